@@ -1,7 +1,11 @@
 from .modules import BaseModule, DownloaderModule
 from .exceptions import DownloadError, StitchingError, ConversionError, InstallError
-from .http import HTTPRequest
-from .stitching import BaseStitcher, PILStitcher, BlenderStitcher, DEFAULT_CUBEMAP_TO_EQUIRECTANGULAR_STITCHER, DEFAULT_STITCHER
+from .httpcache import HTTPCache, get_http_cache
+from .http import HTTPRequest, TileFetcher
+from .asynchttp import AsyncHTTPClient
+from .projection import ProjectionCache, get_projection_cache
+from .storage import PathFile, create_file, link_or_copy, image_size
+from .stitching import BaseStitcher, PILStitcher, BlenderStitcher, NumpyStitcher, DEFAULT_CUBEMAP_TO_EQUIRECTANGULAR_STITCHER, DEFAULT_STITCHER
 
 __all__ = [
     'BaseModule',
@@ -10,10 +14,21 @@ __all__ = [
     'StitchingError',
     'ConversionError',
     'InstallError',
+    'HTTPCache',
+    'get_http_cache',
     'HTTPRequest',
+    'TileFetcher',
+    'AsyncHTTPClient',
+    'ProjectionCache',
+    'get_projection_cache',
+    'PathFile',
+    'create_file',
+    'link_or_copy',
+    'image_size',
     'BaseStitcher',
     'PILStitcher',
     'BlenderStitcher',
+    'NumpyStitcher',
     'DEFAULT_CUBEMAP_TO_EQUIRECTANGULAR_STITCHER',
     'DEFAULT_STITCHER'
 ]
\ No newline at end of file
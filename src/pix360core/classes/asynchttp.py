@@ -0,0 +1,520 @@
+from urllib.parse import urlsplit, urljoin
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .exceptions import DownloadError
+from .http import USER_AGENT, RETRY_STATUSES, REDIRECT_STATUSES, HTTPResponseError, backoff_delay, retry_delay
+from .httpcache import get_http_cache
+
+import asyncio
+import logging
+import re
+import ssl
+
+# Characters allowed in header names, see RFC 9110, section 5.6.2
+HEADER_NAME = re.compile(r"[!#$%&'*+.^_`|~0-9A-Za-z-]+")
+
+def check_headers(headers: Dict[str, str]):
+    """Check that request headers cannot inject further headers or requests
+
+    Args:
+        headers (Dict[str, str]): Request headers
+
+    Raises:
+        ValueError: If a header name is invalid, or a value contains CR, LF or NUL characters
+    """
+    for key, value in headers.items():
+        if not HEADER_NAME.fullmatch(key):
+            raise ValueError(f"Invalid header name: {key!r}")
+
+        if any(character in str(value) for character in "\r\n\0"):
+            raise ValueError(f"Invalid value for header {key}: {value!r}")
+
+class AsyncHTTPConnection:
+    """Minimal HTTP/1.1 client connection on top of asyncio streams
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    @classmethod
+    async def open(cls, scheme: str, host: str, port: int) -> "AsyncHTTPConnection":
+        """Open a connection to a host
+
+        Args:
+            scheme (str): "http" or "https"
+            host (str): Hostname to connect to
+            port (int): Port to connect to
+
+        Returns:
+            AsyncHTTPConnection: The new connection
+        """
+        context = ssl.create_default_context() if scheme == "https" else None
+        reader, writer = await asyncio.open_connection(host, port, ssl=context, server_hostname=host if context else None, limit=2 ** 20)
+        return cls(reader, writer)
+
+    async def request(self, host: str, path: str, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]:
+        """Perform a GET request
+
+        Args:
+            host (str): Value of the Host header
+            path (str): Path and query of the request
+            headers (Dict[str, str]): Request headers
+
+        Returns:
+            Tuple[int, Dict[str, str], bytes]: Status, headers and body of the response
+
+        Raises:
+            OSError: If the connection failed
+            asyncio.IncompleteReadError: If the connection was closed during the response
+            ValueError: If the request headers are invalid, see check_headers(), or the response was malformed
+        """
+        check_headers(headers)
+
+        if any(character in path for character in " \r\n\0"):
+            raise ValueError(f"Invalid request path: {path!r}")
+
+        lines = [f"GET {path} HTTP/1.1", f"Host: {host}", "Accept-Encoding: identity", "Connection: keep-alive"]
+        lines += [f"{key}: {value}" for key, value in headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+
+        version, status = status_line.decode("latin-1").split(" ", 2)[:2]
+        status = int(status)
+
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+
+        connection = response_headers.get("connection", "").lower()
+        self.reusable = connection != "close" and (version != "HTTP/1.0" or connection == "keep-alive")
+
+        if status in (204, 304) or 100 <= status < 200:
+            body = b""
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self.read_chunked()
+        elif "content-length" in response_headers:
+            body = await self.reader.readexactly(int(response_headers["content-length"]))
+        else:
+            body = await self.reader.read()
+            self.reusable = False
+
+        return status, response_headers, body
+
+    async def read_chunked(self) -> bytes:
+        """Read a body sent with chunked transfer encoding
+
+        Returns:
+            bytes: The decoded body
+        """
+        chunks = []
+
+        while True:
+            size = int((await self.reader.readline()).split(b";")[0].strip(), 16)
+
+            if size == 0:
+                while (await self.reader.readline()).strip():
+                    pass
+                return b"".join(chunks)
+
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+    def close(self):
+        """Close the connection
+        """
+        self.reusable = False
+        self.writer.close()
+
+class AsyncHostPool:
+    """Keep-alive connections and rate limit for a single host
+    """
+    def __init__(self, scheme: str, host: str, port: Optional[int], size: int, rate_limit: Optional[float], timeout: float):
+        """Initialize the AsyncHostPool
+
+        Must be created while the event loop is running.
+
+        Args:
+            scheme (str): "http" or "https"
+            host (str): Hostname to connect to
+            port (Optional[int]): Port to connect to, None for the default port of the scheme
+            size (int): Maximum number of connections
+            rate_limit (Optional[float]): Maximum number of requests per second, None for no limit
+            timeout (float): Timeout for connecting and for each request in seconds, not counting the wait for a free connection
+        """
+        self.scheme = scheme
+        self.host = host
+        self.port = port or (443 if scheme == "https" else 80)
+        self.host_header = host if port is None else f"{host}:{port}"
+        self.timeout = timeout
+        self.interval = 1 / rate_limit if rate_limit else 0
+        self.next_slot = 0.0
+        self.semaphore = asyncio.Semaphore(size)
+        self.idle = []
+
+    async def throttle(self):
+        """Wait until the rate limit allows the next request
+        """
+        if not self.interval:
+            return
+
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def request(self, path: str, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]:
+        """Perform a GET request on a pooled connection
+
+        A reused connection may have been closed by the server in the
+        meantime, in which case the request is repeated once on a new one.
+
+        Args:
+            path (str): Path and query of the request
+            headers (Dict[str, str]): Request headers
+
+        Returns:
+            Tuple[int, Dict[str, str], bytes]: Status, headers and body of the response
+
+        Raises:
+            asyncio.TimeoutError: If connecting or the request timed out
+            OSError: If the connection failed
+        """
+        async with self.semaphore:
+            await self.throttle()
+
+            while True:
+                reused = bool(self.idle)
+                connection = self.idle.pop() if reused else await asyncio.wait_for(AsyncHTTPConnection.open(self.scheme, self.host, self.port), self.timeout)
+
+                try:
+                    response = await asyncio.wait_for(connection.request(self.host_header, path, headers), self.timeout)
+                except asyncio.TimeoutError:
+                    connection.close()
+                    raise
+                except (OSError, asyncio.IncompleteReadError, ValueError):
+                    connection.close()
+                    if reused:
+                        continue
+                    raise
+                except BaseException:
+                    # Cancelled mid-response, the connection is unusable
+                    connection.close()
+                    raise
+
+                if connection.reusable:
+                    self.idle.append(connection)
+                else:
+                    connection.close()
+
+                return response
+
+    def close(self):
+        """Close all idle connections
+        """
+        while self.idle:
+            self.idle.pop().close()
+
+class AsyncHTTPClient:
+    """asyncio based downloader for very large numbers of files
+
+    This is the asyncio counterpart to TileFetcher. Thousands of requests
+    can be in flight as coroutines while only a few connections per host
+    are opened, and requests to each host can be rate limited. Requests
+    are sent with the same User-Agent as HTTPRequest, and retried with
+    exponential backoff like TileFetcher.
+
+    The client has to be used from within a single event loop, for example:
+
+        async with AsyncHTTPClient() as client:
+            tiles = await client.fetch_all(urls)
+    """
+    def __init__(self, connections_per_host: Optional[int] = None, rate_limit: Optional[float] = None, retries: Optional[int] = None, timeout: Optional[float] = None, headers: Optional[Dict[str, str]] = None, max_redirects: int = 5, cache: bool = True):
+        """Initialize the AsyncHTTPClient
+
+        Args:
+            connections_per_host (Optional[int], optional): Number of connections per host. Defaults to the PIX360_HTTP_CONNECTIONS_PER_HOST setting, or 6.
+            rate_limit (Optional[float], optional): Maximum requests per second per host. Defaults to the PIX360_HTTP_RATE_LIMIT setting, or no limit.
+            retries (Optional[int], optional): Number of attempts per request. Defaults to the PIX360_HTTP_RETRIES setting, or 3.
+            timeout (Optional[float], optional): Timeout for connecting and for each request in seconds. Defaults to the PIX360_HTTP_TIMEOUT setting, or 10.
+            headers (Optional[Dict[str, str]], optional): Additional headers to send with every request. Defaults to None.
+            max_redirects (int, optional): Maximum number of redirects to follow per request. Defaults to 5.
+            cache (bool, optional): Whether to use the shared HTTP cache. Defaults to True.
+        """
+        self.logger = logging.getLogger("pix360")
+
+        self.connections_per_host = connections_per_host or getattr(settings, "PIX360_HTTP_CONNECTIONS_PER_HOST", 6)
+        self.rate_limit = rate_limit or getattr(settings, "PIX360_HTTP_RATE_LIMIT", None)
+        self.retries = retries or getattr(settings, "PIX360_HTTP_RETRIES", 3)
+        self.timeout = timeout or getattr(settings, "PIX360_HTTP_TIMEOUT", 10)
+        self.max_redirects = max_redirects
+
+        self.headers = {"User-Agent": USER_AGENT}
+        self.headers.update(headers or {})
+
+        self.cache = get_http_cache() if cache else None
+        self.pools = {}
+
+    def pool(self, scheme: str, host: str, port: Optional[int]) -> AsyncHostPool:
+        """Get the connection pool for a host
+
+        Args:
+            scheme (str): "http" or "https"
+            host (str): Hostname
+            port (Optional[int]): Port, None for the default port of the scheme
+
+        Returns:
+            AsyncHostPool: The connection pool
+        """
+        key = (scheme, host, port)
+        if key not in self.pools:
+            self.pools[key] = AsyncHostPool(scheme, host, port, self.connections_per_host, self.rate_limit, self.timeout)
+        return self.pools[key]
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+        """Perform a single GET request, following redirects
+
+        Args:
+            url (str): URL to request
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            Tuple[int, Dict[str, str], bytes]: Status, headers and body of the final response
+
+        Raises:
+            DownloadError: If the URL or the request headers are invalid, or the URL redirects too often
+            HTTPResponseError: If the server responded with an error status
+        """
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+
+        try:
+            check_headers(request_headers)
+        except ValueError as e:
+            raise DownloadError(f"Invalid request for {url}: {e}") from e
+
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise DownloadError(f"Unsupported URL: {url}")
+
+            path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+            status, response_headers, body = await self.pool(parts.scheme, parts.hostname, parts.port).request(path, request_headers)
+
+            if status in REDIRECT_STATUSES and "location" in response_headers:
+                url = urljoin(url, response_headers["location"])
+                continue
+
+            if status >= 400:
+                retry_after = response_headers.get("retry-after")
+                retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                raise HTTPResponseError(f"HTTP {status} while downloading {url}", status, retry_after)
+
+            return status, response_headers, body
+
+        raise DownloadError(f"Too many redirects while downloading {url}")
+
+    async def cached_get(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, str], bytes]:
+        """Perform a single GET request through the HTTP cache, see TileFetcher.cached_get()
+
+        The cache is accessed in the default executor, so its disk I/O does
+        not block the event loop.
+
+        Args:
+            url (str): URL to request
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            Tuple[Dict[str, str], bytes]: Headers and body of the response
+
+        Raises:
+            DownloadError: See get()
+            HTTPResponseError: See get()
+        """
+        if not self.cache:
+            return (await self.get(url, headers))[1:]
+
+        loop = asyncio.get_running_loop()
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        entry = await loop.run_in_executor(None, self.cache.lookup, url, request_headers)
+
+        if entry and entry.fresh:
+            try:
+                return entry.headers, await loop.run_in_executor(None, entry.read)
+            except OSError:
+                # The blob was evicted by another process in the meantime
+                entry = None
+
+        status, response_headers, body = await self.get(url, dict(headers or {}, **entry.validators()) if entry else headers)
+
+        if status == 304 and entry:
+            entry = await loop.run_in_executor(None, self.cache.refresh, entry, response_headers)
+            try:
+                return entry.headers, await loop.run_in_executor(None, entry.read)
+            except OSError:
+                status, response_headers, body = await self.get(url, headers)
+
+        if status == 200:
+            await loop.run_in_executor(None, self.cache.store, url, request_headers, response_headers, body)
+
+        return response_headers, body
+
+    async def fetch_response(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, str], bytes]:
+        """Download a URL, retrying with exponential backoff on failure
+
+        Responses are cached, see cached_get(). Connection errors, timeouts and 429 and 5xx responses are retried,
+        other error responses fail immediately.
+
+        Args:
+            url (str): URL to download
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            Tuple[Dict[str, str], bytes]: Headers and body of the response
+
+        Raises:
+            DownloadError: If the download failed
+        """
+        self.logger.debug(f"Fetching {url}")
+
+        for attempt in range(self.retries):
+            try:
+                return await self.cached_get(url, headers)
+            except HTTPResponseError as e:
+                if e.status not in RETRY_STATUSES or attempt == self.retries - 1:
+                    raise
+                self.logger.warning(f"Error while fetching {url}: {e}")
+                await asyncio.sleep(retry_delay(attempt, e.retry_after))
+            except DownloadError:
+                raise
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                self.logger.warning(f"Error while fetching {url}: {e!r}")
+                if attempt == self.retries - 1:
+                    raise DownloadError(f"Error downloading file from {url}") from e
+                await asyncio.sleep(backoff_delay(attempt))
+
+    async def fetch(self, url: str, headers: Optional[Dict[str, str]] = None) -> bytes:
+        """Download a URL, see fetch_response()
+
+        Args:
+            url (str): URL to download
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            bytes: Body of the response
+
+        Raises:
+            DownloadError: If the download failed
+        """
+        return (await self.fetch_response(url, headers))[1]
+
+    async def iter_fetch(self, urls: List[str], headers: Optional[Dict[str, str]] = None) -> AsyncIterator[Tuple[int, Dict[str, str], bytes]]:
+        """Download URLs concurrently, yielding each response as soon as it is complete
+
+        If a download fails, the remaining downloads are cancelled and the
+        error is raised.
+
+        Args:
+            urls (List[str]): URLs to download
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Yields:
+            Tuple[int, Dict[str, str], bytes]: Index of the URL in the input, headers and body of the response
+
+        Raises:
+            DownloadError: If a download failed
+        """
+        async def indexed(index, url):
+            return (index,) + await self.fetch_response(url, headers)
+
+        tasks = [asyncio.ensure_future(indexed(index, url)) for index, url in enumerate(urls)]
+
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def fetch_all(self, urls: List[str], headers: Optional[Dict[str, str]] = None) -> List[bytes]:
+        """Download URLs concurrently
+
+        Args:
+            urls (List[str]): URLs to download
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            List[bytes]: Bodies of the responses, in input order
+
+        Raises:
+            DownloadError: If a download failed
+        """
+        results = [None] * len(urls)
+
+        async for index, _, body in self.iter_fetch(urls, headers):
+            results[index] = body
+
+        return results
+
+    async def fetch_grid(self, grid: List[List[str]], headers: Optional[Dict[str, str]] = None) -> List[List[bytes]]:
+        """Download a grid of URLs concurrently
+
+        Args:
+            grid (List[List[str]]): Lines of URLs to download, for example the rows of a tiled image
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            List[List[bytes]]: Bodies of the responses, in the shape of the grid
+
+        Raises:
+            DownloadError: If a download failed
+        """
+        bodies = iter(await self.fetch_all([url for line in grid for url in line], headers))
+        return [[next(bodies) for _ in line] for line in grid]
+
+    async def close(self):
+        """Close all connections
+        """
+        for pool in self.pools.values():
+            pool.close()
+        self.pools.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+def fetch_all(urls: List[str], headers: Optional[Dict[str, str]] = None, **kwargs) -> List[bytes]:
+    """Download URLs with an AsyncHTTPClient from synchronous code
+
+    Args:
+        urls (List[str]): URLs to download
+        headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+        **kwargs: Arguments for the AsyncHTTPClient
+
+    Returns:
+        List[bytes]: Bodies of the responses, in input order
+
+    Raises:
+        DownloadError: If a download failed
+    """
+    async def run():
+        async with AsyncHTTPClient(**kwargs) as client:
+            return await client.fetch_all(urls, headers)
+
+    return asyncio.run(run())
@@ -1,11 +1,87 @@
 from urllib.request import Request, urlopen
+from urllib.parse import urlsplit, urljoin
+from urllib.error import HTTPError
+from http.client import HTTPConnection, HTTPSConnection, HTTPException, HTTPMessage
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple
 
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from ..models import File, Conversion
+from ..models.content import checkpoint_key
 from .exceptions import DownloadError
+from .httpcache import get_http_cache
+from ..progress import get_progress_reporter, PHASE_DOWNLOAD
 
+import io
 import logging
+import mimetypes
+import posixpath
+import queue
+import random
+import threading
+import time
 
 USER_AGENT = 'Mozilla/5.0 (compatible; Pix360/dev; +https://kumig.it/kumisystems/pix360)'
 
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Get the delay before retrying a request, using exponential backoff with full jitter
+
+    Args:
+        attempt (int): Number of the failed attempt, starting at 0
+        base (float, optional): Delay after the first attempt in seconds, before jitter. Defaults to 0.5.
+        cap (float, optional): Maximum delay in seconds. Defaults to 30.0.
+
+    Returns:
+        float: Delay in seconds
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Get the delay before retrying a failed request
+
+    The delay requested by the server in a Retry-After header is honoured
+    up to the PIX360_HTTP_MAX_RETRY_AFTER setting, or 60 seconds, so a
+    server cannot stall a worker indefinitely. Without one, see
+    backoff_delay().
+
+    Args:
+        attempt (int): Number of the failed attempt, starting at 0
+        retry_after (Optional[float], optional): Delay requested by the server in seconds. Defaults to None.
+
+    Returns:
+        float: Delay in seconds
+    """
+    if retry_after is None:
+        return backoff_delay(attempt)
+
+    return min(retry_after, getattr(settings, "PIX360_HTTP_MAX_RETRY_AFTER", 60))
+
+class CachedResponse(io.BytesIO):
+    """Response served from the HTTP cache, with the interface of a urllib response
+    """
+    def __init__(self, url: str, headers: Dict[str, str], body: bytes):
+        super().__init__(body)
+        self.url = url
+        self.status = 200
+        self.headers = HTTPMessage()
+
+        for key, value in headers.items():
+            self.headers[key] = value
+
+    def getcode(self) -> int:
+        return self.status
+
+    def geturl(self) -> str:
+        return self.url
+
+    def info(self) -> HTTPMessage:
+        return self.headers
+
 class HTTPRequest(Request):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -14,12 +90,452 @@ class HTTPRequest(Request):
 
         self.headers['User-Agent'] = USER_AGENT
 
-    def open(self, retries=3, timeout=10, *args, **kwargs):
+    def open(self, retries=3, timeout=10, *args, cache=False, **kwargs):
+        # The response is streamed unless the caller opts into the HTTP cache,
+        # which reads bodies up to its maximum entry size into memory
+        cache = get_http_cache() if cache and self.get_method() == "GET" and self.data is None else None
+        request_headers = dict(self.header_items())
+        entry = cache.lookup(self.full_url, request_headers) if cache else None
+
+        if entry and entry.fresh:
+            try:
+                self.logger.debug(f"Serving {self.full_url} from cache")
+                return CachedResponse(self.full_url, entry.headers, entry.read())
+            except OSError:
+                entry = None
+
         self.logger.debug(f"Opening {self.full_url}")
+
         for i in range(retries):
+            for key, value in (entry.validators() if entry else {}).items():
+                self.add_unredirected_header(key, value)
+
             try:
-                return urlopen(self, timeout=timeout, *args, **kwargs)
+                response = urlopen(self, timeout=timeout, *args, **kwargs)
+
+                length = response.headers.get("Content-Length")
+
+                # Only bodies of known, bounded size are cached, larger ones are streamed
+                if cache and length and length.isdigit() and int(length) <= cache.max_entry_size:
+                    with response:
+                        body = response.read()
+                    cache.store(self.full_url, request_headers, dict(response.headers.items()), body)
+                    return CachedResponse(response.url, dict(response.headers.items()), body)
+
+                return response
             except Exception as e:
+                if isinstance(e, HTTPError) and e.code == 304 and entry:
+                    entry = cache.refresh(entry, dict(e.headers.items()))
+                    try:
+                        return CachedResponse(self.full_url, entry.headers, entry.read())
+                    except OSError:
+                        # Evicted by another process in the meantime, fetch it unconditionally
+                        entry = None
+                        self.unredirected_hdrs.clear()
+                        continue
                 self.logger.warn(f"Error while opening {self.full_url}: {e}")
                 if i == retries - 1:
                     raise DownloadError(f"Error downloading file from {self.full_url}") from e
+                time.sleep(backoff_delay(i))
+
+class HTTPResponseError(DownloadError):
+    """Error raised when a server responds with an error status
+
+    Attributes:
+        status (int): HTTP status code of the response
+        retry_after (Optional[float]): Delay requested by the server in its Retry-After header
+    """
+    def __init__(self, message: str, status: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class HTTPConnectionPool:
+    """Pool of keep-alive connections to a single host
+    """
+    def __init__(self, scheme: str, host: str, port: Optional[int], size: int, timeout: float):
+        """Initialize the HTTPConnectionPool
+
+        Args:
+            scheme (str): "http" or "https"
+            host (str): Hostname to connect to
+            port (Optional[int]): Port to connect to, None for the default port of the scheme
+            size (int): Maximum number of concurrent requests, and of idle connections kept
+            timeout (float): Socket timeout of the connections in seconds
+        """
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue(size)
+
+    def connect(self) -> HTTPConnection:
+        """Open a new connection to the host
+
+        Returns:
+            HTTPConnection: The new connection
+        """
+        connection_class = HTTPSConnection if self.scheme == "https" else HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def request(self, path: str, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], bytes]:
+        """Perform a GET request on a pooled connection
+
+        A reused connection may have been closed by the server in the
+        meantime, in which case the request is repeated once on a new one.
+
+        Args:
+            path (str): Path and query of the request
+            headers (Dict[str, str]): Request headers
+
+        Returns:
+            Tuple[int, Dict[str, str], bytes]: Status, headers and body of the response
+
+        Raises:
+            OSError: If the connection failed
+            HTTPException: If the response was malformed
+        """
+        with self.semaphore:
+            while True:
+                try:
+                    connection, reused = self.idle.get_nowait(), True
+                except queue.Empty:
+                    connection, reused = self.connect(), False
+
+                try:
+                    connection.request("GET", path, headers=headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                except (OSError, HTTPException):
+                    connection.close()
+                    if reused:
+                        continue
+                    raise
+
+                if response.will_close:
+                    connection.close()
+                else:
+                    try:
+                        self.idle.put_nowait(connection)
+                    except queue.Full:
+                        connection.close()
+
+                return response.status, {key.lower(): value for key, value in response.getheaders()}, body
+
+    def close(self):
+        """Close all idle connections
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class TileFetcher:
+    """Concurrent downloader for large numbers of files, like the tiles of a panorama
+
+    Requests run in a thread pool, with a limited number of concurrent
+    requests and reused keep-alive connections per host. Failed requests
+    are retried with exponential backoff and jitter.
+    """
+    def __init__(self, workers: Optional[int] = None, connections_per_host: Optional[int] = None, retries: Optional[int] = None, timeout: Optional[float] = None, headers: Optional[Dict[str, str]] = None, max_redirects: int = 5, cache: bool = True):
+        """Initialize the TileFetcher
+
+        Args:
+            workers (Optional[int], optional): Number of concurrent requests overall. Defaults to the PIX360_HTTP_WORKERS setting, or 16.
+            connections_per_host (Optional[int], optional): Number of concurrent requests per host. Defaults to the PIX360_HTTP_CONNECTIONS_PER_HOST setting, or 6.
+            retries (Optional[int], optional): Number of attempts per request. Defaults to the PIX360_HTTP_RETRIES setting, or 3.
+            timeout (Optional[float], optional): Socket timeout per request in seconds. Defaults to the PIX360_HTTP_TIMEOUT setting, or 10.
+            headers (Optional[Dict[str, str]], optional): Additional headers to send with every request. Defaults to None.
+            max_redirects (int, optional): Maximum number of redirects to follow per request. Defaults to 5.
+            cache (bool, optional): Whether to use the shared HTTP cache. Defaults to True.
+        """
+        self.logger = logging.getLogger("pix360")
+
+        self.workers = workers or getattr(settings, "PIX360_HTTP_WORKERS", 16)
+        self.connections_per_host = connections_per_host or getattr(settings, "PIX360_HTTP_CONNECTIONS_PER_HOST", 6)
+        self.retries = retries or getattr(settings, "PIX360_HTTP_RETRIES", 3)
+        self.timeout = timeout or getattr(settings, "PIX360_HTTP_TIMEOUT", 10)
+        self.max_redirects = max_redirects
+
+        self.headers = {"User-Agent": USER_AGENT}
+        self.headers.update(headers or {})
+
+        self.cache = get_http_cache() if cache else None
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pix360-fetch")
+
+    def pool(self, scheme: str, host: str, port: Optional[int]) -> HTTPConnectionPool:
+        """Get the connection pool for a host
+
+        Args:
+            scheme (str): "http" or "https"
+            host (str): Hostname
+            port (Optional[int]): Port, None for the default port of the scheme
+
+        Returns:
+            HTTPConnectionPool: The connection pool
+        """
+        with self.lock:
+            key = (scheme, host, port)
+            if key not in self.pools:
+                self.pools[key] = HTTPConnectionPool(scheme, host, port, self.connections_per_host, self.timeout)
+            return self.pools[key]
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+        """Perform a single GET request, following redirects
+
+        Args:
+            url (str): URL to request
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            Tuple[int, Dict[str, str], bytes]: Status, headers and body of the final response
+
+        Raises:
+            DownloadError: If the URL is invalid or redirects too often
+            HTTPResponseError: If the server responded with an error status
+            OSError: If the connection failed
+            HTTPException: If the response was malformed
+        """
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise DownloadError(f"Unsupported URL: {url}")
+
+            path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+            status, response_headers, body = self.pool(parts.scheme, parts.hostname, parts.port).request(path, request_headers)
+
+            if status in REDIRECT_STATUSES and "location" in response_headers:
+                url = urljoin(url, response_headers["location"])
+                continue
+
+            if status >= 400:
+                retry_after = response_headers.get("retry-after")
+                retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+                raise HTTPResponseError(f"HTTP {status} while downloading {url}", status, retry_after)
+
+            return status, response_headers, body
+
+        raise DownloadError(f"Too many redirects while downloading {url}")
+
+    def cached_get(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, str], bytes]:
+        """Perform a single GET request through the HTTP cache
+
+        Fresh cached responses are returned without a request, stale ones
+        are revalidated, and new successful responses are stored.
+
+        Args:
+            url (str): URL to request
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            Tuple[Dict[str, str], bytes]: Headers and body of the response
+
+        Raises:
+            DownloadError: See get()
+            HTTPResponseError: See get()
+            OSError: See get()
+            HTTPException: See get()
+        """
+        if not self.cache:
+            return self.get(url, headers)[1:]
+
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        entry = self.cache.lookup(url, request_headers)
+
+        if entry and entry.fresh:
+            try:
+                return entry.headers, entry.read()
+            except OSError:
+                # The blob was evicted by another process in the meantime
+                entry = None
+
+        status, response_headers, body = self.get(url, dict(headers or {}, **entry.validators()) if entry else headers)
+
+        if status == 304 and entry:
+            entry = self.cache.refresh(entry, response_headers)
+            try:
+                return entry.headers, entry.read()
+            except OSError:
+                status, response_headers, body = self.get(url, headers)
+
+        if status == 200:
+            self.cache.store(url, request_headers, response_headers, body)
+
+        return response_headers, body
+
+    def fetch_response(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, str], bytes]:
+        """Download a URL, retrying with exponential backoff on failure
+
+        Responses are cached, see cached_get(). Connection errors and 429 and 5xx responses are retried, other error
+        responses fail immediately. Delays requested by the server are capped, see retry_delay().
+
+        Args:
+            url (str): URL to download
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            Tuple[Dict[str, str], bytes]: Headers and body of the response
+
+        Raises:
+            DownloadError: If the download failed
+        """
+        self.logger.debug(f"Fetching {url}")
+
+        for attempt in range(self.retries):
+            try:
+                return self.cached_get(url, headers)
+            except HTTPResponseError as e:
+                if e.status not in RETRY_STATUSES or attempt == self.retries - 1:
+                    raise
+                self.logger.warning(f"Error while fetching {url}: {e}")
+                time.sleep(retry_delay(attempt, e.retry_after))
+            except DownloadError:
+                raise
+            except (OSError, HTTPException) as e:
+                self.logger.warning(f"Error while fetching {url}: {e}")
+                if attempt == self.retries - 1:
+                    raise DownloadError(f"Error downloading file from {url}") from e
+                time.sleep(backoff_delay(attempt))
+
+    def fetch(self, url: str, headers: Optional[Dict[str, str]] = None) -> bytes:
+        """Download a URL, see fetch_response()
+
+        Args:
+            url (str): URL to download
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            bytes: Body of the response
+
+        Raises:
+            DownloadError: If the download failed
+        """
+        return self.fetch_response(url, headers)[1]
+
+    def iter_fetch(self, urls: List[str], headers: Optional[Dict[str, str]] = None) -> Iterator[Tuple[int, Dict[str, str], bytes]]:
+        """Download URLs concurrently, yielding each response as soon as it is complete
+
+        If a download fails, the downloads that have not started yet are
+        cancelled and the error is raised.
+
+        Args:
+            urls (List[str]): URLs to download
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Yields:
+            Tuple[int, Dict[str, str], bytes]: Index of the URL in the input, headers and body of the response
+
+        Raises:
+            DownloadError: If a download failed
+        """
+        futures = {self.executor.submit(self.fetch_response, url, headers): index for index, url in enumerate(urls)}
+
+        try:
+            for future in as_completed(futures):
+                yield (futures[future],) + future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def fetch_all(self, urls: List[str], headers: Optional[Dict[str, str]] = None) -> List[bytes]:
+        """Download URLs concurrently
+
+        Args:
+            urls (List[str]): URLs to download
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            List[bytes]: Bodies of the responses, in input order
+
+        Raises:
+            DownloadError: If a download failed
+        """
+        results = [None] * len(urls)
+
+        for index, _, body in self.iter_fetch(urls, headers):
+            results[index] = body
+
+        return results
+
+    def fetch_grid(self, grid: List[List[str]], headers: Optional[Dict[str, str]] = None) -> List[List[bytes]]:
+        """Download a grid of URLs concurrently
+
+        Args:
+            grid (List[List[str]]): Lines of URLs to download, for example the rows of a tiled image
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            List[List[bytes]]: Bodies of the responses, in the shape of the grid
+
+        Raises:
+            DownloadError: If a download failed
+        """
+        bodies = iter(self.fetch_all([url for line in grid for url in line], headers))
+        return [[next(bodies) for _ in line] for line in grid]
+
+    def fetch_grid_files(self, grid: List[List[str]], conversion: Conversion, headers: Optional[Dict[str, str]] = None) -> List[List[File]]:
+        """Download a grid of URLs concurrently into File objects
+
+        Each download is saved as soon as it completes, so only the downloads
+        in flight are held in memory. The result can be passed to a
+        stitcher's stitch() method directly.
+
+        The files are checkpoints of the conversion, so when a failed
+        conversion is retried or reclaimed, tiles downloaded before are
+        reused instead of being downloaded again. The number of downloaded
+        files is reported as the progress of the conversion.
+
+        Args:
+            grid (List[List[str]]): Lines of URLs to download, for example the rows of a tiled image
+            conversion (Conversion): Conversion the files belong to
+            headers (Optional[Dict[str, str]], optional): Additional request headers. Defaults to None.
+
+        Returns:
+            List[List[File]]: File objects in the shape of the grid
+
+        Raises:
+            DownloadError: If a download failed
+        """
+        checkpoints = conversion.get_checkpoints(File.STAGE_DOWNLOADED)
+        files = {url: checkpoints[checkpoint_key(url)] for line in grid for url in line if checkpoint_key(url) in checkpoints}
+        urls = list(dict.fromkeys(url for line in grid for url in line if url not in files))
+
+        if files:
+            self.logger.debug(f"Resuming with {len(files)} downloaded files, {len(urls)} remaining")
+
+        progress = get_progress_reporter(conversion)
+        total = len(files) + len(urls)
+        progress.report(PHASE_DOWNLOAD, len(files), total)
+
+        for index, response_headers, body in self.iter_fetch(urls, headers):
+            name = posixpath.basename(urlsplit(urls[index]).path) or "tile"
+            mime_type = response_headers.get("content-type", "").split(";")[0].strip() or mimetypes.guess_type(name)[0] or "application/octet-stream"
+            files[urls[index]] = File.objects.create(conversion=conversion, file=ContentFile(body, name=name), mime_type=mime_type, stage=File.STAGE_DOWNLOADED, key=checkpoint_key(urls[index]))
+            progress.report(PHASE_DOWNLOAD, len(files), total)
+
+        return [[files[url] for url in line] for line in grid]
+
+    def close(self):
+        """Stop the worker threads and close all connections
+        """
+        self.executor.shutdown(wait=True)
+
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,371 @@
+from django.conf import settings
+
+from typing import Dict, Optional
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+from ..paths import user_cache_path
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Request headers that can change the response, and so are part of the cache key
+KEY_HEADERS = ("accept", "accept-language", "authorization", "cookie", "range")
+
+# Response headers kept with a cached response
+STORED_HEADERS = ("content-type", "etag", "last-modified", "cache-control", "expires")
+
+class CacheEntry:
+    """A response stored in the HTTPCache
+
+    Attributes:
+        key (str): Cache key of the request
+        url (str): URL of the request
+        digest (str): SHA-256 of the body, which is also the name of the blob file
+        size (int): Size of the body in bytes
+        headers (Dict[str, str]): Stored response headers, with lowercase names
+        expires (float): Time until which the entry is fresh, as a Unix timestamp
+        path (Path): Path of the blob file holding the body
+    """
+    def __init__(self, key: str, url: str, digest: str, size: int, headers: Dict[str, str], expires: float, path: Path):
+        self.key = key
+        self.url = url
+        self.digest = digest
+        self.size = size
+        self.headers = headers
+        self.expires = expires
+        self.path = path
+
+    @property
+    def fresh(self) -> bool:
+        """Whether the entry can be used without revalidating it
+        """
+        return time.time() < self.expires
+
+    def validators(self) -> Dict[str, str]:
+        """Get the headers for a conditional request revalidating this entry
+
+        Returns:
+            Dict[str, str]: If-None-Match and/or If-Modified-Since headers
+        """
+        headers = {}
+
+        if "etag" in self.headers:
+            headers["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["last-modified"]
+
+        return headers
+
+    def read(self) -> bytes:
+        """Read the body of the response
+
+        Returns:
+            bytes: The body
+
+        Raises:
+            OSError: If the blob file was removed by a concurrent eviction
+        """
+        return self.path.read_bytes()
+
+class HTTPCache:
+    """Content-addressed on-disk cache for HTTP responses
+
+    Bodies are stored once per distinct content, named by their SHA-256, and
+    an SQLite index maps requests (URL plus the headers that can change the
+    response) to them. The index is shared safely by all processes using
+    the same directory. When the total size of the cache exceeds its limit,
+    the least recently used entries are evicted.
+
+    Responses are fresh as long as their Cache-Control or Expires headers
+    say. Responses with neither are only cached if they have an ETag or
+    Last-Modified header, and are then fresh for a default time. Stale
+    entries are revalidated with If-None-Match and If-Modified-Since.
+    """
+    def __init__(self, directory: str, max_size: int = 2 * 1024 * 1024 * 1024, default_ttl: float = 24 * 60 * 60, max_entry_size: int = 64 * 1024 * 1024):
+        """Initialize the HTTPCache
+
+        Args:
+            directory (str): Directory to store the cache in
+            max_size (int, optional): Maximum total size of the cached bodies in bytes. Defaults to 2 GiB.
+            default_ttl (float, optional): Freshness of responses with validators but without caching headers in seconds. Defaults to one day.
+            max_entry_size (int, optional): Maximum size of a single cached body in bytes. Defaults to 64 MiB.
+        """
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.max_entry_size = max_entry_size
+        self.local = threading.local()
+        self.logger = logging.getLogger("pix360")
+
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        (self.directory / "blobs").mkdir(exist_ok=True)
+
+        with self.connection() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    headers TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+
+    def connection(self) -> sqlite3.Connection:
+        """Get the index connection of the current thread
+
+        Connections are not shared between threads or inherited by forked
+        processes.
+
+        Returns:
+            sqlite3.Connection: Connection to the index
+        """
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.directory / "index.sqlite3", timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return self.local.connection
+
+    @staticmethod
+    def key(url: str, headers: Optional[Dict[str, str]] = None) -> str:
+        """Build the cache key of a request
+
+        Args:
+            url (str): URL of the request
+            headers (Optional[Dict[str, str]], optional): Request headers. Defaults to None.
+
+        Returns:
+            str: Cache key
+        """
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        relevant = [(name, headers[name]) for name in KEY_HEADERS if name in headers]
+        return hashlib.sha256(json.dumps([url, relevant]).encode()).hexdigest()
+
+    def blob_path(self, digest: str) -> Path:
+        """Get the path of the blob file for a body
+
+        Args:
+            digest (str): SHA-256 of the body
+
+        Returns:
+            Path: Path of the blob file
+        """
+        return self.directory / "blobs" / digest[:2] / digest
+
+    def lookup(self, url: str, headers: Optional[Dict[str, str]] = None) -> Optional[CacheEntry]:
+        """Look up the cached response to a request
+
+        Args:
+            url (str): URL of the request
+            headers (Optional[Dict[str, str]], optional): Request headers. Defaults to None.
+
+        Returns:
+            Optional[CacheEntry]: The cached response, which may be stale, or None
+        """
+        key = self.key(url, headers)
+
+        with self.connection() as connection:
+            row = connection.execute("SELECT digest, size, headers, expires FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                return None
+
+            connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        digest, size, stored_headers, expires = row
+        entry = CacheEntry(key, url, digest, size, json.loads(stored_headers), expires, self.blob_path(digest))
+
+        if not entry.path.exists():
+            self.delete(key)
+            return None
+
+        return entry
+
+    def expiry(self, headers: Dict[str, str]) -> Optional[float]:
+        """Compute until when a response is fresh
+
+        Args:
+            headers (Dict[str, str]): Response headers, with lowercase names
+
+        Returns:
+            Optional[float]: Expiry as a Unix timestamp, or None if the response must not be cached, or cannot be revalidated and has no caching headers
+        """
+        now = time.time()
+        directives = {}
+
+        for directive in headers.get("cache-control", "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            directives[name] = value.strip('"')
+
+        if "no-store" in directives:
+            return None
+
+        if "no-cache" in directives:
+            return now
+
+        for name in ("s-maxage", "max-age"):
+            if directives.get(name, "").isdigit():
+                return now + int(directives[name])
+
+        if "expires" in headers:
+            try:
+                return parsedate_to_datetime(headers["expires"]).timestamp()
+            except (TypeError, ValueError):
+                return now
+
+        # Without validators, a stale response could never be revalidated
+        if "etag" not in headers and "last-modified" not in headers:
+            return None
+
+        return now + self.default_ttl
+
+    def store(self, url: str, headers: Optional[Dict[str, str]], response_headers: Dict[str, str], body: bytes) -> Optional[CacheEntry]:
+        """Store a successful response
+
+        Args:
+            url (str): URL of the request
+            headers (Optional[Dict[str, str]]): Request headers
+            response_headers (Dict[str, str]): Response headers
+            body (bytes): Response body
+
+        Returns:
+            Optional[CacheEntry]: The new entry, or None if the response is not cacheable
+        """
+        response_headers = {name.lower(): value for name, value in response_headers.items()}
+        expires = self.expiry(response_headers)
+
+        if expires is None or len(body) > self.max_entry_size:
+            return None
+
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.blob_path(digest)
+
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            handle, temporary = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+
+            with os.fdopen(handle, "wb") as f:
+                f.write(body)
+
+            # Blobs are immutable, so concurrent writers can safely replace each other's
+            os.replace(temporary, path)
+
+        key = self.key(url, headers)
+        stored_headers = {name: response_headers[name] for name in STORED_HEADERS if name in response_headers}
+
+        with self.connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, url, digest, size, headers, expires, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, url, digest, len(body), json.dumps(stored_headers), expires, time.time())
+            )
+
+        self.evict()
+
+        return CacheEntry(key, url, digest, len(body), stored_headers, expires, path)
+
+    def refresh(self, entry: CacheEntry, response_headers: Dict[str, str]) -> CacheEntry:
+        """Update an entry after the server confirmed it is still valid (304 Not Modified)
+
+        Args:
+            entry (CacheEntry): The revalidated entry
+            response_headers (Dict[str, str]): Headers of the 304 response
+
+        Returns:
+            CacheEntry: The updated entry
+        """
+        response_headers = {name.lower(): value for name, value in response_headers.items()}
+        entry.headers.update({name: response_headers[name] for name in STORED_HEADERS if name in response_headers})
+        entry.expires = self.expiry(entry.headers) or time.time()
+
+        with self.connection() as connection:
+            connection.execute("UPDATE entries SET headers = ?, expires = ?, accessed = ? WHERE key = ?", (json.dumps(entry.headers), entry.expires, time.time(), entry.key))
+
+        return entry
+
+    def delete(self, key: str):
+        """Remove an entry from the index
+
+        Args:
+            key (str): Cache key of the entry
+        """
+        with self.connection() as connection:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def evict(self):
+        """Evict the least recently used entries until the cache is within its size limit
+
+        A blob is deleted once no entry refers to it any more.
+        """
+        with self.connection() as connection:
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)").fetchone()[0]
+
+            if total <= self.max_size:
+                return
+
+            rows = connection.execute("SELECT key, digest, size FROM entries ORDER BY accessed").fetchall()
+            evicted = set()
+
+            for key, digest, size in rows:
+                if total <= self.max_size:
+                    break
+
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+                if not connection.execute("SELECT 1 FROM entries WHERE digest = ?", (digest,)).fetchone():
+                    total -= size
+                    evicted.add(digest)
+
+        for digest in evicted:
+            try:
+                self.blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+
+        self.logger.debug(f"Evicted {len(evicted)} blobs from the HTTP cache")
+
+_http_cache = None
+
+def get_http_cache() -> Optional[HTTPCache]:
+    """Get the process-wide HTTP cache, configured from the Django settings
+
+    Settings:
+        PIX360_HTTP_CACHE_DIR: Directory of the cache, None to disable it (default: pix360/http in the cache directory of the user)
+        PIX360_HTTP_CACHE_SIZE: Maximum total size of the cache in bytes (default: 2 GiB)
+        PIX360_HTTP_CACHE_TTL: Freshness of responses with validators but without caching headers in seconds (default: one day)
+
+    Returns:
+        Optional[HTTPCache]: The HTTP cache, or None if it is disabled or its directory cannot be used
+    """
+    global _http_cache
+
+    if _http_cache is None:
+        directory = getattr(settings, "PIX360_HTTP_CACHE_DIR", user_cache_path("http"))
+
+        if not directory:
+            return None
+
+        try:
+            _http_cache = HTTPCache(
+                directory,
+                max_size=getattr(settings, "PIX360_HTTP_CACHE_SIZE", 2 * 1024 * 1024 * 1024),
+                default_ttl=getattr(settings, "PIX360_HTTP_CACHE_TTL", 24 * 60 * 60),
+            )
+        except (OSError, sqlite3.Error) as e:
+            # Downloads work without the cache, just slower
+            logging.getLogger("pix360").warning(f"HTTP cache disabled, could not use {directory}: {e}")
+            _http_cache = False
+
+    return _http_cache or None
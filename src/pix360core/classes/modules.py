@@ -1,5 +1,7 @@
 from ..models import File, Conversion
 
+from typing import Any, List
+
 class BaseModule:
     """Base class for any type of modules supported by PIX360
     """
@@ -23,6 +25,13 @@ class DownloaderModule(BaseModule):
     name: str # Human-friendly name of the module
     identifier: str # Unique identifier for the module
 
+    # URLs handled by the module, indexed by the Loader so that test_url()
+    # is only called for URLs matching them. Modules declaring neither are
+    # tested against every URL.
+
+    hostnames: List[str] = [] # Hostnames like "tours.example.com", or "*.example.com" for all subdomains
+    url_prefixes: List[str] = [] # URL prefixes like "https://example.com/tours/"
+
     @classmethod
     def test_url(cls, url: str) -> int:
         """Test if URL is plausible for this module
@@ -31,17 +40,23 @@ class DownloaderModule(BaseModule):
         it is not intended to check whether the URL is valid and working, or
         whether it actually contains downloadable content.
 
+        Modules declaring hostnames or url_prefixes do not need to implement
+        this, URLs matching those are then considered probable.
+
         Args:
             url (str): URL to check for plausibility
 
         Raises:
-            NotImplementedError: If the method is not implemented in a module
+            NotImplementedError: If the method is not implemented in a module without hostnames or url_prefixes
 
         Returns:
             int: Certainty level of the URL being supported by this module
                  See CERTAINTY_* constants for default values
 
         """
+        if cls.hostnames or cls.url_prefixes:
+            return cls.CERTAINTY_PROBABLE
+
         raise NotImplementedError(f"Downloader Module {cls.__name__} does not implement test_url(url)!")
 
     def process_conversion(self, conversion: Conversion) -> File:
@@ -57,4 +72,50 @@ class DownloaderModule(BaseModule):
         Returns:
             File: Image or Video object containing the downloaded file
         """
-        raise NotImplementedError(f"Downloader Module {self.__class__.__name__} does not implement process_url(url)!")
\ No newline at end of file
+        raise NotImplementedError(f"Downloader Module {self.__class__.__name__} does not implement process_url(url)!")
+
+    @property
+    def supports_pipeline(self) -> bool:
+        """Whether the module splits conversions into separate download and stitch stages
+
+        Returns:
+            bool: True if the module implements download_conversion() and stitch_conversion()
+        """
+        return type(self).download_conversion is not DownloaderModule.download_conversion
+
+    def download_conversion(self, conversion: Conversion) -> Any:
+        """Download the content for a conversion, without stitching it
+
+        Modules implementing this and stitch_conversion() can have the two
+        stages run by separate pools of workers. The return value is stored
+        with the conversion and passed to stitch_conversion(), possibly in
+        another process, so it must be JSON serializable, for example the
+        IDs of the downloaded File objects.
+
+        Args:
+            conversion (Conversion): Conversion object to process
+
+        Raises:
+            DownloadError: If an error occurred while downloading content
+            NotImplementedError: If the module does not support separate stages
+
+        Returns:
+            Any: JSON serializable data for stitch_conversion()
+        """
+        raise NotImplementedError(f"Downloader Module {self.__class__.__name__} does not implement download_conversion(conversion)!")
+
+    def stitch_conversion(self, conversion: Conversion, data: Any) -> File:
+        """Create the result of a conversion from the content downloaded by download_conversion()
+
+        Args:
+            conversion (Conversion): Conversion object to process
+            data (Any): Return value of download_conversion()
+
+        Raises:
+            StitchingError: If an error occurred while stitching
+            NotImplementedError: If the module does not support separate stages
+
+        Returns:
+            File: Image or Video object containing the result
+        """
+        raise NotImplementedError(f"Downloader Module {self.__class__.__name__} does not implement stitch_conversion(conversion, data)!")
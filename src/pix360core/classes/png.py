@@ -0,0 +1,154 @@
+from typing import BinaryIO
+
+import numpy
+
+import struct
+import zlib
+
+class PNGWriter:
+    """Streaming encoder for 8 bit RGB PNG images
+
+    Rows are filtered, compressed and written to the output as they are
+    passed in, so an image never has to be held in memory as a whole.
+    Every row uses the Paeth filter, which works well for photographic
+    content and can be computed for many rows at once.
+    """
+
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+    CHANNELS = 3
+
+    def __init__(self, fileobj: BinaryIO, width: int, height: int, compress_level: int = 6, chunk_size: int = 1024 * 1024, band: int = 64):
+        """Initialize the PNGWriter and write the PNG header
+
+        Args:
+            fileobj (BinaryIO): File object to write the PNG to
+            width (int): Width of the image
+            height (int): Height of the image
+            compress_level (int, optional): zlib compression level. Defaults to 6, like PIL.
+            chunk_size (int, optional): Approximate size of the IDAT chunks to write. Defaults to 1 MiB.
+            band (int, optional): Number of rows to filter at once. Defaults to 64.
+        """
+        self.fileobj = fileobj
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        self.band = band
+
+        self.compressor = zlib.compressobj(compress_level)
+        self.buffer = []
+        self.buffered = 0
+        self.rows = 0
+        self.previous = numpy.zeros((1, width * self.CHANNELS), dtype=numpy.int16)
+
+        self.fileobj.write(self.SIGNATURE)
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, kind: bytes, data: bytes):
+        """Write a PNG chunk to the output
+
+        Args:
+            kind (bytes): Chunk type
+            data (bytes): Chunk data
+        """
+        self.fileobj.write(struct.pack(">I", len(data)))
+        self.fileobj.write(kind)
+        self.fileobj.write(data)
+        self.fileobj.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def compress(self, data: bytes):
+        """Compress data and write it out once enough has been buffered
+
+        Args:
+            data (bytes): Filtered scanlines
+        """
+        compressed = self.compressor.compress(data)
+
+        if compressed:
+            self.buffer.append(compressed)
+            self.buffered += len(compressed)
+
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered compressed data as an IDAT chunk
+        """
+        if self.buffered:
+            self.write_chunk(b"IDAT", b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def filter(self, rows: numpy.ndarray) -> numpy.ndarray:
+        """Apply the Paeth filter to a band of rows
+
+        Args:
+            rows (numpy.ndarray): Rows as an array of shape (n, width * 3)
+
+        Returns:
+            numpy.ndarray: Filtered rows, each prefixed with its filter type byte
+        """
+        raw = rows.astype(numpy.int16)
+
+        above = numpy.concatenate((self.previous, raw[:-1]))
+        left = numpy.zeros_like(raw)
+        left[:, self.CHANNELS:] = raw[:, :-self.CHANNELS]
+        corner = numpy.zeros_like(raw)
+        corner[:, self.CHANNELS:] = above[:, :-self.CHANNELS]
+
+        pa = numpy.abs(above - corner)
+        pb = numpy.abs(left - corner)
+        pc = numpy.abs(left + above - 2 * corner)
+
+        predictor = numpy.where((pa <= pb) & (pa <= pc), left, numpy.where(pb <= pc, above, corner))
+
+        self.previous = raw[-1:]
+
+        filtered = numpy.empty((rows.shape[0], rows.shape[1] + 1), dtype=numpy.uint8)
+        filtered[:, 0] = 4
+        filtered[:, 1:] = (raw - predictor) & 0xFF
+
+        return filtered
+
+    def write(self, rows: numpy.ndarray):
+        """Encode a band of rows
+
+        Args:
+            rows (numpy.ndarray): uint8 array of shape (n, width, 3)
+
+        Raises:
+            ValueError: If the rows do not match the image dimensions
+        """
+        if rows.ndim != 3 or rows.shape[1:] != (self.width, self.CHANNELS):
+            raise ValueError(f"Expected rows of shape (n, {self.width}, {self.CHANNELS}), got {rows.shape}")
+
+        if self.rows + rows.shape[0] > self.height:
+            raise ValueError("More rows written than the image height!")
+
+        rows = rows.reshape(rows.shape[0], -1)
+
+        for start in range(0, rows.shape[0], self.band):
+            self.compress(self.filter(rows[start:start + self.band]).tobytes())
+
+        self.rows += rows.shape[0]
+
+    def close(self):
+        """Finish the image and write the PNG trailer
+
+        Raises:
+            ValueError: If fewer rows than the image height were written
+        """
+        if self.rows != self.height:
+            raise ValueError(f"Expected {self.height} rows, got {self.rows}")
+
+        self.buffer.append(self.compressor.flush())
+        self.buffered += len(self.buffer[-1])
+        self.flush()
+
+        self.write_chunk(b"IEND", b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
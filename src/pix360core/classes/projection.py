@@ -0,0 +1,572 @@
+from django.conf import settings
+
+from typing import Optional, Tuple
+from collections import OrderedDict
+from pathlib import Path
+
+from ..paths import user_cache_path
+
+import numpy
+
+import hashlib
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+
+# Bump this whenever the projection math changes, to invalidate maps on disk
+PROJECTION_VERSION = 1
+
+INTERPOLATION_NEAREST = "nearest"
+INTERPOLATION_BILINEAR = "bilinear"
+INTERPOLATION_BICUBIC = "bicubic"
+
+INTERPOLATION_MODES = (INTERPOLATION_NEAREST, INTERPOLATION_BILINEAR, INTERPOLATION_BICUBIC)
+
+# Border added around each face for interpolated sampling, enough for the 4x4 bicubic kernel
+FACE_PADDING = 2
+
+def rotation_matrix(rotation: Tuple[int, int, int]) -> numpy.ndarray:
+    """Build the rotation matrix for a cubemap rotation
+
+    Args:
+        rotation (Tuple[int, int, int]): Rotation on x, y and z axes in degrees
+
+    Returns:
+        numpy.ndarray: 3x3 rotation matrix, applying the x, y and z rotations in that order
+    """
+    x, y, z = (math.radians(r) for r in rotation)
+
+    rx = numpy.array([[1, 0, 0], [0, math.cos(x), -math.sin(x)], [0, math.sin(x), math.cos(x)]])
+    ry = numpy.array([[math.cos(y), 0, math.sin(y)], [0, 1, 0], [-math.sin(y), 0, math.cos(y)]])
+    rz = numpy.array([[math.cos(z), -math.sin(z), 0], [math.sin(z), math.cos(z), 0], [0, 0, 1]])
+
+    return rz @ ry @ rx
+
+def face_directions(face: int, u: numpy.ndarray, v: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Compute the viewing directions of points on a cubemap face
+
+    The x axis points right, the y axis up and the z axis forward. Faces are
+    indexed in BaseStitcher.CUBEMAP_ORDER.
+
+    Args:
+        face (int): Index of the face
+        u (numpy.ndarray): Horizontal position on the face, -1 (left edge) to 1 (right edge)
+        v (numpy.ndarray): Vertical position on the face, -1 (top edge) to 1 (bottom edge)
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: x, y and z components of the (unnormalized) directions
+    """
+    one = numpy.ones_like(u)
+
+    return [
+        (-u, -v, -one),  # back
+        (one, -v, -u),   # right
+        (u, -v, one),    # front
+        (-one, -v, u),   # left
+        (u, one, v),     # up
+        (u, -one, -v),   # down
+    ][face]
+
+def direction_faces(x: numpy.ndarray, y: numpy.ndarray, z: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Find the cubemap face and position on it for viewing directions
+
+    This is the inverse of face_directions().
+
+    Args:
+        x (numpy.ndarray): x components of the directions
+        y (numpy.ndarray): y components of the directions
+        z (numpy.ndarray): z components of the directions
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: Face index, u and v of each direction
+    """
+    ax, ay, az = numpy.abs(x), numpy.abs(y), numpy.abs(z)
+
+    x_major = (ax >= ay) & (ax >= az)
+    y_major = ~x_major & (ay >= az)
+    z_major = ~x_major & ~y_major
+
+    face = numpy.where(z_major, numpy.where(z > 0, 2, 0), numpy.where(x_major, numpy.where(x > 0, 1, 3), numpy.where(y > 0, 4, 5)))
+
+    major = numpy.where(x_major, ax, numpy.where(y_major, ay, az))
+    u = numpy.where(x_major, -numpy.sign(x) * z, numpy.where(y_major, x, numpy.sign(z) * x)) / major
+    v = numpy.where(y_major, numpy.sign(y) * z, -y) / major
+
+    return face, u, v
+
+def face_pixels(u: numpy.ndarray, dim: int) -> numpy.ndarray:
+    """Convert positions on a face to the indices of the pixels containing them
+
+    Args:
+        u (numpy.ndarray): Positions on the face, -1 to 1
+        dim (int): Edge length of the face in pixels
+
+    Returns:
+        numpy.ndarray: Pixel indices, 0 to dim - 1
+    """
+    return numpy.clip(((u + 1) / 2 * dim).astype(numpy.int32), 0, dim - 1)
+
+def cubemap_projection(dim: int, width: int, height: int, rotation: Tuple[int, int, int] = (0, 0, 0), interpolation: str = INTERPOLATION_NEAREST, band: int = 256) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Compute the cubemap face and source pixel for every pixel of an equirectangular image
+
+    The center of the equirectangular image looks at the front face. The
+    projection is computed in bands of rows to keep the temporary arrays
+    small.
+
+    For nearest neighbour sampling, rows and columns are pixel indices on the
+    face. Otherwise they are continuous coordinates with pixel centers at
+    integer values, which may lie up to half a pixel outside the face.
+
+    Args:
+        dim (int): Edge length of the (square) cubemap faces in pixels
+        width (int): Width of the equirectangular image
+        height (int): Height of the equirectangular image
+        rotation (Tuple[int, int, int], optional): Rotation of the cubemap on x, y and z axes in degrees. Defaults to (0, 0, 0).
+        interpolation (str, optional): Interpolation mode the projection is used with. Defaults to "nearest".
+        band (int, optional): Number of rows to compute at once. Defaults to 256.
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: Face index, source row and source column, each of shape (height, width)
+    """
+    if interpolation == INTERPOLATION_NEAREST:
+        coordinate_type = numpy.uint16 if dim <= 65536 else numpy.int32
+    else:
+        coordinate_type = numpy.float32
+
+    face = numpy.empty((height, width), dtype=numpy.uint8)
+    rows = numpy.empty((height, width), dtype=coordinate_type)
+    cols = numpy.empty((height, width), dtype=coordinate_type)
+
+    matrix = rotation_matrix(rotation).astype(numpy.float32)
+
+    lon = ((numpy.arange(width, dtype=numpy.float32) + 0.5) / width * 2 - 1) * numpy.float32(math.pi)
+    lat = (0.5 - (numpy.arange(height, dtype=numpy.float32) + 0.5) / height) * numpy.float32(math.pi)
+
+    sin_lon, cos_lon = numpy.sin(lon)[numpy.newaxis, :], numpy.cos(lon)[numpy.newaxis, :]
+
+    for start in range(0, height, band):
+        stop = min(start + band, height)
+        sin_lat, cos_lat = numpy.sin(lat[start:stop])[:, numpy.newaxis], numpy.cos(lat[start:stop])[:, numpy.newaxis]
+
+        x = cos_lat * sin_lon
+        y = numpy.broadcast_to(sin_lat, x.shape)
+        z = cos_lat * cos_lon
+
+        x, y, z = (matrix[i, 0] * x + matrix[i, 1] * y + matrix[i, 2] * z for i in range(3))
+        f, u, v = direction_faces(x, y, z)
+
+        face[start:stop] = f
+
+        if interpolation == INTERPOLATION_NEAREST:
+            cols[start:stop] = face_pixels(u, dim)
+            rows[start:stop] = face_pixels(v, dim)
+        else:
+            cols[start:stop] = (u + 1) / 2 * dim - 0.5
+            rows[start:stop] = (v + 1) / 2 * dim - 0.5
+
+    return face, rows, cols
+
+def pad_cubemap(cube: numpy.ndarray, pad: int = FACE_PADDING) -> numpy.ndarray:
+    """Add a border taken from the neighbouring faces around each cubemap face
+
+    Interpolating near the edge of a face needs pixels beyond it. These are
+    found by extending the face plane and projecting the border pixels onto
+    the faces they actually belong to, so sampling is continuous across seams.
+
+    Args:
+        cube (numpy.ndarray): Array of shape (6, dim, dim, channels) holding the faces
+        pad (int, optional): Width of the border in pixels. Defaults to FACE_PADDING.
+
+    Returns:
+        numpy.ndarray: Array of shape (6, dim + 2 * pad, dim + 2 * pad, channels)
+    """
+    dim = cube.shape[1]
+
+    coordinates = (numpy.arange(-pad, dim + pad, dtype=numpy.float32) + 0.5) / dim * 2 - 1
+    u, v = numpy.meshgrid(coordinates, coordinates)
+
+    padded = numpy.empty((6, dim + 2 * pad, dim + 2 * pad) + cube.shape[3:], dtype=cube.dtype)
+
+    for index in range(6):
+        face, su, sv = direction_faces(*face_directions(index, u, v))
+        padded[index] = cube[face, face_pixels(sv, dim), face_pixels(su, dim)]
+        padded[index, pad:pad + dim, pad:pad + dim] = cube[index]
+
+    return padded
+
+def cubic_weights(t: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Compute the weights of the bicubic (Keys, a = -0.5) kernel
+
+    Args:
+        t (numpy.ndarray): Fractional offset of the sample from the second of the four taps
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]: Weights of the four taps
+    """
+    def kernel(d):
+        return numpy.where(d <= 1, (1.5 * d - 2.5) * d * d + 1, ((-0.5 * d + 2.5) * d - 4) * d + 2)
+
+    return kernel(t + 1), kernel(t), kernel(1 - t), kernel(2 - t)
+
+def sample_cubemap(padded: numpy.ndarray, face: numpy.ndarray, rows: numpy.ndarray, cols: numpy.ndarray, interpolation: str, pad: int = FACE_PADDING) -> numpy.ndarray:
+    """Sample a padded cubemap at continuous coordinates
+
+    Args:
+        padded (numpy.ndarray): Cubemap as returned by pad_cubemap()
+        face (numpy.ndarray): Face index of each sample
+        rows (numpy.ndarray): Continuous row of each sample on the unpadded face
+        cols (numpy.ndarray): Continuous column of each sample on the unpadded face
+        interpolation (str): "bilinear" or "bicubic"
+        pad (int, optional): Width of the border of the padded cubemap. Defaults to FACE_PADDING.
+
+    Returns:
+        numpy.ndarray: Sampled values, in the dtype of the cubemap
+    """
+    y = rows + numpy.float32(pad)
+    x = cols + numpy.float32(pad)
+
+    y0 = numpy.floor(y).astype(numpy.int32)
+    x0 = numpy.floor(x).astype(numpy.int32)
+
+    fy = (y - y0)[..., numpy.newaxis].astype(numpy.float32)
+    fx = (x - x0)[..., numpy.newaxis].astype(numpy.float32)
+
+    if interpolation == INTERPOLATION_BILINEAR:
+        taps, wy, wx = (0, 1), (1 - fy, fy), (1 - fx, fx)
+    else:
+        taps, wy, wx = (-1, 0, 1, 2), cubic_weights(fy), cubic_weights(fx)
+
+    # Gather through flat indices, which is much faster than indexing three axes
+    stride = padded.shape[1]
+    flat = padded.reshape((-1,) + padded.shape[3:])
+    base = (face.astype(numpy.int64) * stride + y0) * stride + x0
+
+    result = numpy.zeros(face.shape + padded.shape[3:], dtype=numpy.float32)
+
+    for dy, weight_y in zip(taps, wy):
+        line = numpy.zeros_like(result)
+
+        for dx, weight_x in zip(taps, wx):
+            line += numpy.take(flat, base + (dy * stride + dx), axis=0) * weight_x
+
+        result += line * weight_y
+
+    if numpy.issubdtype(padded.dtype, numpy.integer):
+        limits = numpy.iinfo(padded.dtype)
+        result = numpy.clip(numpy.rint(result), limits.min, limits.max)
+
+    return result.astype(padded.dtype)
+
+class ProjectionMap:
+    """Precomputed cubemap to equirectangular lookup table
+
+    Attributes:
+        key (tuple): Key identifying the map, see ProjectionCache.key()
+        interpolation (str): Interpolation mode the map was computed for
+        face (numpy.ndarray): Cubemap face index for every output pixel
+        rows (numpy.ndarray): Source row on the face for every output pixel
+        cols (numpy.ndarray): Source column on the face for every output pixel
+    """
+
+    ARRAYS = ("face", "rows", "cols")
+
+    def __init__(self, key: tuple, face: numpy.ndarray, rows: numpy.ndarray, cols: numpy.ndarray):
+        self.key = key
+        self.interpolation = key[4]
+        self.face = face
+        self.rows = rows
+        self.cols = cols
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the map's arrays in bytes
+        """
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def gather(self, cube: numpy.ndarray, band: int = 256) -> numpy.ndarray:
+        """Sample an equirectangular image from a stack of cubemap faces
+
+        Interpolated sampling is done in bands of rows to keep the
+        intermediate floating point arrays small.
+
+        Args:
+            cube (numpy.ndarray): Array of shape (6, dim, dim, channels) holding the faces in BaseStitcher.CUBEMAP_ORDER
+            band (int, optional): Number of rows to interpolate at once. Defaults to 256.
+
+        Returns:
+            numpy.ndarray: Array of shape (height, width, channels)
+        """
+        if self.interpolation == INTERPOLATION_NEAREST:
+            return cube[self.face, self.rows, self.cols]
+
+        padded = pad_cubemap(cube)
+        output = numpy.empty(self.face.shape + cube.shape[3:], dtype=cube.dtype)
+
+        for start in range(0, self.face.shape[0], band):
+            stop = start + band
+            output[start:stop] = sample_cubemap(padded, self.face[start:stop], self.rows[start:stop], self.cols[start:stop], self.interpolation)
+
+        return output
+
+    def save(self, path: Path):
+        """Write the map to a directory of .npy files
+
+        The files are written to a temporary directory first, which is then
+        renamed into place, so concurrent readers never see partial maps.
+
+        Args:
+            path (Path): Directory to write the map to
+
+        Raises:
+            OSError: If the map could not be written
+        """
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tempdir = Path(tempfile.mkdtemp(dir=path.parent, prefix=".tmp-"))
+
+        try:
+            for name in self.ARRAYS:
+                numpy.save(tempdir / f"{name}.npy", getattr(self, name))
+            os.rename(tempdir, path)
+        except OSError:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+            # Another process may have won the race
+            if not path.is_dir():
+                raise
+
+    @classmethod
+    def load(cls, key: tuple, path: Path) -> "ProjectionMap":
+        """Load a map from a directory of .npy files as memory-mapped arrays
+
+        Args:
+            key (tuple): Key of the map
+            path (Path): Directory the map was saved to
+
+        Returns:
+            ProjectionMap: The loaded map
+
+        Raises:
+            OSError: If the map could not be read
+            ValueError: If the map files are corrupt
+        """
+        return cls(key, *[numpy.load(path / f"{name}.npy", mmap_mode="r") for name in cls.ARRAYS])
+
+class ProjectionCache:
+    """Cache for cubemap to equirectangular lookup tables
+
+    Maps are kept in an in-memory LRU bounded by their total size in bytes,
+    and persisted to disk as memory-mapped .npy files so they can be shared
+    between worker processes and survive restarts. The persisted maps have
+    a byte budget of their own, with the least recently used maps evicted
+    first. Access times are tracked through the modification times of the
+    map directories. Failing to persist a map is logged, and the map is
+    still used from memory.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, directory: Optional[str] = None, max_disk_bytes: int = 2 * 1024 * 1024 * 1024):
+        """Initialize the ProjectionCache
+
+        Args:
+            max_bytes (int, optional): Byte budget of the in-memory LRU. Defaults to 512 MiB.
+            directory (Optional[str], optional): Directory to persist maps to. Defaults to None, which disables persistence.
+            max_disk_bytes (int, optional): Byte budget of the persisted maps. Defaults to 2 GiB.
+        """
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = Path(directory) if directory else None
+        self.maps = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("pix360")
+
+    @staticmethod
+    def key(dim: int, width: int, height: int, rotation: Tuple[int, int, int] = (0, 0, 0), interpolation: str = INTERPOLATION_NEAREST) -> tuple:
+        """Build the cache key for a projection
+
+        Args:
+            dim (int): Edge length of the cubemap faces
+            width (int): Width of the equirectangular image
+            height (int): Height of the equirectangular image
+            rotation (Tuple[int, int, int], optional): Rotation of the cubemap in degrees. Defaults to (0, 0, 0).
+            interpolation (str, optional): Interpolation mode. Defaults to "nearest".
+
+        Returns:
+            tuple: Cache key
+        """
+        return (int(dim), int(width), int(height), tuple(float(r) for r in rotation), interpolation)
+
+    def path(self, key: tuple) -> Optional[Path]:
+        """Get the directory a map is persisted to
+
+        Args:
+            key (tuple): Key of the map
+
+        Returns:
+            Optional[Path]: Directory of the map, or None if persistence is disabled
+        """
+        if not self.directory:
+            return None
+
+        digest = hashlib.sha256(repr((PROJECTION_VERSION, key)).encode()).hexdigest()
+        return self.directory / digest
+
+    def get(self, dim: int, width: int, height: int, rotation: Tuple[int, int, int] = (0, 0, 0), interpolation: str = INTERPOLATION_NEAREST) -> ProjectionMap:
+        """Get a projection map, computing it if it is not cached yet
+
+        Args:
+            dim (int): Edge length of the cubemap faces
+            width (int): Width of the equirectangular image
+            height (int): Height of the equirectangular image
+            rotation (Tuple[int, int, int], optional): Rotation of the cubemap in degrees. Defaults to (0, 0, 0).
+            interpolation (str, optional): Interpolation mode. Defaults to "nearest".
+
+        Raises:
+            ValueError: If the interpolation mode is not supported
+
+        Returns:
+            ProjectionMap: The projection map
+        """
+        if interpolation not in INTERPOLATION_MODES:
+            raise ValueError(f"Unsupported interpolation mode: {interpolation}")
+
+        key = self.key(dim, width, height, rotation, interpolation)
+
+        with self.lock:
+            if key in self.maps:
+                self.maps.move_to_end(key)
+                return self.maps[key]
+
+        projection = self.load(key)
+
+        if projection is None:
+            self.logger.debug(f"Computing projection map {key}")
+            projection = ProjectionMap(key, *cubemap_projection(dim, width, height, rotation, interpolation))
+
+            path = self.path(key)
+            if path:
+                try:
+                    projection.save(path)
+                except OSError as e:
+                    self.logger.warning(f"Could not persist projection map {path}: {e}")
+                else:
+                    projection = self.load(key) or projection
+                    self.evict()
+
+        self.store(projection)
+        return projection
+
+    def load(self, key: tuple) -> Optional[ProjectionMap]:
+        """Load a map persisted to disk
+
+        Args:
+            key (tuple): Key of the map
+
+        Returns:
+            Optional[ProjectionMap]: The map, or None if it is not on disk
+        """
+        path = self.path(key)
+
+        if not path or not path.is_dir():
+            return None
+
+        try:
+            projection = ProjectionMap.load(key, path)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Discarding unreadable projection map {path}: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return projection
+
+    def evict(self):
+        """Evict the least recently used persisted maps until they are within the disk budget
+
+        Maps that are evicted while memory-mapped stay readable by the
+        processes using them.
+        """
+        entries = []
+
+        try:
+            paths = [path for path in self.directory.iterdir() if not path.name.startswith(".")]
+        except OSError as e:
+            self.logger.warning(f"Could not list projection maps in {self.directory}: {e}")
+            return
+
+        for path in paths:
+            try:
+                mtime = path.stat().st_mtime
+                size = sum(file.stat().st_size for file in path.iterdir())
+            except OSError:
+                continue
+
+            entries.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            evicted += 1
+
+        if evicted:
+            self.logger.debug(f"Evicted {evicted} projection maps from {self.directory}")
+
+    def store(self, projection: ProjectionMap):
+        """Add a map to the in-memory LRU, evicting the least recently used maps over budget
+
+        Args:
+            projection (ProjectionMap): Map to add
+        """
+        with self.lock:
+            if projection.key in self.maps:
+                return
+
+            self.maps[projection.key] = projection
+            self.size += projection.nbytes
+
+            while self.size > self.max_bytes and len(self.maps) > 1:
+                _, evicted = self.maps.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def clear(self):
+        """Drop all maps from the in-memory LRU
+        """
+        with self.lock:
+            self.maps.clear()
+            self.size = 0
+
+_projection_cache = None
+
+def get_projection_cache() -> ProjectionCache:
+    """Get the process-wide projection cache, configured from the Django settings
+
+    Settings:
+        PIX360_PROJECTION_CACHE_SIZE: Byte budget of the in-memory LRU (default: 512 MiB)
+        PIX360_PROJECTION_CACHE_DIR: Directory to persist maps to, None to disable (default: pix360/projections in the cache directory of the user)
+        PIX360_PROJECTION_CACHE_DISK_SIZE: Byte budget of the persisted maps (default: 2 GiB)
+
+    Returns:
+        ProjectionCache: The projection cache
+    """
+    global _projection_cache
+
+    if _projection_cache is None:
+        _projection_cache = ProjectionCache(
+            max_bytes=getattr(settings, "PIX360_PROJECTION_CACHE_SIZE", 512 * 1024 * 1024),
+            directory=getattr(settings, "PIX360_PROJECTION_CACHE_DIR", user_cache_path("projections")),
+            max_disk_bytes=getattr(settings, "PIX360_PROJECTION_CACHE_DISK_SIZE", 2 * 1024 * 1024 * 1024),
+        )
+
+    return _projection_cache
@@ -1,18 +1,24 @@
 from ..models import File
+from ..models.content import checkpoint_key
 from ..classes import StitchingError
+from .projection import get_projection_cache, INTERPOLATION_NEAREST
+from .png import PNGWriter
+from .storage import link_or_copy, image_size, temporary_directory, create_file
+from ..processes import run_command, get_stitcher_pool
+from ..progress import report_progress, PHASE_STITCH, PHASE_ENCODE
 
-from django.core.files.base import ContentFile
+from django.conf import settings
 
 from typing import List, Optional, Tuple
 from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, wait
 
 import PIL.Image
+import numpy
 
-import tempfile
+import os
 import subprocess
-import io
 import logging
-import time
 import math
 
 class BaseStitcher:
@@ -24,12 +30,14 @@ class BaseStitcher:
     def __init__(self, *args, **kwargs):
         self.logger = logging.getLogger("pix360")
 
-    def cubemap_to_equirectangular(self, files: List[File], rotation: Tuple[int, int, int] = (0, 0, 0)) -> File:
+    def cubemap_to_equirectangular(self, files: List[File], rotation: Tuple[int, int, int] = (0, 0, 0), interpolation: str = INTERPOLATION_NEAREST, size: Optional[Tuple[int, int]] = None) -> File:
         """Stitch a cubemap into an equirectangular image
 
         Args:
             files (List[File]): List of 6 files representing the 6 faces of the cubemap [back, right, front, left, up, down].
             rotation (Tuple[int, int, int], optional): Rotation of the cubemap on x, y and z axes in degrees. Defaults to (0, 0, 0).
+            interpolation (str, optional): Interpolation mode, one of "nearest", "bilinear" or "bicubic". Defaults to "nearest".
+            size (Optional[Tuple[int, int]], optional): Width and height of the equirectangular image. Defaults to None, which renders at four times by two times the face size.
 
         Raises:
             NotImplementedError: If the method is not implemented in a module
@@ -40,7 +48,7 @@ class BaseStitcher:
         """
         raise NotImplementedError
 
-    def stitch(self, files: List[List[File]]) -> File:
+    def stitch(self, files: List[List[File]], progress: bool = True) -> File:
         """Stitch a list of images together
 
         The input is a list of lists of images.
@@ -49,6 +57,7 @@ class BaseStitcher:
 
         Args:
             files (List[List[File]]): List of lists of files to stitch together
+            progress (bool, optional): Whether to report the progress of the conversion, see report_progress(). Defaults to True.
 
         Raises:
             NotImplementedError: If the method is not implemented in a module
@@ -59,7 +68,26 @@ class BaseStitcher:
         """
         raise NotImplementedError
 
-    def multistitch(self, tiles: List[List[List[File]]]) -> List[File]:
+    def estimate_memory(self, files: List[List[File]]) -> int:
+        """Estimate the memory needed to stitch a list of lists of images
+
+        Only the header of the first image is read. The default estimate is
+        the size of the uncompressed RGB output image.
+
+        Args:
+            files (List[List[File]]): List of lists of files to stitch together
+
+        Returns:
+            int: Estimated peak memory usage in bytes
+        """
+        if not files or not files[0]:
+            return 0
+
+        width, height = image_size(files[0][0])
+
+        return width * len(files[0]) * height * len(files) * 3
+
+    def multistitch(self, tiles: List[List[List[File]]], processes: Optional[int] = None, memory_limit: Optional[int] = None) -> List[File]:
         """Stitch a list of lists of images together
 
         The input is a list of lists of lists of images.
@@ -67,40 +95,106 @@ class BaseStitcher:
         The resulting lines are then stitched together vertically.
         This is repeated for each list of lists of images.
 
+        The lists of lists are stitched in parallel in the warm processes of
+        the stitcher pool (see StitcherPool).
+        A new stitch is only started while the estimated memory usage of the
+        running ones (see estimate_memory()) stays within the memory limit,
+        but at least one stitch always runs.
+
+        Each stitched image is recorded as a checkpoint of the conversion, so
+        when a failed conversion is retried or reclaimed, images stitched
+        before from the same files are reused. The number of stitched images
+        is reported as the progress of the conversion.
+
         Args:
             tiles (List[List[List[File]]]): List of lists of lists of files to stitch together
+            processes (Optional[int], optional): Maximum number of concurrent stitches. Defaults to the PIX360_STITCH_PROCESSES setting, or the number of CPUs.
+            memory_limit (Optional[int], optional): Memory budget for concurrent stitches in bytes. Defaults to the PIX360_STITCH_MEMORY_LIMIT setting, or 2 GiB.
 
         Raises:
             NotImplementedError: If the method is not implemented in a module
             StitchingError: If the stitching failed
 
         Returns:
-            List[File]: List of File objects containing the stitched images
+            List[File]: List of File objects containing the stitched images, in input order
         """
-        result = []
+        processes = processes or getattr(settings, "PIX360_STITCH_PROCESSES", None) or os.cpu_count() or 1
+        memory_limit = memory_limit or getattr(settings, "PIX360_STITCH_MEMORY_LIMIT", 2 * 1024 * 1024 * 1024)
+
+        conversion = tiles[0][0][0].conversion if tiles and tiles[0] and tiles[0][0] else None
+        keys = [checkpoint_key(*(file.id for line in tile for file in line)) for tile in tiles]
+        checkpoints = conversion.get_checkpoints(File.STAGE_STITCHED) if conversion else {}
+
+        results = [checkpoints.get(key) for key in keys]
+        queue = [index for index, result in enumerate(results) if result is None]
+
+        if len(queue) < len(tiles):
+            self.logger.debug(f"Resuming with {len(tiles) - len(queue)} stitched images, {len(queue)} remaining")
+
+        def finish(index: int, result: File):
+            results[index] = conversion.add_checkpoint(result, File.STAGE_STITCHED, keys[index]) if conversion else result
+
+            if conversion:
+                report_progress(conversion, PHASE_STITCH, sum(result is not None for result in results), len(results))
+
+        if processes <= 1 or len(queue) <= 1:
+            for index in queue:
+                finish(index, self.stitch(tiles[index], progress=False))
 
-        for tile in tiles:
-            result.append(self.stitch(tile))
+            return results
 
-        return result
+        estimates = {index: self.estimate_memory(tiles[index]) for index in queue}
+        pool = get_stitcher_pool()
+        running = {}
+        memory = 0
+
+        try:
+            while queue or running:
+                while queue and len(running) < processes and (not running or memory + estimates[queue[0]] <= memory_limit):
+                    index = queue.pop(0)
+                    running[pool.submit(_stitch, self, tiles[index])] = index
+                    memory += estimates[index]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    index = running.pop(future)
+                    memory -= estimates[index]
+                    finish(index, future.result())
+
+        finally:
+            for future in running:
+                future.cancel()
+
+        return results
+
+def _stitch(stitcher: BaseStitcher, files: List[List[File]]) -> File:
+    """Run a stitch in a pool process, see BaseStitcher.multistitch()
+    """
+    return stitcher.stitch(files, progress=False)
 
 class BlenderStitcher(BaseStitcher):
     """Stitcher module using Blender to stitch images
     """
-    def __init__(self, cube2sphere_path: Optional[str] = None):
+    def __init__(self, cube2sphere_path: Optional[str] = None, timeout: Optional[float] = None):
         """Initialize the BlenderStitcher
 
         Args:
             cube2sphere_path (Optional[str], optional): Path to the cube2sphere binary. Defaults to None, which will try to find the binary in the PATH.
+            timeout (Optional[float], optional): Maximum run time of cube2sphere in seconds, after which it is killed. Defaults to the PIX360_CUBE2SPHERE_TIMEOUT setting, or 30 minutes.
         """
         super().__init__()
         self.cube2sphere_path = cube2sphere_path or "cube2sphere"
+        self.timeout = timeout or getattr(settings, "PIX360_CUBE2SPHERE_TIMEOUT", 30 * 60)
 
-    def cubemap_to_equirectangular(self, files: List[File], rotation: Tuple[int, int, int] = (0, 0, 0)) -> File:
+    def cubemap_to_equirectangular(self, files: List[File], rotation: Tuple[int, int, int] = (0, 0, 0), interpolation: str = INTERPOLATION_NEAREST, size: Optional[Tuple[int, int]] = None) -> File:
         """Stitch a cubemap into an equirectangular image
 
         Args:
             files (List[File]): List of 6 files representing the 6 faces of the cubemap [back, right, front, left, up, down].
+            rotation (Tuple[int, int, int], optional): Rotation of the cubemap on x, y and z axes in degrees. Defaults to (0, 0, 0).
+            interpolation (str, optional): Not supported by this stitcher, Blender does its own sampling. Defaults to "nearest".
+            size (Optional[Tuple[int, int]], optional): Width and height of the equirectangular image. Defaults to None, which renders at four times by two times the face size.
 
         Raises:
             StitchingError: If the stitching failed
@@ -113,13 +207,15 @@ class BlenderStitcher(BaseStitcher):
         if len(files) != 6:
             raise ValueError("Exactly 6 files are required!")
 
-        with tempfile.TemporaryDirectory() as tempdir:
+        with temporary_directory() as tempdir:
             for i, file in enumerate(files):
-                with (Path(tempdir) / f"{self.CUBEMAP_ORDER[i]}.png").open("wb") as f:
-                    f.write(file.file.read())
+                link_or_copy(file, Path(tempdir) / f"{self.CUBEMAP_ORDER[i]}.png")
 
-            height = PIL.Image.open(files[0].file).height * 2
-            width = PIL.Image.open(files[0].file).width * 4
+            if size:
+                width, height = size
+            else:
+                width, height = image_size(files[0])
+                width, height = width * 4, height * 2
 
             command = [
                 self.cube2sphere_path,
@@ -135,25 +231,43 @@ class BlenderStitcher(BaseStitcher):
                 "-r", str(width), str(height),
                 ]
 
-            result = subprocess.run(command, cwd=tempdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if files[0].conversion_id:
+                report_progress(files[0].conversion_id, PHASE_STITCH, 0, 1)
+
+            try:
+                result = run_command(command, cwd=tempdir, timeout=self.timeout)
+            except subprocess.TimeoutExpired as e:
+                raise StitchingError(f"cube2sphere timed out after {self.timeout} seconds for conversion {files[0].conversion_id}") from e
+            except OSError as e:
+                raise StitchingError(f"Could not run cube2sphere: {e}") from e
 
             if result.returncode != 0:
                 self.logger.error(command)
                 self.logger.error(result.stderr.decode("utf-8"))
                 self.logger.error(result.stdout.decode("utf-8"))
-                self.logger.debug(tempdir)
-                time.sleep(600)
-                raise StitchingError(f"cube2sphere stitching failed for conversion {files[0].conversion.id}")
+                errors = result.stderr.decode("utf-8", "replace").strip().splitlines()[-5:]
+                raise StitchingError(f"cube2sphere stitching failed for conversion {files[0].conversion_id} with exit code {result.returncode}: " + "\n".join(errors))
 
-            with (Path(tempdir) / "out0001.png").open("rb") as f:
-                result = File.objects.create(conversion=files[0].conversion, file=ContentFile(f.read(), name="result.png"), mime_type="image/png")
-
-            return result
+            return create_file(Path(tempdir) / "out0001.png", "result.png", conversion=files[0].conversion, mime_type="image/png")
 
 class PILStitcher(BaseStitcher):
     """Stitcher module using PIL to stitch images
     """
-    def cubemap_to_equirectangular(self, files: List[File], rotation: Tuple[int, int, int] = (0, 0, 0)) -> File:
+    def estimate_memory(self, files: List[List[File]]) -> int:
+        """Estimate the memory needed to stitch a list of lists of images
+
+        The stitch is streamed, so this is a few times the size of one line
+        of tiles, see stitch().
+
+        Args:
+            files (List[List[File]]): List of lists of files to stitch together
+
+        Returns:
+            int: Estimated peak memory usage in bytes
+        """
+        return super().estimate_memory(files[:1]) * 3
+
+    def cubemap_to_equirectangular(self, files: List[File], rotation: Tuple[int, int, int] = (0, 0, 0), interpolation: str = INTERPOLATION_NEAREST, size: Optional[Tuple[int, int]] = None) -> File:
         '''Stitch a cubemap into an equirectangular image
 
         This method does not use Blender, but instead uses PIL to stitch the images together.
@@ -162,6 +276,8 @@ class PILStitcher(BaseStitcher):
         Args:
             files (List[File]): List of 6 files representing the 6 faces of the cubemap [back, right, front, left, up, down]
             rotation (Tuple[int, int, int], optional): Not supported by this stitcher. Defaults to (0, 0, 0).
+            interpolation (str, optional): Not supported by this stitcher, which always samples nearest neighbours. Defaults to "nearest".
+            size (Optional[Tuple[int, int]], optional): Not supported by this stitcher. Defaults to None.
 
         Raises:
             StitchingError: If the stitching failed
@@ -240,26 +356,30 @@ class PILStitcher(BaseStitcher):
 
                 raw.append(part.getpixel((currx, curry)))
 
-        bio = io.BytesIO()
-        PIL.Image.frombytes("RGB", (t_width, t_height), bytes(raw)).save(bio, "PNG")
-        bio.seek(0)
-
-        result = File.objects.create(conversion=files[0].conversion, file=ContentFile(bio, name="result.png", mime_type="image/png"))
+        with temporary_directory() as tempdir:
+            path = Path(tempdir) / "result.png"
+            PIL.Image.frombytes("RGB", (t_width, t_height), bytes(raw)).save(path, "PNG")
 
-        return result
+            return create_file(path, conversion=files[0].conversion, mime_type="image/png")
 
-    def stitch(self, files: List[List[File]]) -> File:
+    def stitch(self, files: List[List[File]], progress: bool = True) -> File:
         """Stitch a list of images together
 
         The input is a list of lists of images.
         Each list of images is stitched into one line horizontally.
         The resulting lines are then stitched together vertically.
 
+        The image is built and encoded one line of tiles at a time, and
+        streamed through a temporary file into storage, so memory usage is
+        proportional to one line rather than to the whole image.
+
         Args:
             files (List[List[File]]): List of lists of files to stitch together
+            progress (bool, optional): Whether to report the number of stitched lines as the progress of the conversion. Defaults to True.
 
         Raises:
             StitchingError: If the stitching failed
+            ValueError: If the lines or the files do not all have the same size
 
         Returns:
             File: File object containing the stitched image
@@ -270,33 +390,93 @@ class PILStitcher(BaseStitcher):
         if len(files[0]) == 0:
             raise StitchingError("No files to stitch!")
 
-        image_files = [[PIL.Image.open(f.file) for f in line] for line in files]
-
-        width = image_files[0][0].width
-        height = image_files[0][0].height
-
-        for line in image_files:
+        for line in files:
             if len(line) != len(files[0]):
                 raise ValueError("All lines must have the same length!")
 
-            for file in line:
-                if file.width != width or file.height != height:
-                    raise ValueError("All files must have the same dimensions!")
+        width, height = image_size(files[0][0])
+
+        with temporary_directory() as tempdir:
+            path = Path(tempdir) / "result.png"
+
+            with path.open("wb") as output, PNGWriter(output, width * len(files[0]), height * len(files)) as writer:
+                for y, line in enumerate(files):
+                    band = numpy.empty((height, width * len(line), 3), dtype=numpy.uint8)
+
+                    for x, file in enumerate(line):
+                        with file.file.open("rb") as handle:
+                            image = PIL.Image.open(handle)
+
+                            if image.width != width or image.height != height:
+                                raise ValueError("All files must have the same dimensions!")
+
+                            band[:, x * width:(x + 1) * width] = numpy.asarray(image.convert("RGB"))
+
+                    writer.write(band)
+
+                    if progress and files[0][0].conversion_id:
+                        report_progress(files[0][0].conversion_id, PHASE_STITCH, y + 1, len(files))
+
+            return create_file(path, conversion=files[0][0].conversion, mime_type="image/png")
+
+class NumpyStitcher(BaseStitcher):
+    """Stitcher module using NumPy to stitch images
+    """
+    def cubemap_to_equirectangular(self, files: List[File], rotation: Tuple[int, int, int] = (0, 0, 0), interpolation: str = INTERPOLATION_NEAREST, size: Optional[Tuple[int, int]] = None) -> File:
+        """Stitch a cubemap into an equirectangular image
+
+        The source pixel of every output pixel is looked up in a cached
+        projection map, and the output is gathered from the faces in a single
+        indexing operation. Interpolated modes sample across face seams from
+        the neighbouring faces, so the image can be rendered at its target
+        size directly.
+
+        Args:
+            files (List[File]): List of 6 files representing the 6 faces of the cubemap [back, right, front, left, up, down].
+            rotation (Tuple[int, int, int], optional): Rotation of the cubemap on x, y and z axes in degrees. Defaults to (0, 0, 0).
+            interpolation (str, optional): Interpolation mode, one of "nearest", "bilinear" or "bicubic". Defaults to "nearest".
+            size (Optional[Tuple[int, int]], optional): Width and height of the equirectangular image. Defaults to None, which renders at four times by two times the face size.
+
+        Raises:
+            StitchingError: If the stitching failed
+            ValueError: If the number of provided input files is not 6, or the interpolation mode is not supported
+
+        Returns:
+            File: File object containing the stitched image
+        """
+
+        if len(files) != 6:
+            raise ValueError("Exactly 6 files are required!")
+
+        dim = image_size(files[0])[0]
+        cube = numpy.empty((6, dim, dim, 3), dtype=numpy.uint8)
+
+        # Faces are decoded straight into the cube, one at a time
+        for index, file in enumerate(files):
+            with file.file.open("rb") as handle:
+                image = PIL.Image.open(handle)
+
+                if image.width != dim or image.height != dim:
+                    raise StitchingError("All cubemap faces must be square and have the same dimensions!")
+
+                cube[index] = numpy.asarray(image.convert("RGB"))
 
-        result = PIL.Image.new("RGB", (width * len(files[0]), height * len(files)))
+        width, height = size or (dim * 4, dim * 2)
 
-        for y, line in enumerate(image_files):
-            for x, file in enumerate(line):
-                result.paste(file, (x * width, y * height))
+        if files[0].conversion_id:
+            report_progress(files[0].conversion_id, PHASE_STITCH, 0, 1)
 
-        bio = io.BytesIO()
-        result.save(bio, "PNG")
-        bio.seek(0)
+        projection = get_projection_cache().get(dim, width, height, rotation, interpolation)
+        output = projection.gather(cube)
 
-        result_file = File.objects.create(conversion=files[0][0].conversion, file=ContentFile(bio.read(), name="result.png"), mime_type="image/png")
-        return result_file
+        if files[0].conversion_id:
+            report_progress(files[0].conversion_id, PHASE_ENCODE, 0, 1)
 
+        with temporary_directory() as tempdir:
+            path = Path(tempdir) / "result.png"
+            PIL.Image.fromarray(output, "RGB").save(path, "PNG")
 
+            return create_file(path, conversion=files[0].conversion, mime_type="image/png")
 
-DEFAULT_CUBEMAP_TO_EQUIRECTANGULAR_STITCHER = BlenderStitcher
+DEFAULT_CUBEMAP_TO_EQUIRECTANGULAR_STITCHER = NumpyStitcher
 DEFAULT_STITCHER = PILStitcher
\ No newline at end of file
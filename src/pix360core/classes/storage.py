@@ -0,0 +1,113 @@
+from ..models import File
+
+from django.conf import settings
+from django.core.files.base import File as DjangoFile
+
+from typing import Optional, Tuple
+from pathlib import Path
+
+import PIL.Image
+
+import os
+import shutil
+import tempfile
+
+def local_path(file: File) -> Optional[Path]:
+    """Get the path of a file in the local filesystem, if its storage has one
+
+    Args:
+        file (File): File object
+
+    Returns:
+        Optional[Path]: Path of the file, or None if the storage is not local (like S3)
+    """
+    try:
+        return Path(file.file.path)
+    except NotImplementedError:
+        return None
+
+def link_or_copy(file: File, destination: Path):
+    """Make a file available at a path, without copying it if possible
+
+    Files in local storage are hardlinked, or symlinked if the destination
+    is on another filesystem. Other files are streamed to the destination
+    in chunks.
+
+    Args:
+        file (File): File object
+        destination (Path): Path to make the file available at
+    """
+    source = local_path(file)
+
+    if source is not None:
+        try:
+            os.link(source, destination)
+        except OSError:
+            os.symlink(source.resolve(), destination)
+        return
+
+    with file.file.open("rb") as handle, open(destination, "wb") as f:
+        shutil.copyfileobj(handle, f)
+
+def image_size(file: File) -> Tuple[int, int]:
+    """Get the dimensions of an image, reading only its header
+
+    Args:
+        file (File): File object containing the image
+
+    Returns:
+        Tuple[int, int]: Width and height of the image
+    """
+    with file.file.open("rb") as handle:
+        return PIL.Image.open(handle).size
+
+def temporary_directory() -> tempfile.TemporaryDirectory:
+    """Create a temporary directory for intermediate files
+
+    The directory is created in the PIX360_TEMP_DIR setting if it is set, or
+    in the system's temporary directory. Putting it on the same filesystem
+    as the media files lets inputs be hardlinked and outputs be moved into
+    storage without copying them.
+
+    Returns:
+        tempfile.TemporaryDirectory: The temporary directory, to be used as a context manager
+    """
+    return tempfile.TemporaryDirectory(dir=getattr(settings, "PIX360_TEMP_DIR", None))
+
+class PathFile(DjangoFile):
+    """File backed by a path in the local filesystem, which is moved into storage when saved
+
+    FileSystemStorage moves files providing temporary_file_path(), which is a
+    rename if both are on the same filesystem. Other storages read the file
+    in chunks. Either way, its content is never held in memory as a whole.
+    """
+    def __init__(self, path: Path, name: Optional[str] = None):
+        """Initialize the PathFile
+
+        Args:
+            path (Path): Path of the file, which may be moved away when it is saved
+            name (Optional[str], optional): Name of the file in storage. Defaults to None, which uses the name of the path.
+        """
+        self.path = Path(path)
+        super().__init__(self.path.open("rb"), name=name or self.path.name)
+
+    def temporary_file_path(self) -> str:
+        return str(self.path)
+
+def create_file(path: Path, name: Optional[str] = None, **kwargs) -> File:
+    """Create a File object from a file in the local filesystem, moving it into storage
+
+    Args:
+        path (Path): Path of the file, which may be moved away
+        name (Optional[str], optional): Name of the file in storage. Defaults to None, which uses the name of the path.
+        **kwargs: Further fields of the File object, like conversion and mime_type
+
+    Returns:
+        File: The new File object
+    """
+    content = PathFile(path, name)
+
+    try:
+        return File.objects.create(file=content, **kwargs)
+    finally:
+        content.close()
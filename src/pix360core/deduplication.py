@@ -0,0 +1,116 @@
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Conversion, ConversionStatus
+
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from datetime import timedelta
+
+import hashlib
+import json
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def normalize_url(url: str) -> str:
+    """Normalize a URL so that equivalent URLs compare equal
+
+    The scheme and host are lowercased, default ports and utm_* tracking
+    parameters are removed, and query parameters are sorted. The fragment
+    is kept, as tour viewers use it to select a panorama, like #pano=2.
+
+    Args:
+        url (str): URL to normalize
+
+    Returns:
+        str: Normalized URL
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += f":{parts.port}"
+
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not key.startswith("utm_"))
+
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query), parts.fragment))
+
+def conversion_fingerprint(url: str, downloader: Optional[str] = None, properties: Optional[dict] = None) -> str:
+    """Build the fingerprint identifying conversions with identical results
+
+    Only the properties listed in the PIX360_DEDUPLICATION_PROPERTIES setting
+    are taken into account, or all of them if it is not set.
+
+    Args:
+        url (str): URL of the conversion
+        downloader (Optional[str], optional): Identifier of the requested downloader. Defaults to None.
+        properties (Optional[dict], optional): Properties of the conversion. Defaults to None.
+
+    Returns:
+        str: Fingerprint of the conversion
+    """
+    properties = properties or {}
+    relevant = getattr(settings, "PIX360_DEDUPLICATION_PROPERTIES", None)
+
+    if relevant is not None:
+        properties = {key: value for key, value in properties.items() if key in relevant}
+
+    data = json.dumps([normalize_url(url), downloader, properties], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def find_duplicate(fingerprint: str, exclude: Optional[list] = None) -> Optional[Conversion]:
+    """Find a finished conversion with the same fingerprint
+
+    Only conversions requested within the PIX360_DEDUPLICATION_WINDOW setting
+    (a timedelta or a number of seconds) are considered. Deduplication is
+    disabled if the setting is not set.
+
+    Args:
+        fingerprint (str): Fingerprint to look for, see conversion_fingerprint()
+        exclude (Optional[list], optional): IDs of conversions not to return. Defaults to None.
+
+    Returns:
+        Optional[Conversion]: The most recent matching conversion, or None
+    """
+    window = getattr(settings, "PIX360_DEDUPLICATION_WINDOW", None)
+
+    if not window:
+        return None
+
+    if not isinstance(window, timedelta):
+        window = timedelta(seconds=window)
+
+    conversions = Conversion.objects.filter(
+        fingerprint=fingerprint,
+        status=ConversionStatus.DONE,
+        duplicate_of__isnull=True,
+        created__gte=timezone.now() - window,
+        file__is_result=True,
+    )
+
+    if exclude:
+        conversions = conversions.exclude(id__in=[pk for pk in exclude if pk])
+
+    return conversions.order_by("-created").first()
+
+def create_conversion(url: str, title: Optional[str], user, exclude: Optional[list] = None, **kwargs) -> Conversion:
+    """Create a conversion, reusing the result of an identical finished one if possible
+
+    Args:
+        url (str): URL of the content to convert
+        title (Optional[str]): Title of the conversion
+        user (User): User requesting the conversion
+        exclude (Optional[list], optional): IDs of conversions not to reuse. Defaults to None.
+        **kwargs: Further fields of the conversion, like downloader or properties
+
+    Returns:
+        Conversion: The new conversion, which is DONE already if it is a duplicate
+    """
+    fingerprint = conversion_fingerprint(url, kwargs.get("downloader"), kwargs.get("properties"))
+    original = find_duplicate(fingerprint, exclude)
+
+    if original:
+        return Conversion.objects.create(url=url, title=title, user=user, fingerprint=fingerprint, duplicate_of=original, status=ConversionStatus.DONE, **kwargs)
+
+    return Conversion.objects.create(url=url, title=title, user=user, fingerprint=fingerprint, **kwargs)
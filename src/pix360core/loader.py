@@ -1,32 +1,271 @@
 from typing import List, Tuple, Optional
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from django.conf import settings
 
 from pix360core.classes.modules import DownloaderModule
+from pix360core.deduplication import normalize_url
+from pix360core.paths import user_cache_path
 
 import importlib.metadata
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+ENTRY_POINT_GROUP = "pix360downloader"
+
+class LazyDownloader:
+    """Stand-in for an installed downloader class, importing it only when it is first used
+
+    The identifier, name, hostnames and URL prefixes are known without
+    importing the module, so the Loader can index the downloader and
+    resolve its identifier for free. Testing a URL, instantiating the
+    downloader or reading any other attribute imports it.
+    """
+    def __init__(self, entry_point: str, identifier: str, name: Optional[str] = None, hostnames: Optional[List[str]] = None, url_prefixes: Optional[List[str]] = None, downloader=None):
+        """Initialize the LazyDownloader
+
+        Args:
+            entry_point (str): Value of the entry point, like "package.module:Downloader"
+            identifier (str): Identifier of the downloader
+            name (Optional[str], optional): Human-friendly name of the downloader. Defaults to None.
+            hostnames (Optional[List[str]], optional): Hostnames declared by the downloader. Defaults to None.
+            url_prefixes (Optional[List[str]], optional): URL prefixes declared by the downloader. Defaults to None.
+            downloader (optional): The downloader class, if it is already imported. Defaults to None.
+        """
+        self.entry_point = entry_point
+        self.identifier = identifier
+        self.name = name
+        self.hostnames = hostnames or []
+        self.url_prefixes = url_prefixes or []
+        self.downloader = downloader
+
+    def load(self):
+        """Import the downloader class, if it was not imported yet
+
+        Returns:
+            The downloader class
+        """
+        if self.downloader is None:
+            self.downloader = importlib.metadata.EntryPoint(name=self.identifier, value=self.entry_point, group=ENTRY_POINT_GROUP).load()
+
+        return self.downloader
+
+    def test_url(self, url: str) -> int:
+        """Test if URL is plausible for this downloader, see DownloaderModule.test_url()
+        """
+        return self.load().test_url(url)
+
+    def __call__(self, *args, **kwargs) -> DownloaderModule:
+        return self.load()(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        # Only called for attributes not set in __init__, which are not set yet while unpickling
+        if name.startswith("__") or name in ("entry_point", "downloader"):
+            raise AttributeError(name)
+
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        return f"<LazyDownloader {self.identifier} ({self.entry_point}){' loaded' if self.downloader else ''}>"
+
+def downloader_entry_points() -> List:
+    """Find the entry points of all installed downloaders, without importing them
+
+    Returns:
+        List: Entry points in the pix360downloader group
+    """
+    try:
+        return list(importlib.metadata.entry_points().get(ENTRY_POINT_GROUP, []))
+    except AttributeError:
+        return list(importlib.metadata.entry_points().select(group=ENTRY_POINT_GROUP))
+
+def distributions_key(entry_points: List) -> str:
+    """Build the key identifying the installed distributions and downloaders
+
+    Args:
+        entry_points (List): Entry points of the installed downloaders
+
+    Returns:
+        str: Hash of the names and versions of all installed distributions, and of the entry points
+    """
+    distributions = sorted((distribution.metadata["Name"] or "", distribution.version or "") for distribution in importlib.metadata.distributions())
+    data = json.dumps([distributions, sorted((entry_point.name, entry_point.value) for entry_point in entry_points)])
+
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def read_manifest(path: str, key: str, entry_points: List) -> Optional[List[LazyDownloader]]:
+    """Read the downloaders from a plugin manifest
+
+    The manifest is only trusted to describe the installed downloaders: it
+    is rejected unless it lists exactly the installed entry points, so it
+    can never make the Loader import anything else.
+
+    Args:
+        path (str): Path of the manifest
+        key (str): Key of the installed distributions, see distributions_key()
+        entry_points (List): Entry points of the installed downloaders
+
+    Returns:
+        Optional[List[LazyDownloader]]: The downloaders, or None if the manifest is missing, invalid or outdated
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+
+        if manifest.get("key") != key:
+            return None
+
+        downloaders = [LazyDownloader(**downloader) for downloader in manifest["downloaders"]]
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+    if sorted(downloader.entry_point for downloader in downloaders) != sorted(entry_point.value for entry_point in entry_points):
+        return None
+
+    return downloaders
+
+def write_manifest(path: str, key: str, downloaders: List[LazyDownloader]):
+    """Write the downloaders to a plugin manifest, atomically
+
+    Args:
+        path (str): Path of the manifest
+        key (str): Key of the installed distributions, see distributions_key()
+        downloaders (List[LazyDownloader]): The downloaders
+    """
+    manifest = {
+        "key": key,
+        "downloaders": [
+            {
+                "entry_point": downloader.entry_point,
+                "identifier": downloader.identifier,
+                "name": downloader.name,
+                "hostnames": list(downloader.hostnames),
+                "url_prefixes": list(downloader.url_prefixes),
+            }
+            for downloader in downloaders
+        ],
+    }
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+
+    try:
+        with os.fdopen(handle, "w") as f:
+            json.dump(manifest, f)
+
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+def manifest_path() -> Optional[str]:
+    """Get the default path of the plugin manifest, in the cache directory of the user
+
+    Returns:
+        Optional[str]: Path of the manifest, or None if the user has no home directory
+    """
+    return user_cache_path("plugins.json")
+
+_registry = None
+_registry_lock = threading.Lock()
 
 class Loader:
-    def __init__(self):
-        self.downloaders = self.__class__.load_downloaders()
+    def __init__(self, downloaders: Optional[List] = None, cache_size: Optional[int] = None):
+        """Initialize the Loader
+
+        Args:
+            downloaders (Optional[List], optional): Downloader classes to use. Defaults to None, meaning all installed downloaders, see load_downloaders().
+            cache_size (Optional[int], optional): Number of URLs to remember the downloaders of. Defaults to the PIX360_DOWNLOADER_CACHE_SIZE setting, or 1024.
+        """
+        self.downloaders = downloaders if downloaders is not None else self.__class__.load_downloaders()
+        self.logger = logging.getLogger("pix360")
+        self.cache_size = cache_size if cache_size is not None else getattr(settings, "PIX360_DOWNLOADER_CACHE_SIZE", 1024)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.build_index()
+
+    def build_index(self):
+        """Index the downloaders by the hostnames and URL prefixes they declare
+
+        Downloaders declaring neither are kept in a separate list, which
+        find_downloader() tests every URL against.
+        """
+        self.identifiers = {}
+        self.hosts = {}
+        self.prefixes = {}
+        self.unindexed = []
+
+        for downloader in self.downloaders:
+            self.identifiers.setdefault(downloader.identifier, downloader)
+
+            hostnames = getattr(downloader, "hostnames", None) or []
+            prefixes = getattr(downloader, "url_prefixes", None) or []
+
+            for hostname in hostnames:
+                self.hosts.setdefault(hostname.lower(), []).append(downloader)
+
+            for prefix in prefixes:
+                prefix = normalize_url(prefix)
+                self.prefixes.setdefault(urlsplit(prefix).hostname or "", []).append((prefix, downloader))
+
+            if not (hostnames or prefixes):
+                self.unindexed.append(downloader)
 
     def resolve_downloader_identifier(self, identifier: str) -> Optional[DownloaderModule]:
-        """A function to resolve a downloader identifier to a downloader name.
+        """A function to resolve a downloader identifier to a downloader.
 
         Args:
             identifier (str): The downloader identifier
 
         Returns:
-            str: The downloader name
+            Optional[DownloaderModule]: An instance of the downloader, or None if it is not installed
         """
 
-        for downloader in self.downloaders:
-            if downloader.identifier == identifier:
-                return downloader
+        downloader = self.identifiers.get(identifier)
 
-        return None
+        return downloader() if downloader else None
+
+    def candidates(self, url: str) -> List:
+        """Find the downloaders that may handle a normalized URL
+
+        Args:
+            url (str): The normalized URL
+
+        Returns:
+            List: Downloader classes whose hostnames or URL prefixes match the URL, followed by those declaring neither
+        """
+        hostname = urlsplit(url).hostname or ""
+        candidates = list(self.hosts.get(hostname, []))
+
+        # "*.example.com" matches all subdomains of example.com
+        labels = hostname.split(".")
+        for index in range(1, len(labels)):
+            candidates.extend(self.hosts.get("*." + ".".join(labels[index:]), []))
+
+        for prefix, downloader in self.prefixes.get(hostname, []):
+            if url.startswith(prefix):
+                candidates.append(downloader)
+
+        candidates = list(dict.fromkeys(candidates))
+        candidates.extend(downloader for downloader in self.unindexed if downloader not in candidates)
+
+        return candidates
 
     def find_downloader(self, url: str) -> List[Tuple[DownloaderModule, int]]:
         """A function to find the downloader(s) that can handle a given URL.
 
+        Only the downloaders whose hostnames or URL prefixes match the URL,
+        and those declaring neither, are tested. The results are remembered
+        by URL, so repeated URLs are not tested again. URLs that only differ
+        in a way test_url() may care about, like the fragment or the order
+        of the query, are tested separately. Downloaders failing to test the
+        URL are logged and skipped.
+
         Args:
             url (str): The URL to test
 
@@ -34,44 +273,95 @@ class Loader:
             List[Tuple[DownloaderModule, int]]: A list of tuples containing the downloader and the certainty level
         """
 
-        downloaders = []
+        key = url.strip()
 
-        for downloader in self.downloaders:
-            downloader = downloader()
-            try:
-                certainty = downloader.test_url(url)
-            except Exception as e:
-                raise Exception(f"Error while testing URL with {downloader.identifier}: {e}") from e
-            if certainty != DownloaderModule.CERTAINTY_UNSUPPORTED:
-                downloaders.append((downloader, certainty))
+        with self.lock:
+            matches = self.cache.get(key)
+
+            if matches is not None:
+                self.cache.move_to_end(key)
+
+        if matches is None:
+            matches = []
+
+            for downloader in self.candidates(normalize_url(url)):
+                try:
+                    certainty = downloader.test_url(url)
+                except Exception as e:
+                    self.logger.error(f"Error while testing URL with {downloader.identifier}: {e}")
+                    continue
+
+                if certainty != DownloaderModule.CERTAINTY_UNSUPPORTED:
+                    matches.append((downloader, certainty))
 
-        return downloaders
+            with self.lock:
+                self.cache[key] = matches
+
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        return [(downloader(), certainty) for downloader, certainty in matches]
 
     @staticmethod
     def load_downloaders() -> List:
         """A function to find all downloaders installed, implementing the
         pix360downloader entry point.
 
-        Returns: List of imported installed downloaders
+        The downloaders are described by a manifest cached in the file set
+        by the PIX360_PLUGIN_MANIFEST setting, or in the cache directory of
+        the user, so they are only imported when they are first used. The
+        manifest is rebuilt, importing every downloader once, whenever the
+        installed distributions change. Within a process, the manifest is
+        read once and shared by all Loader objects. A new worker process
+        reads it again, which is cheap as long as it is up to date.
+
+        Returns: List of installed downloaders, as LazyDownloader objects
         """
 
-        downloaders = []
+        global _registry
+
+        with _registry_lock:
+            if _registry is not None:
+                return list(_registry)
+
+            logger = logging.getLogger("pix360")
+            path = getattr(settings, "PIX360_PLUGIN_MANIFEST", manifest_path())
+            entry_points = downloader_entry_points()
+            key = distributions_key(entry_points)
 
-        try:
-            for entry_point in importlib.metadata.entry_points().get("pix360downloader", []):
+            downloaders = read_manifest(path, key, entry_points) if path else None
+
+            if downloaders is not None:
+                logger.debug(f"Read {len(downloaders)} downloaders from the plugin manifest")
+                _registry = downloaders
+                return list(_registry)
+
+            downloaders = []
+            complete = True
+
+            for entry_point in entry_points:
                 try:
-                    downloaders.append(entry_point.load())
+                    downloader = entry_point.load()
                 except Exception as e:
-                    print(f"Something went wrong trying to import {entry_point}: {e}")
+                    logger.error(f"Something went wrong trying to import {entry_point}: {e}")
+                    complete = False
+                    continue
 
-        except AttributeError:
-            for entry_point in importlib.metadata.entry_points().select(
-                group="pix360downloader"
-            ):
+                downloaders.append(LazyDownloader(
+                    entry_point.value,
+                    downloader.identifier,
+                    getattr(downloader, "name", None),
+                    list(getattr(downloader, "hostnames", None) or []),
+                    list(getattr(downloader, "url_prefixes", None) or []),
+                    downloader,
+                ))
+
+            # Downloaders failing to import are retried until the manifest is complete
+            if path and complete:
                 try:
-                    downloaders.append(entry_point.load())
-                except Exception as e:
-                    print(f"Something went wrong trying to import {entry_point}: {e}"
-            )
+                    write_manifest(path, key, downloaders)
+                except OSError as e:
+                    logger.warning(f"Could not write the plugin manifest to {path}: {e}")
 
-        return downloaders
\ No newline at end of file
+            _registry = downloaders
+            return list(_registry)
\ No newline at end of file
@@ -1,11 +1,18 @@
 from django.core.management.base import BaseCommand
 
-from pix360core.worker import Worker
+from pix360core.supervisor import Supervisor
+from pix360core.worker import STAGES, STAGE_ALL
 
 class Command(BaseCommand):
     help = "Run the worker"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=1, help="Number of worker processes to run")
+        parser.add_argument("--max-jobs", type=int, default=None, help="Replace a worker process after this many conversions")
+        parser.add_argument("--stage", choices=STAGES, default=STAGE_ALL, help="Only process the download or the stitch stage of conversions")
+        parser.add_argument("--size-class", action="append", dest="size_classes", help="Only process conversions of this size class, and those without one (can be repeated)")
+
     def handle(self, *args, **options):
         """Handle the command"""
-        worker = Worker()
-        worker.run()
+        supervisor = Supervisor(concurrency=options["concurrency"], max_jobs=options["max_jobs"], size_classes=options["size_classes"], stage=options["stage"])
+        supervisor.run()
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pix360core", "0006_conversion_created_conversion_fingerprint_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversion",
+            name="priority",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="conversion",
+            name="size_class",
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pix360core", "0007_conversion_priority_conversion_size_class"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversion",
+            name="stage_data",
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="conversion",
+            name="status",
+            field=models.IntegerField(
+                choices=[
+                    (0, "Pending"),
+                    (1, "Processing"),
+                    (2, "Done"),
+                    (-1, "Failed"),
+                    (-2, "Dismissed"),
+                    (10, "Downloading"),
+                    (11, "Stitching"),
+                    (12, "Downloaded"),
+                ],
+                default=0,
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pix360core", "0008_conversion_stage_data_alter_conversion_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversion",
+            name="worker",
+            field=models.CharField(blank=True, max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name="conversion",
+            name="lease_expires",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="conversion",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pix360core", "0010_file_stage_file_key_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="height",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="rendition_of",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="renditions",
+                to="pix360core.file",
+            ),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="width",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pix360core", "0011_file_height_file_rendition_of_file_width"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversion",
+            name="updated",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name="conversion",
+            index=models.Index(
+                fields=["user", "created"], name="pix360core__user_id_dd1991_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="conversion",
+            index=models.Index(
+                fields=["user", "status", "created"], name="pix360core__user_id_15e2a8_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="conversion",
+            index=models.Index(
+                fields=["status", "created"], name="pix360core__status_fcb250_idx"
+            ),
+        ),
+    ]
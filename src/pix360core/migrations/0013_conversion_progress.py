@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pix360core", "0012_conversion_updated_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversion",
+            name="progress",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
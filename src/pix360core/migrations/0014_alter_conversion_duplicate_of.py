@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("pix360core", "0013_conversion_progress"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="conversion",
+            name="duplicate_of",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="duplicates",
+                to="pix360core.conversion",
+            ),
+        ),
+    ]
@@ -3,6 +3,9 @@ from django.contrib.auth import get_user_model
 
 from ..fields import Char32UUIDField as UUIDField
 
+from typing import Dict, Optional
+
+import hashlib
 import mimetypes
 import uuid
 
@@ -19,6 +22,17 @@ def file_upload_path(instance, filename) -> str:
 
     return f"content/{instance.conversion.id}/{instance.id}/{filename}"
 
+def checkpoint_key(*parts) -> str:
+    """Build a checkpoint key from arbitrary values, like URLs or file IDs
+
+    Args:
+        *parts: Values identifying the checkpoint
+
+    Returns:
+        str: Key for the checkpoint
+    """
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode()).hexdigest()
+
 class File(models.Model):
     """Model for files downloaded or generated by PIX360
 
@@ -27,13 +41,32 @@ class File(models.Model):
         file (FileField): File object containing the file
         conversion (ForeignKey): Conversion object that this file belongs to
         is_result (BooleanField): Whether this file is the result of a conversion
+        stage (CharField): Stage of the conversion that produced this file, if it is a checkpoint
+        key (CharField): Key identifying the checkpoint within its stage
+        rendition_of (ForeignKey): File that this file is a scaled down preview of, if it is a rendition
+        width (PositiveIntegerField): Width of the image, if known
+        height (PositiveIntegerField): Height of the image, if known
     """
 
+    # Stages of checkpoints created by PIX360 itself
+    STAGE_DOWNLOADED = "downloaded"
+    STAGE_STITCHED = "stitched"
+
     id = UUIDField(primary_key=True, default=uuid.uuid4)
     file = models.FileField(upload_to=file_upload_path)
     mime_type = models.CharField(max_length=256, default="application/octet-stream")
     conversion = models.ForeignKey(to='Conversion', on_delete=models.SET_NULL, null=True, blank=True)
     is_result = models.BooleanField(default=False)
+    stage = models.CharField(max_length=32, null=True, blank=True)
+    key = models.CharField(max_length=64, null=True, blank=True)
+    rendition_of = models.ForeignKey(to='self', on_delete=models.CASCADE, null=True, blank=True, related_name='renditions')
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["conversion", "stage", "key"]),
+        ]
 
 class ConversionStatus(models.IntegerChoices):
     """Enum for conversion statuses
@@ -43,6 +76,10 @@ class ConversionStatus(models.IntegerChoices):
         PROCESSING (int): Conversion is processing
         DONE (int): Conversion is done
         FAILED (int): Conversion has failed
+        DISMISSED (int): Conversion was dismissed by the user
+        DOWNLOADING (int): Content is being downloaded
+        STITCHING (int): Downloaded content is being stitched
+        DOWNLOADED (int): Content is downloaded and waiting to be stitched
     """
 
     PENDING = 0
@@ -53,6 +90,7 @@ class ConversionStatus(models.IntegerChoices):
 
     DOWNLOADING = 10
     STITCHING = 11
+    DOWNLOADED = 12
 
 class Conversion(models.Model):
     """Model for conversions performed by PIX360
@@ -65,6 +103,17 @@ class Conversion(models.Model):
         properties (JSONField): Properties of the conversion
         status (IntegerField): Status of the conversion (see ConversionStatus)
         log (TextField): Log of the conversion
+        created (DateTimeField): Time the conversion was requested
+        updated (DateTimeField): Time the status or content of the conversion last changed
+        fingerprint (CharField): Fingerprint of the conversion, used to find identical conversions
+        duplicate_of (ForeignKey): Conversion whose result this conversion reuses, which cannot be deleted while it has duplicates
+        priority (IntegerField): Scheduling priority, higher values are processed first
+        size_class (CharField): Size class of the conversion, used to route it to dedicated workers
+        stage_data (JSONField): Data passed from the download stage to the stitch stage
+        worker (CharField): Worker currently processing the conversion
+        lease_expires (DateTimeField): Time at which the conversion is considered abandoned unless the worker renews its lease
+        attempts (PositiveIntegerField): Number of times a worker claimed the conversion
+        progress (JSONField): Progress of the current phase while the conversion is processed, see ProgressReporter
     """
 
     id = UUIDField(primary_key=True, default=uuid.uuid4)
@@ -75,19 +124,103 @@ class Conversion(models.Model):
     properties = models.JSONField(null=True, blank=True)
     status = models.IntegerField(choices=ConversionStatus.choices, default=ConversionStatus.PENDING)
     log = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    fingerprint = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    duplicate_of = models.ForeignKey(to='self', on_delete=models.PROTECT, null=True, blank=True, related_name='duplicates')
+    priority = models.IntegerField(default=0)
+    size_class = models.CharField(max_length=32, null=True, blank=True)
+    stage_data = models.JSONField(null=True, blank=True)
+    worker = models.CharField(max_length=256, null=True, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    progress = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created"]),
+            models.Index(fields=["user", "status", "created"]),
+            models.Index(fields=["status", "created"]),
+        ]
 
     @property
     def result(self) -> File:
         """Get the result file of this conversion
 
+        For a duplicate, this is the result file of the original conversion.
+
         Returns:
             File: Result file of this conversion
 
         Raises:
             File.DoesNotExist: If no result file exists
         """
+        if self.duplicate_of_id:
+            return self.duplicate_of.result
+
         return File.objects.get(conversion=self, is_result=True)
 
+    def get_checkpoints(self, stage: str) -> Dict[str, File]:
+        """Get the checkpoints of a stage of this conversion
+
+        Args:
+            stage (str): Stage of the checkpoints
+
+        Returns:
+            Dict[str, File]: Checkpoint files by key
+        """
+        return {file.key: file for file in File.objects.filter(conversion=self, stage=stage)}
+
+    def get_checkpoint(self, stage: str, key: str) -> Optional[File]:
+        """Get a checkpoint of this conversion
+
+        Args:
+            stage (str): Stage of the checkpoint
+            key (str): Key of the checkpoint, see checkpoint_key()
+
+        Returns:
+            Optional[File]: The checkpoint file, or None if the stage was not completed for this key
+        """
+        return File.objects.filter(conversion=self, stage=stage, key=key).first()
+
+    def add_checkpoint(self, file: File, stage: str, key: str) -> File:
+        """Record a file as a checkpoint of this conversion, replacing any previous one
+
+        Args:
+            file (File): The intermediate file
+            stage (str): Stage that produced the file
+            key (str): Key of the checkpoint, see checkpoint_key()
+
+        Returns:
+            File: The checkpoint file
+        """
+        File.objects.filter(conversion=self, stage=stage, key=key).exclude(id=file.id).update(stage=None, key=None)
+
+        file.conversion = self
+        file.stage = stage
+        file.key = key
+        file.save()
+
+        return file
+
+    def adopt_checkpoints(self, other: "Conversion") -> int:
+        """Take over the checkpoints of another conversion, so this one can resume where it stopped
+
+        Checkpoints are only taken from a conversion that failed or that no
+        worker holds a lease on, so they are never taken away from a worker
+        still using them.
+
+        Args:
+            other (Conversion): Conversion to take the checkpoints from
+
+        Returns:
+            int: Number of checkpoints taken over
+        """
+        files = File.objects.filter(conversion=other, stage__isnull=False, is_result=False)
+        files = files.filter(models.Q(conversion__status=ConversionStatus.FAILED) | models.Q(conversion__worker__isnull=True))
+
+        return files.update(conversion=self)
+
     def get_result_filename(self) -> str:
         """Get the final filename for the result file
 
@@ -0,0 +1,261 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+from typing import Optional
+from pathlib import Path
+
+from .paths import user_cache_path
+
+import logging
+import os
+import select
+import socket
+
+CHANNEL = "pix360_conversions"
+
+class BaseNotifier:
+    """Wakes up idle workers when new conversions are queued
+
+    Notifications are only hints: the database stays the source of truth,
+    and workers still check it regularly in case a notification was lost.
+
+    Subclasses implement notify(), and provide a file descriptor that
+    becomes readable when a notification arrives through fileno() and
+    drain().
+    """
+    def __init__(self):
+        self.logger = logging.getLogger("pix360")
+        self.interrupt_pipe = None
+
+    def notify(self):
+        """Notify all waiting workers
+        """
+        raise NotImplementedError
+
+    def fileno(self) -> Optional[int]:
+        """Get the file descriptor that becomes readable on notification
+
+        Returns:
+            Optional[int]: The file descriptor, or None if notifications are currently unavailable
+        """
+        return None
+
+    def drain(self):
+        """Consume pending notifications after fileno() became readable
+        """
+        pass
+
+    def interrupt(self):
+        """Wake up wait() in this process, for example from a signal handler
+        """
+        if self.interrupt_pipe:
+            try:
+                os.write(self.interrupt_pipe[1], b"\0")
+            except BlockingIOError:
+                pass
+
+    def wait(self, timeout: float) -> bool:
+        """Block until a notification arrives, interrupt() is called or the timeout expires
+
+        Args:
+            timeout (float): Maximum time to wait in seconds
+
+        Returns:
+            bool: Whether the wait ended early
+        """
+        if not self.interrupt_pipe:
+            self.interrupt_pipe = os.pipe()
+            for fd in self.interrupt_pipe:
+                os.set_blocking(fd, False)
+
+        readers = [self.interrupt_pipe[0]]
+
+        try:
+            fd = self.fileno()
+        except Exception as e:
+            self.logger.warning(f"Notifications unavailable: {e}")
+            fd = None
+
+        if fd is not None:
+            readers.append(fd)
+
+        ready, _, _ = select.select(readers, [], [], timeout)
+
+        if self.interrupt_pipe[0] in ready:
+            try:
+                while os.read(self.interrupt_pipe[0], 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+        if fd in ready:
+            try:
+                self.drain()
+            except Exception as e:
+                self.logger.warning(f"Error while receiving notifications: {e}")
+                self.close()
+
+        return bool(ready)
+
+    def close(self):
+        """Release the resources used for receiving notifications
+        """
+        pass
+
+class PostgresNotifier(BaseNotifier):
+    """Notifier using PostgreSQL LISTEN/NOTIFY
+
+    Waiting workers listen on a dedicated database connection, so
+    notifications work across hosts. Supports psycopg2 and psycopg 3.
+    """
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+
+    def notify(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"NOTIFY {CHANNEL}")
+
+    def connect(self):
+        """Open the listening connection
+        """
+        listener = connection.get_new_connection(connection.get_connection_params())
+        listener.autocommit = True
+
+        if type(listener).__module__.startswith("psycopg2"):
+            listener.cursor().execute(f"LISTEN {CHANNEL}")
+        else:
+            listener.add_notify_handler(lambda notification: None)
+            listener.execute(f"LISTEN {CHANNEL}")
+
+        self.listener = listener
+
+    def fileno(self) -> Optional[int]:
+        if self.listener is None:
+            self.connect()
+
+        return self.listener.fileno()
+
+    def drain(self):
+        if type(self.listener).__module__.startswith("psycopg2"):
+            self.listener.poll()
+            self.listener.notifies.clear()
+        else:
+            # psycopg 3 dispatches pending notifications to the handlers while executing a query
+            self.listener.execute("SELECT 1")
+
+    def close(self):
+        if self.listener is not None:
+            try:
+                self.listener.close()
+            finally:
+                self.listener = None
+
+class SocketNotifier(BaseNotifier):
+    """Notifier using Unix datagram sockets, for databases without LISTEN/NOTIFY
+
+    Every waiting worker binds a socket in a shared directory, and
+    notify() sends a datagram to all of them. This only reaches workers
+    on the same host, which is sufficient for SQLite. The directory is in
+    the cache directory of the user by default, so if the web server and
+    the workers run as different users, PIX360_WORKER_SOCKET_DIR must point
+    to a directory both can use.
+    """
+    def __init__(self, directory: Optional[str] = None):
+        """Initialize the SocketNotifier
+
+        Args:
+            directory (Optional[str], optional): Directory for the sockets. Defaults to the PIX360_WORKER_SOCKET_DIR setting, or pix360/workers in the cache directory of the user.
+        """
+        super().__init__()
+        directory = directory or getattr(settings, "PIX360_WORKER_SOCKET_DIR", user_cache_path("workers"))
+        self.directory = Path(directory) if directory else None
+        self.socket = None
+        self.path = None
+
+    def notify(self):
+        if self.directory is None or not self.directory.is_dir():
+            return
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+            sender.setblocking(False)
+
+            for path in self.directory.glob("*.sock"):
+                try:
+                    sender.sendto(b"\0", str(path))
+                except BlockingIOError:
+                    # The worker has unread notifications already
+                    pass
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Left behind by a worker that did not exit cleanly
+                    path.unlink(missing_ok=True)
+
+    def fileno(self) -> Optional[int]:
+        if self.directory is None:
+            return None
+
+        if self.socket is None:
+            self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+            self.path = self.directory / f"{os.getpid()}.sock"
+            self.path.unlink(missing_ok=True)
+
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.setblocking(False)
+            self.socket.bind(str(self.path))
+
+        return self.socket.fileno()
+
+    def drain(self):
+        try:
+            while self.socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            self.path.unlink(missing_ok=True)
+
+_notifiers = {}
+
+def get_notifier() -> BaseNotifier:
+    """Get the notifier of this process, configured from the Django settings
+
+    Settings:
+        PIX360_WORKER_NOTIFIER: Dotted path to a BaseNotifier subclass (default: PostgresNotifier on PostgreSQL, SocketNotifier otherwise)
+
+    Returns:
+        BaseNotifier: The notifier
+    """
+    pid = os.getpid()
+
+    if pid not in _notifiers:
+        path = getattr(settings, "PIX360_WORKER_NOTIFIER", None)
+
+        if path:
+            notifier_class = import_string(path)
+        elif connection.vendor == "postgresql":
+            notifier_class = PostgresNotifier
+        else:
+            notifier_class = SocketNotifier
+
+        _notifiers.clear()
+        _notifiers[pid] = notifier_class()
+
+    return _notifiers[pid]
+
+def notify_workers():
+    """Wake up idle workers once the current transaction is committed
+
+    Errors are logged, so a failing notification never breaks the caller.
+    """
+    def send():
+        try:
+            get_notifier().notify()
+        except Exception as e:
+            logging.getLogger("pix360").warning(f"Could not notify workers: {e}")
+
+    transaction.on_commit(send)
@@ -0,0 +1,81 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+
+from typing import List, Optional, Tuple
+
+import base64
+import json
+
+def encode_cursor(instance) -> str:
+    """Build the cursor pointing after an object, see paginate()
+
+    Args:
+        instance (Model): Last object of a page
+
+    Returns:
+        str: Opaque, URL-safe cursor
+    """
+    data = json.dumps([instance.created.isoformat(), str(instance.pk)])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple:
+    """Parse a cursor built by encode_cursor()
+
+    Args:
+        cursor (str): The cursor
+
+    Returns:
+        Tuple: Creation time and primary key of the last object of the previous page
+
+    Raises:
+        ValueError: If the cursor is invalid
+    """
+    try:
+        created, pk = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        created = parse_datetime(created)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from e
+
+    if created is None:
+        raise ValueError("Invalid cursor")
+
+    return created, pk
+
+def paginate(queryset: QuerySet, cursor: Optional[str], limit: int) -> Tuple[List, Optional[str]]:
+    """Get a page of objects, newest first, using keyset pagination
+
+    Instead of an offset, the cursor holds the creation time and primary
+    key of the last object of the previous page, so every page is a single
+    index range scan, however deep it is, and objects created in between
+    do not shift the pages.
+
+    Args:
+        queryset (QuerySet): Objects to paginate, which must have a created field
+        cursor (Optional[str]): Cursor from the previous page, or None for the first page
+        limit (int): Maximum number of objects per page
+
+    Returns:
+        Tuple[List, Optional[str]]: The objects, and the cursor of the next page, or None if this is the last page
+
+    Raises:
+        ValueError: If the cursor is invalid, including a primary key not valid for the model
+    """
+    queryset = queryset.order_by("-created", "-pk")
+
+    if cursor:
+        created, pk = decode_cursor(cursor)
+
+        try:
+            pk = queryset.model._meta.pk.to_python(pk)
+        except ValidationError as e:
+            raise ValueError(f"Invalid cursor: {e}") from e
+
+        queryset = queryset.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+
+    page = list(queryset[:limit + 1])
+
+    if len(page) > limit:
+        return page[:limit], encode_cursor(page[limit - 1])
+
+    return page, None
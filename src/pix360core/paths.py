@@ -0,0 +1,23 @@
+from typing import Optional
+
+import os
+
+def user_cache_path(*parts: str) -> Optional[str]:
+    """Get a path in the cache directory of the user running PIX360
+
+    Caches and sockets are kept out of the shared temp directory, where
+    other users could replace their content, or create the directory first
+    and lock everyone else out.
+
+    Args:
+        *parts: Path components below the pix360 cache directory
+
+    Returns:
+        Optional[str]: The path, or None if the user has no home directory
+    """
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+    if not os.path.isabs(cache):
+        return None
+
+    return os.path.join(cache, "pix360", *parts)
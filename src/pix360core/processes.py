@@ -0,0 +1,273 @@
+from django.conf import settings
+
+from typing import Callable, List, Optional, Tuple
+from concurrent.futures import Future
+from multiprocessing.connection import Connection
+
+import django
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import subprocess
+import threading
+
+# Process groups of the commands currently run by run_command() in this process
+_active_commands = set()
+
+def run_command(command: List[str], cwd: Optional[str] = None, timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+    """Run an external command in its own process group, killing the whole group on timeout
+
+    Args:
+        command (List[str]): Command and arguments
+        cwd (Optional[str], optional): Working directory of the command. Defaults to None.
+        timeout (Optional[float], optional): Maximum run time in seconds. Defaults to None, meaning no limit.
+
+    Returns:
+        subprocess.CompletedProcess: Return code and output of the command
+
+    Raises:
+        subprocess.TimeoutExpired: If the command did not finish in time
+        OSError: If the command could not be started
+    """
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    _active_commands.add(process.pid)
+
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except BaseException:
+        # Commands like cube2sphere start further processes, which have to be killed as well
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # The whole group exited already
+            pass
+
+        process.communicate()
+        raise
+    finally:
+        _active_commands.discard(process.pid)
+
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+def _terminate(signum, frame):
+    """Kill the commands run by this process before exiting, see _serve()
+    """
+    for pid in list(_active_commands):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    os._exit(1)
+
+def _serve(connection: Connection):
+    """Main loop of a StitcherPool process: run jobs received over the pipe until told to stop
+
+    This module is imported by spawned processes before Django is set up,
+    so it must not import anything depending on the app registry at the
+    module level.
+    """
+    signal.signal(signal.SIGTERM, _terminate)
+    django.setup()
+
+    from .classes.exceptions import StitchingError
+    from .progress import flush_progress
+
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            # The pool was shut down without stopping this process
+            return
+
+        if job is None:
+            return
+
+        function, args = job
+
+        try:
+            result = ("result", function(*args))
+        except Exception as e:
+            result = ("error", e)
+
+        flush_progress()
+
+        try:
+            connection.send(result)
+        except Exception as e:
+            # The exception or result could not be pickled
+            connection.send(("error", StitchingError(f"Could not return the result of {function.__name__}: {e!r}")))
+
+class StitcherPool:
+    """Pool of warm, reusable processes running stitching jobs
+
+    The processes are started once and keep their imports, Django setup and
+    caches (like the projection cache) between jobs, which are sent to
+    them over a pipe. A job running longer than the timeout is aborted by
+    killing its process, including any commands it started, and the process
+    is replaced. Processes are also replaced after a number of jobs, to
+    release memory fragmented by large images.
+    """
+    def __init__(self, processes: Optional[int] = None, timeout: Optional[float] = None, max_jobs: Optional[int] = None):
+        """Initialize the StitcherPool
+
+        Processes are only started when jobs are submitted.
+
+        Args:
+            processes (Optional[int], optional): Number of processes. Defaults to the PIX360_STITCH_PROCESSES setting, or the number of CPUs.
+            timeout (Optional[float], optional): Maximum run time per job in seconds. Defaults to the PIX360_STITCH_TIMEOUT setting, or one hour.
+            max_jobs (Optional[int], optional): Number of jobs after which a process is replaced. Defaults to the PIX360_STITCH_MAX_JOBS setting, or 100.
+        """
+        self.processes = processes or getattr(settings, "PIX360_STITCH_PROCESSES", None) or os.cpu_count() or 1
+        self.timeout = timeout or getattr(settings, "PIX360_STITCH_TIMEOUT", 60 * 60)
+        self.max_jobs = max_jobs or getattr(settings, "PIX360_STITCH_MAX_JOBS", 100)
+        self.logger = logging.getLogger("pix360")
+
+        self.jobs = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, function: Callable, *args) -> Future:
+        """Run a function in one of the pool processes
+
+        The function and its arguments and result must be picklable.
+
+        Args:
+            function (Callable): Module level function to run
+            *args: Arguments for the function
+
+        Returns:
+            Future: Future for the result of the function, failing with StitchingError on timeout
+        """
+        future = Future()
+        self.jobs.put((future, function, args))
+
+        with self.lock:
+            if len(self.threads) < self.processes:
+                thread = threading.Thread(target=self.manage, name="pix360-stitcher", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+        return future
+
+    def start_process(self) -> Tuple[multiprocessing.Process, Connection]:
+        """Start a pool process
+
+        Returns:
+            Tuple[multiprocessing.Process, Connection]: The process and the parent end of its pipe
+        """
+        context = multiprocessing.get_context("spawn")
+        parent, child = context.Pipe()
+        process = context.Process(target=_serve, args=(child,), name="pix360-stitcher", daemon=True)
+        process.start()
+        child.close()
+        return process, parent
+
+    def stop_process(self, process: multiprocessing.Process, connection: Connection, kill: bool = False):
+        """Stop a pool process
+
+        Args:
+            process (multiprocessing.Process): The process
+            connection (Connection): Parent end of its pipe
+            kill (bool, optional): Whether to abort the job it is running. Defaults to False.
+        """
+        try:
+            if kill:
+                process.terminate()
+            else:
+                connection.send(None)
+            process.join(5)
+        except OSError:
+            pass
+
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+        connection.close()
+
+    def manage(self):
+        """Feed jobs to one pool process, replacing it when it dies, hangs or is worn out
+
+        Runs in a thread per process, until shutdown() is called.
+        """
+        from .classes.exceptions import StitchingError
+
+        process, connection = None, None
+        jobs = 0
+
+        while True:
+            job = self.jobs.get()
+
+            if job is None:
+                break
+
+            future, function, args = job
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            if process is None:
+                process, connection = self.start_process()
+                jobs = 0
+
+            try:
+                connection.send((function, args))
+
+                if not connection.poll(self.timeout):
+                    self.logger.error(f"Stitching job {function.__name__} timed out after {self.timeout} seconds, killing its process")
+                    self.stop_process(process, connection, kill=True)
+                    process = None
+                    future.set_exception(StitchingError(f"Stitching timed out after {self.timeout} seconds"))
+                    continue
+
+                status, value = connection.recv()
+            except (EOFError, OSError) as e:
+                self.stop_process(process, connection, kill=True)
+                process = None
+                future.set_exception(StitchingError(f"Stitching process died: {e!r}"))
+                continue
+
+            if status == "error":
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+
+            jobs += 1
+
+            if jobs >= self.max_jobs:
+                self.stop_process(process, connection)
+                process = None
+
+        if process is not None:
+            self.stop_process(process, connection)
+
+    def shutdown(self):
+        """Stop all pool processes once the submitted jobs are done
+        """
+        with self.lock:
+            for _ in self.threads:
+                self.jobs.put(None)
+
+            for thread in self.threads:
+                thread.join()
+
+            self.threads.clear()
+
+_stitcher_pool = None
+
+def get_stitcher_pool() -> StitcherPool:
+    """Get the process-wide stitcher pool, configured from the Django settings
+
+    Returns:
+        StitcherPool: The stitcher pool
+    """
+    global _stitcher_pool
+
+    if _stitcher_pool is None:
+        _stitcher_pool = StitcherPool()
+
+    return _stitcher_pool
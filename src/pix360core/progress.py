@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Conversion, ConversionStatus
+
+from typing import Optional
+
+import logging
+import threading
+import time
+
+# Phases of a conversion reported by PIX360 itself
+PHASE_DOWNLOAD = "download"
+PHASE_STITCH = "stitch"
+PHASE_ENCODE = "encode"
+
+# Statuses in which progress is recorded, so late reports cannot touch finished conversions
+REPORTING_STATUSES = (ConversionStatus.PROCESSING, ConversionStatus.DOWNLOADING, ConversionStatus.STITCHING)
+
+class ProgressReporter:
+    """Records the progress of a conversion, coalescing frequent reports into few writes
+
+    Reports are kept in memory, and only written when the phase changes,
+    when a phase is complete, or at most every interval seconds otherwise.
+    Each write is a single UPDATE of the progress and updated columns, so
+    it never overwrites changes made to the conversion in the meantime.
+    """
+    def __init__(self, conversion_id, interval: Optional[float] = None):
+        """Initialize the ProgressReporter
+
+        Args:
+            conversion_id (UUID): ID of the conversion
+            interval (Optional[float], optional): Minimum time between writes in seconds. Defaults to the PIX360_PROGRESS_INTERVAL setting, or 2 seconds.
+        """
+        self.conversion_id = conversion_id
+        self.interval = interval if interval is not None else getattr(settings, "PIX360_PROGRESS_INTERVAL", 2)
+        self.logger = logging.getLogger("pix360")
+        self.lock = threading.Lock()
+        self.progress = None
+        self.written = None
+        self.last_write = 0
+
+    def report(self, phase: str, done: int, total: Optional[int] = None):
+        """Report the progress of the current phase
+
+        Args:
+            phase (str): Name of the phase, like "download", "stitch" or "encode"
+            done (int): Number of completed steps, like tiles fetched or rows stitched
+            total (Optional[int], optional): Total number of steps, if known. Defaults to None.
+        """
+        with self.lock:
+            self.update(phase, done, total)
+
+    def update(self, phase: str, done: int, total: Optional[int]):
+        """Record a report and write it if it is due, with the lock held
+        """
+        self.progress = {"phase": phase, "done": done, "total": total}
+
+        changed = self.written is None or self.written["phase"] != phase
+        complete = total is not None and done >= total
+
+        if changed or complete or time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def flush(self):
+        """Write the latest report if it was not written yet
+        """
+        with self.lock:
+            if self.progress != self.written:
+                self.write()
+
+    def write(self):
+        """Write the latest report, with the lock held
+        """
+        try:
+            Conversion.objects.filter(id=self.conversion_id, status__in=REPORTING_STATUSES).update(progress=self.progress, updated=timezone.now())
+        except Exception as e:
+            # Progress is informational, it must never fail a conversion
+            self.logger.warning(f"Could not record progress of conversion {self.conversion_id}: {e}")
+
+        self.written = self.progress
+        self.last_write = time.monotonic()
+
+_reporters = {}
+_reporters_lock = threading.Lock()
+
+def get_progress_reporter(conversion) -> ProgressReporter:
+    """Get the progress reporter of a conversion in this process
+
+    Args:
+        conversion (Conversion): The conversion, or its ID
+
+    Returns:
+        ProgressReporter: The reporter, shared by all callers in this process
+    """
+    conversion_id = getattr(conversion, "id", conversion)
+
+    with _reporters_lock:
+        if conversion_id not in _reporters:
+            _reporters[conversion_id] = ProgressReporter(conversion_id)
+
+        return _reporters[conversion_id]
+
+def report_progress(conversion, phase: str, done: int, total: Optional[int] = None):
+    """Report the progress of a conversion, see ProgressReporter.report()
+
+    Args:
+        conversion (Conversion): The conversion, or its ID
+        phase (str): Name of the phase, like "download", "stitch" or "encode"
+        done (int): Number of completed steps
+        total (Optional[int], optional): Total number of steps, if known. Defaults to None.
+    """
+    get_progress_reporter(conversion).report(phase, done, total)
+
+def discard_progress(conversion):
+    """Forget the progress reporter of a conversion once it is finished
+
+    Unwritten reports are dropped, as the progress of a finished conversion
+    is cleared anyway.
+
+    Args:
+        conversion (Conversion): The conversion, or its ID
+    """
+    with _reporters_lock:
+        _reporters.pop(getattr(conversion, "id", conversion), None)
+
+def flush_progress():
+    """Write the unwritten reports of all conversions and forget their reporters
+
+    Called by StitcherPool processes after every job, as they never learn
+    when a conversion is finished.
+    """
+    with _reporters_lock:
+        reporters = list(_reporters.values())
+        _reporters.clear()
+
+    for reporter in reporters:
+        reporter.flush()
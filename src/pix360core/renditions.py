@@ -0,0 +1,248 @@
+from django.conf import settings
+
+from .models import File
+from .classes.storage import image_size, temporary_directory, create_file
+from .paths import user_cache_path
+
+from typing import BinaryIO, List, Optional, Tuple
+from pathlib import Path
+
+import PIL.Image
+
+import contextlib
+import logging
+import os
+import tempfile
+
+# Bounding boxes of the renditions created for every result
+DEFAULT_RENDITION_SIZES = [(320, 160), (1024, 512), (2048, 1024)]
+
+def fit_size(width: int, height: int, max_width: int, max_height: int) -> Tuple[int, int]:
+    """Compute the size of an image scaled down to fit a bounding box, keeping its aspect ratio
+
+    Images are never scaled up.
+
+    Args:
+        width (int): Width of the image
+        height (int): Height of the image
+        max_width (int): Width of the bounding box
+        max_height (int): Height of the bounding box
+
+    Returns:
+        Tuple[int, int]: Width and height of the scaled image
+    """
+    scale = min(max_width / width, max_height / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+@contextlib.contextmanager
+def unlimited_pixels():
+    """Lift PIL's decompression bomb limit while decoding a result
+
+    Panoramas are larger than the limit, but results are created by PIX360
+    itself, so the limit is only lifted for them, and restored afterwards.
+    """
+    previous = PIL.Image.MAX_IMAGE_PIXELS
+    PIL.Image.MAX_IMAGE_PIXELS = None
+
+    try:
+        yield
+    finally:
+        PIL.Image.MAX_IMAGE_PIXELS = previous
+
+def original_size(file: File) -> Tuple[int, int]:
+    """Get the dimensions of an image, reading its header only the first time
+
+    Args:
+        file (File): File object containing the image
+
+    Returns:
+        Tuple[int, int]: Width and height of the image
+    """
+    if file.width is None or file.height is None:
+        with unlimited_pixels():
+            file.width, file.height = image_size(file)
+
+        File.objects.filter(id=file.id).update(width=file.width, height=file.height)
+
+    return file.width, file.height
+
+def open_image(file: File, size: Optional[Tuple[int, int]] = None) -> PIL.Image.Image:
+    """Decode an image file, as RGB
+
+    Args:
+        file (File): File object containing the image
+        size (Optional[Tuple[int, int]], optional): Size the image will be scaled down to, which lets JPEG images be decoded at a reduced size. Defaults to None.
+
+    Returns:
+        PIL.Image.Image: The decoded image
+    """
+    with unlimited_pixels(), file.file.open("rb") as handle:
+        image = PIL.Image.open(handle)
+
+        if size:
+            image.draft("RGB", size)
+
+        return image.convert("RGB")
+
+def create_renditions(file: File) -> List[File]:
+    """Create the preview renditions of an image
+
+    The sizes are read from the PIX360_RENDITION_SIZES setting, a list of
+    (width, height) bounding boxes. The image is decoded once, and each
+    rendition is scaled down from the next larger one.
+
+    Args:
+        file (File): File object containing the image, usually the result of a conversion
+
+    Returns:
+        List[File]: The new renditions, from the largest to the smallest
+    """
+    width, height = original_size(file)
+    sizes = {fit_size(width, height, *size) for size in getattr(settings, "PIX360_RENDITION_SIZES", DEFAULT_RENDITION_SIZES)}
+    sizes = sorted((size for size in sizes if size != (width, height)), reverse=True)
+
+    if not sizes:
+        return []
+
+    image = open_image(file, sizes[0])
+    quality = getattr(settings, "PIX360_RENDITION_QUALITY", 85)
+    renditions = []
+
+    with temporary_directory() as tempdir:
+        for size in sizes:
+            image = image.resize(size, PIL.Image.LANCZOS, reducing_gap=3.0)
+            path = Path(tempdir) / f"preview-{size[0]}x{size[1]}.jpg"
+            image.save(path, "JPEG", quality=quality)
+
+            renditions.append(create_file(path, conversion=file.conversion, mime_type="image/jpeg", rendition_of=file, width=size[0], height=size[1]))
+
+    return renditions
+
+def find_rendition(file: File, width: int, height: int) -> Optional[File]:
+    """Find the smallest stored rendition that an image of the given size can be made from
+
+    Args:
+        file (File): File object containing the original image
+        width (int): Width of the image to make
+        height (int): Height of the image to make
+
+    Returns:
+        Optional[File]: The rendition, or None if only the original is large enough
+    """
+    return file.renditions.filter(width__gte=width, height__gte=height).order_by("width").first()
+
+class RenditionCache:
+    """On-disk cache for renditions of sizes that are not stored
+
+    Renditions are scaled down from the smallest stored rendition that is
+    large enough, or from the original. When the total size of the cache
+    exceeds its limit, the least recently used renditions are evicted.
+    Access times are tracked through the modification times of the files,
+    which works regardless of how the filesystem is mounted.
+    """
+    def __init__(self, directory: str, max_size: int = 512 * 1024 * 1024):
+        """Initialize the RenditionCache
+
+        Args:
+            directory (str): Directory to store the cache in
+            max_size (int, optional): Maximum total size of the cached renditions in bytes. Defaults to 512 MiB.
+        """
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.logger = logging.getLogger("pix360")
+
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    def open(self, file: File, width: int, height: int) -> BinaryIO:
+        """Open a rendition of an image, creating it if it is not cached
+
+        Args:
+            file (File): File object containing the original image
+            width (int): Width of the bounding box
+            height (int): Height of the bounding box
+
+        Returns:
+            BinaryIO: The JPEG encoded rendition, which stays readable even if it is evicted concurrently
+        """
+        size = fit_size(*original_size(file), width, height)
+        path = self.directory / f"{file.id}-{size[0]}x{size[1]}.jpg"
+
+        try:
+            handle = path.open("rb")
+            os.utime(path)
+            return handle
+        except FileNotFoundError:
+            pass
+
+        source = find_rendition(file, *size) or file
+        image = open_image(source, size).resize(size, PIL.Image.LANCZOS, reducing_gap=3.0)
+        handle, temporary = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+
+        with os.fdopen(handle, "wb") as f:
+            image.save(f, "JPEG", quality=getattr(settings, "PIX360_RENDITION_QUALITY", 85))
+
+        os.replace(temporary, path)
+        handle = path.open("rb")
+
+        self.evict()
+
+        return handle
+
+    def evict(self):
+        """Evict the least recently used renditions until the cache is within its size limit
+        """
+        entries = []
+
+        for path in self.directory.glob("*.jpg"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            path.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+
+        if evicted:
+            self.logger.debug(f"Evicted {evicted} renditions from the rendition cache")
+
+_rendition_cache = None
+
+def get_rendition_cache() -> RenditionCache:
+    """Get the process-wide rendition cache, configured from the Django settings
+
+    Settings:
+        PIX360_RENDITION_CACHE_DIR: Directory of the cache (default: pix360/renditions in the cache directory of the user)
+        PIX360_RENDITION_CACHE_SIZE: Maximum total size of the cache in bytes (default: 512 MiB)
+
+    If the directory cannot be used, renditions are cached in a private
+    temporary directory of this process instead.
+
+    Returns:
+        RenditionCache: The rendition cache
+    """
+    global _rendition_cache
+
+    if _rendition_cache is None:
+        directory = getattr(settings, "PIX360_RENDITION_CACHE_DIR", user_cache_path("renditions"))
+        max_size = getattr(settings, "PIX360_RENDITION_CACHE_SIZE", 512 * 1024 * 1024)
+
+        try:
+            if not directory:
+                raise OSError("No cache directory")
+
+            _rendition_cache = RenditionCache(directory, max_size=max_size)
+        except OSError as e:
+            logging.getLogger("pix360").warning(f"Could not use {directory} for the rendition cache, using a temporary directory: {e}")
+            _rendition_cache = RenditionCache(tempfile.mkdtemp(prefix="pix360-renditions-"), max_size=max_size)
+
+    return _rendition_cache
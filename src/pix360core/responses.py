@@ -0,0 +1,200 @@
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, quote_etag
+
+from pix360core.models import File
+from pix360core.classes.storage import local_path
+from pix360core.renditions import fit_size, original_size, find_rendition, get_rendition_cache
+
+from typing import Optional, Tuple
+
+import re
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class RangeFile:
+    """File-like object reading only a byte range of another file
+
+    FileResponse reads it in blocks, so a range is streamed just like a
+    whole file.
+    """
+    def __init__(self, handle, start: int, length: int):
+        """Initialize the RangeFile
+
+        Args:
+            handle: Open binary file
+            start (int): Offset of the first byte
+            length (int): Number of bytes to read
+        """
+        handle.seek(start)
+        self.handle = handle
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.handle.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.handle.close()
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a Range header with a single byte range
+
+    Args:
+        header (str): Value of the Range header
+        size (int): Size of the file in bytes
+
+    Returns:
+        Optional[Tuple[int, int]]: First and last byte of the range, or None if the header is not supported and the whole file should be sent
+
+    Raises:
+        ValueError: If the range cannot be satisfied
+    """
+    match = RANGE_RE.match(header.strip())
+
+    if not match or match.groups() == ("", ""):
+        # Multiple ranges and other units are allowed to be ignored
+        return None
+
+    first, last = match.groups()
+
+    if not first:
+        # Suffix range: the last bytes of the file
+        length = int(last)
+
+        if length == 0 or size == 0:
+            raise ValueError("Empty suffix range")
+
+        return max(size - length, 0), size - 1
+
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+
+    if first > last:
+        raise ValueError("Range not satisfiable")
+
+    return first, last
+
+def serve_file(request, file: File, filename: Optional[str] = None, as_attachment: bool = False) -> HttpResponse:
+    """Build a response sending a file, without loading it into memory
+
+    Files never change once they are stored, so their ID is used as the
+    ETag, and If-None-Match and If-Range can be answered without reading
+    them. Depending on the settings, sending the file is offloaded:
+
+    Settings:
+        PIX360_SENDFILE_HEADER: "X-Sendfile" or "X-Accel-Redirect" to let the web server send local files (default: None, sending them from Django)
+        PIX360_SENDFILE_PREFIX: Internal location prefixed to the storage name of the file for X-Accel-Redirect (default: "/protected/")
+        PIX360_STORAGE_REDIRECT: Whether to redirect to the storage URL of files without a local path, like S3 (default: False)
+
+    Otherwise, the file is streamed in chunks, supporting single byte ranges.
+
+    Args:
+        request (HttpRequest): The request
+        file (File): File object to send
+        filename (Optional[str], optional): Filename for the Content-Disposition header. Defaults to None.
+        as_attachment (bool, optional): Whether the file should be downloaded rather than displayed. Defaults to False.
+
+    Returns:
+        HttpResponse: Response sending the file, or a 304/412/416 response
+    """
+    etag = quote_etag(str(file.id))
+
+    conditional = get_conditional_response(request, etag=etag)
+
+    if conditional is not None:
+        if conditional.status_code == 304:
+            conditional["ETag"] = etag
+
+        return conditional
+
+    path = local_path(file)
+    sendfile = getattr(settings, "PIX360_SENDFILE_HEADER", None)
+
+    if path is None and getattr(settings, "PIX360_STORAGE_REDIRECT", False):
+        return HttpResponseRedirect(file.file.url)
+
+    if sendfile and sendfile.lower() == "x-accel-redirect":
+        response = HttpResponse(content_type=file.mime_type)
+        response["X-Accel-Redirect"] = getattr(settings, "PIX360_SENDFILE_PREFIX", "/protected/") + file.file.name
+
+    elif sendfile and path is not None:
+        response = HttpResponse(content_type=file.mime_type)
+        response[sendfile] = str(path)
+
+    else:
+        size = file.file.size
+        byte_range = None
+
+        if "HTTP_RANGE" in request.META and request.META.get("HTTP_IF_RANGE", etag) == etag:
+            try:
+                byte_range = parse_range(request.META["HTTP_RANGE"], size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = f"bytes */{size}"
+                return response
+
+        handle = file.file.open("rb")
+
+        if byte_range:
+            first, last = byte_range
+            response = FileResponse(RangeFile(handle, first, last - first + 1), status=206, content_type=file.mime_type)
+            response["Content-Range"] = f"bytes {first}-{last}/{size}"
+            response["Content-Length"] = last - first + 1
+        else:
+            response = FileResponse(handle, content_type=file.mime_type)
+            response["Content-Length"] = size
+
+        response["Accept-Ranges"] = "bytes"
+
+    if disposition := content_disposition_header(as_attachment, filename or ""):
+        response["Content-Disposition"] = disposition
+
+    response["ETag"] = etag
+    patch_cache_control(response, private=True)
+
+    return response
+
+def serve_rendition(request, file: File, width: int, height: int) -> HttpResponse:
+    """Build a response sending a JPEG preview of an image, scaled down to fit a bounding box
+
+    A stored rendition of exactly the right size is sent as it is, see
+    create_renditions(). Other sizes are made from the nearest larger
+    rendition and kept in the rendition cache, so the original is only
+    decoded if no rendition is large enough.
+
+    Args:
+        request (HttpRequest): The request
+        file (File): File object containing the original image
+        width (int): Width of the bounding box
+        height (int): Height of the bounding box
+
+    Returns:
+        HttpResponse: Response sending the preview, or a 304 response
+    """
+    size = fit_size(*original_size(file), width, height)
+    rendition = find_rendition(file, *size)
+
+    if rendition and (rendition.width, rendition.height) == size:
+        return serve_file(request, rendition)
+
+    etag = quote_etag(f"{file.id}-{size[0]}x{size[1]}")
+
+    conditional = get_conditional_response(request, etag=etag)
+
+    if conditional is not None:
+        if conditional.status_code == 304:
+            conditional["ETag"] = etag
+
+        return conditional
+
+    response = FileResponse(get_rendition_cache().open(file, width, height), content_type="image/jpeg")
+    response["ETag"] = etag
+    patch_cache_control(response, private=True)
+
+    return response
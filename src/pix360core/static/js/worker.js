@@ -2,7 +2,10 @@ $("#options").hide();
 
 $body = $("body");
 
-var intervals = {};
+// Titles of the conversions waiting for a result, by ID
+var watched = {};
+// Latest known status of each conversion, by ID
+var statuses = {};
 
 function toggleOptions() {
   $("#options").toggle();
@@ -28,54 +31,148 @@ function deletecard(jobid) {
   }
 }
 
-function checkServerForFile(jobid, title, interval) {
+function sessionExpired() {
+  Notification.requestPermission(function (permission) {
+    if (permission === "granted") {
+      var notification = new Notification("PIX360", {
+        body: "Your session has expired. Please log in again.",
+      });
+    }
+  });
+  window.location.href = "/";
+}
+
+function applyStatus(data) {
+  statuses[data.id] = data;
+  var title = watched[data.id];
+  if (title === undefined) {
+    return;
+  }
+  if (data.status == "completed") {
+    delete watched[data.id];
+    finishcard(data.id, title, data.content_type == "video/mp4");
+  } else if (data.status == "failed") {
+    delete watched[data.id];
+    failcard(data.id, title);
+  } else if (data.status == "dismissed") {
+    // Dismissed in another window
+    delete watched[data.id];
+    $("#" + data.id).remove();
+  } else if (data.status == "queued") {
+    $("#" + data.id + " .progress-text").text("Queued");
+  } else {
+    $("#" + data.id + " .progress-text").text(progressText(data.progress));
+  }
+}
+
+var PHASE_NAMES = {
+  download: "Downloading",
+  stitch: "Stitching",
+  encode: "Encoding",
+};
+
+function progressText(progress) {
+  if (!progress) {
+    return "";
+  }
+  var text = PHASE_NAMES[progress.phase] || progress.phase;
+  if (progress.total) {
+    text +=
+      " " + Math.floor((100 * progress.done) / progress.total) + "%";
+  } else if (progress.done) {
+    text += " (" + progress.done + ")";
+  }
+  return text;
+}
+
+function watch(jobid, title) {
+  watched[jobid] = title;
+  if (statuses[jobid]) {
+    // The status arrived before the conversion was added to the page
+    applyStatus(statuses[jobid]);
+  }
+}
+
+function pollStatuses(callback) {
+  var ids = Object.keys(watched);
+  // The server only accepts statusBatchSize IDs per request
+  var batches = [];
+  for (var start = 0; start < ids.length || start == 0; start += statusBatchSize) {
+    batches.push(ids.slice(start, start + statusBatchSize));
+  }
+  var remaining = batches.length;
+  var since = null;
+  for (var b = 0; b < batches.length; b++) {
+    pollBatch(batches[b], function (time) {
+      // Resume from the oldest response, so no change is missed
+      if (since === null || time < since) {
+        since = time;
+      }
+      remaining--;
+      if (remaining == 0 && callback) {
+        callback(since);
+      }
+    });
+  }
+}
+
+function pollBatch(ids, callback) {
   $.ajax({
-    type: "GET",
+    type: "POST",
     cache: false,
-    url: "/status/" + jobid,
+    url: "/status",
+    data: { id: ids },
+    traditional: true,
     statusCode: {
-      403: function () {
-        Notification.requestPermission(function (permission) {
-          if (permission === "granted") {
-            var notification = new Notification("PIX360", {
-              body: "Your session has expired. Please log in again.",
-            });
+      403: sessionExpired,
+      200: function (msg) {
+        var found = {};
+        for (var i = 0; i < msg["conversions"].length; i++) {
+          found[msg["conversions"][i].id] = true;
+          applyStatus(msg["conversions"][i]);
+        }
+        for (var j = 0; j < ids.length; j++) {
+          if (!found[ids[j]] && watched[ids[j]] !== undefined) {
+            var title = watched[ids[j]];
+            delete watched[ids[j]];
+            failcard(ids[j], title);
           }
-        });
-        window.location.href = "/";
-      },
-      404: function () {
-        clearInterval(intervals[jobid]);
-        failcard(jobid, title);
-        return;
-      },
-      200: function (data, tstatus, xhr) {
-        if (data.status == "completed") {
-          clearInterval(intervals[jobid]);
-          finishcard(jobid, title, data.content_type == "video/mp4");
-          return;
-        } else if (data.status == "failed") {
-          clearInterval(intervals[jobid]);
-          failcard(jobid, title);
-          return;
         }
-      },
-      500: function () {
-        clearInterval(intervals[jobid]);
-        failcard(jobid, title);
-        return;
+        callback(msg["time"]);
       },
     },
   });
 }
 
+function subscribe(since) {
+  if (!statusEvents || !window.EventSource) {
+    setInterval(pollStatuses, 3000);
+    return;
+  }
+  var events = new EventSource(
+    "/events" + (since ? "?since=" + encodeURIComponent(since) : "")
+  );
+  events.addEventListener("status", function (e) {
+    applyStatus(JSON.parse(e.data));
+  });
+  events.onerror = function () {
+    if (events.readyState === EventSource.CLOSED) {
+      // The server refused the stream, fall back to polling
+      setInterval(pollStatuses, 3000);
+    } else {
+      // The browser reconnects by itself, catch up in the meantime
+      pollStatuses();
+    }
+  };
+}
+
 function addcard(jobid, title) {
   var text =
     '<div class="col-sm-3" id="' +
     jobid +
     '"> <div class="card"> <img class="card-img-top img-fluid" src="/static/img/spinner.gif" alt="Creating Image"><div style="text-align: center; font-weight: bold;" class="card-block">' +
     title +
-    "</div> </div> </div>";
+    '</div><div style="text-align: center;" class="card-block progress-text"></div> </div> </div>';
   $("#cards").append(text);
   $("html,body").animate({ scrollTop: $("#" + jobid).offset().top });
 }
@@ -85,9 +182,8 @@ function restartconversion(jobid, title) {
     type: "GET",
     url: "/retry/" + jobid,
     success: function (msg) {
-      var interval = setInterval(checkServerForFile, 3000, msg.id, title);
-      intervals[msg.id] = interval;
       addcard(msg.id, title);
+      watch(msg.id, title);
       deletecard(jobid);
     },
   });
@@ -164,28 +260,35 @@ $("#theform").submit(function (event) {
       data: $("#theform").serialize(),
       success: function (msg) {
         var title = $("#title").val() ? $("#title").val() : "No title";
-        var interval = setInterval(checkServerForFile, 3000, msg.id, title);
-        intervals[msg.id] = interval;
         addcard(msg.id, title);
+        watch(msg.id, title);
       },
     });
   }
 });
 
-function initialize() {
+function initialize(cursor) {
   $.ajax({
     type: "GET",
     url: "/list",
+    data: cursor ? { cursor: cursor } : {},
     success: function (msg) {
       for (var i = 0; i < msg["conversions"].length; i++) {
         var job = msg["conversions"][i];
         if (job.status >= 0) {
           var title = job.title ? job.title : "No title";
           addcard(job.id, title);
-          var interval = setInterval(checkServerForFile, 3000, job.id, title);
-          intervals[job.id] = interval;
+          // Finished conversions are only fetched once, to show their result,
+          // as applyStatus() stops watching them
+          watch(job.id, title);
         }
       }
+      if (msg["next"]) {
+        initialize(msg["next"]);
+      } else {
+        // Catch up once, then get changes pushed from the server
+        pollStatuses(subscribe);
+      }
     },
   });
 }
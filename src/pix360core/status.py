@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import OuterRef, QuerySet, Subquery
+from django.db.models.functions import Coalesce
+
+from pix360core.models import Conversion, ConversionStatus, File
+
+from typing import Iterator, Optional
+from datetime import datetime, timedelta
+
+import json
+import time
+
+STATUS_NAMES = {
+    ConversionStatus.PENDING: "queued",
+    ConversionStatus.DONE: "completed",
+    ConversionStatus.FAILED: "failed",
+    ConversionStatus.DISMISSED: "dismissed",
+    ConversionStatus.DOWNLOADING: "downloading",
+    ConversionStatus.STITCHING: "stitching",
+    ConversionStatus.DOWNLOADED: "downloaded",
+}
+
+def conversion_statuses(user, ids: Optional[list] = None) -> QuerySet:
+    """Get the conversions of a user with everything needed for their status, in a single query
+
+    The result file, which for duplicates belongs to the original
+    conversion, is joined as the result_name and result_mime_type
+    annotations, and the ownership check is part of the query.
+
+    Args:
+        user (User): Owner of the conversions
+        ids (Optional[list], optional): IDs of the conversions to get. Defaults to None, meaning all of them.
+
+    Returns:
+        QuerySet: The conversions, see status_payload()
+    """
+    results = File.objects.filter(conversion=Coalesce(OuterRef("duplicate_of"), OuterRef("pk")), is_result=True)
+
+    conversions = Conversion.objects.filter(user=user).only("id", "status", "updated", "progress").annotate(
+        result_name=Subquery(results.values("file")[:1]),
+        result_mime_type=Subquery(results.values("mime_type")[:1]),
+    )
+
+    if ids is not None:
+        conversions = conversions.filter(id__in=ids)
+
+    return conversions
+
+def status_payload(conversion: Conversion) -> dict:
+    """Describe the status of a conversion for the frontend
+
+    Args:
+        conversion (Conversion): Conversion from conversion_statuses()
+
+    Returns:
+        dict: The status, with the URL and content type of the result once it is done, or the progress while it is in progress
+    """
+    payload = {
+        'id': conversion.id,
+        'status': STATUS_NAMES.get(conversion.status, "processing"),
+        'updated': conversion.updated,
+    }
+
+    if conversion.status == ConversionStatus.DONE:
+        if conversion.result_name:
+            payload['result'] = File._meta.get_field("file").storage.url(conversion.result_name)
+            payload['content_type'] = conversion.result_mime_type
+        else:
+            # The result file was deleted
+            payload['status'] = "failed"
+    elif conversion.progress:
+        payload['progress'] = conversion.progress
+
+    return payload
+
+def status_events(user, since: datetime) -> Iterator[str]:
+    """Stream the status changes of the conversions of a user as Server-Sent Events
+
+    The database is checked every PIX360_EVENTS_POLL_INTERVAL seconds with
+    a single query, which replaces the per-conversion polling of all the
+    client's open conversions. Each event carries the update time of the
+    conversion as its ID, so a reconnecting client resumes where it left
+    off through Last-Event-ID. The stream ends after PIX360_EVENTS_TIMEOUT
+    seconds, upon which the client reconnects, so a web worker is never
+    held indefinitely.
+
+    Args:
+        user (User): Owner of the conversions
+        since (datetime): Only changes after this time are sent
+
+    Yields:
+        str: Event stream chunks
+    """
+    poll_interval = getattr(settings, "PIX360_EVENTS_POLL_INTERVAL", 2)
+    deadline = time.monotonic() + getattr(settings, "PIX360_EVENTS_TIMEOUT", 300)
+    keepalive = time.monotonic()
+
+    # Transactions committing late can make changes appear with an update time in the past
+    overlap = timedelta(seconds=getattr(settings, "PIX360_EVENTS_OVERLAP", 5))
+    sent = {}
+
+    yield f"retry: {int(poll_interval * 1000)}\n\n"
+
+    while time.monotonic() < deadline:
+        for conversion in conversion_statuses(user).filter(updated__gt=since - overlap).order_by("updated"):
+            if sent.get(conversion.id) == conversion.updated:
+                continue
+
+            sent[conversion.id] = conversion.updated
+            since = max(since, conversion.updated)
+            keepalive = time.monotonic()
+
+            yield f"id: {conversion.updated.isoformat()}\nevent: status\ndata: {json.dumps(status_payload(conversion), cls=DjangoJSONEncoder)}\n\n"
+
+        sent = {pk: updated for pk, updated in sent.items() if updated > since - overlap}
+
+        if time.monotonic() - keepalive > 15:
+            # Keeps proxies from closing the idle connection
+            keepalive = time.monotonic()
+            yield ": keepalive\n\n"
+
+        time.sleep(poll_interval)
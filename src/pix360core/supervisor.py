@@ -0,0 +1,128 @@
+from .worker import Worker, STAGE_ALL
+
+from django.conf import settings
+from django.db import connections
+
+from typing import List, Optional
+
+import logging
+import signal
+import threading
+import time
+
+class Supervisor:
+    """Runs and supervises a number of Worker processes
+
+    Workers that exit, either because they crashed or because they reached
+    their maximum number of jobs, are replaced by new ones. Repeated crashes
+    are restarted with an increasing delay. On SIGTERM or SIGINT, all
+    workers are asked to finish their current conversion and exit.
+    """
+    def __init__(self, concurrency: int = 1, max_jobs: Optional[int] = None, size_classes: Optional[List[str]] = None, stage: str = STAGE_ALL, shutdown_timeout: Optional[float] = None):
+        """Initialize the Supervisor
+
+        Args:
+            concurrency (int, optional): Number of worker processes to run. Defaults to 1.
+            max_jobs (Optional[int], optional): Number of conversions after which a worker is replaced. Defaults to None, meaning no limit.
+            size_classes (Optional[List[str]], optional): Only process conversions of these size classes, and those without a size class. Defaults to None, meaning all conversions.
+            stage (str, optional): Pipeline stage to process, see Worker. Defaults to STAGE_ALL.
+            shutdown_timeout (Optional[float], optional): Seconds to wait for workers to finish on shutdown before killing them. Defaults to the PIX360_WORKER_SHUTDOWN_TIMEOUT setting, or no limit.
+        """
+        self.concurrency = concurrency
+        self.max_jobs = max_jobs
+        self.size_classes = size_classes
+        self.stage = stage
+        self.shutdown_timeout = shutdown_timeout or getattr(settings, "PIX360_WORKER_SHUTDOWN_TIMEOUT", None)
+        self.workers: List[Worker] = []
+        self.failures = 0
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger("pix360")
+
+    def create_worker(self) -> Worker:
+        """Create a worker process, without starting it
+
+        Returns:
+            Worker: The new worker
+        """
+        return Worker(max_jobs=self.max_jobs, size_classes=self.size_classes, stage=self.stage)
+
+    def spawn(self) -> Worker:
+        """Start a new worker process
+
+        Returns:
+            Worker: The started worker
+        """
+        # Database connections must not be shared with the forked process
+        connections.close_all()
+
+        worker = self.create_worker()
+        worker.start()
+        self.workers.append(worker)
+
+        self.logger.info(f"Started worker {worker.pid}")
+        return worker
+
+    def reap(self):
+        """Remove exited workers, and delay restarts after repeated crashes
+        """
+        crashed = False
+
+        for worker in [worker for worker in self.workers if not worker.is_alive()]:
+            worker.join()
+            self.workers.remove(worker)
+
+            if worker.exitcode == 0:
+                self.failures = 0
+                if not self.stopping.is_set():
+                    self.logger.info(f"Worker {worker.pid} exited, replacing it")
+            else:
+                self.failures += 1
+                crashed = True
+                self.logger.error(f"Worker {worker.pid} died with exit code {worker.exitcode}")
+
+        if crashed and not self.stopping.is_set():
+            self.stopping.wait(min(60, 2 ** (self.failures - 1)))
+
+    def stop(self, *args):
+        """Ask the supervisor to shut down
+
+        Can be used as a signal handler.
+        """
+        self.stopping.set()
+
+    def shutdown(self):
+        """Stop all workers, waiting for them to finish their current conversion
+        """
+        self.logger.info("Shutting down workers")
+
+        # Workers handle SIGTERM by exiting after their current conversion
+        for worker in self.workers:
+            worker.terminate()
+
+        deadline = time.monotonic() + self.shutdown_timeout if self.shutdown_timeout else None
+
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+            if worker.is_alive():
+                self.logger.warning(f"Worker {worker.pid} did not stop in time, killing it")
+                worker.kill()
+                worker.join()
+
+        self.workers.clear()
+
+    def run(self):
+        """Run the workers until SIGTERM or SIGINT is received
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        try:
+            while not self.stopping.is_set():
+                while len(self.workers) < self.concurrency and not self.stopping.is_set():
+                    self.spawn()
+
+                self.stopping.wait(1)
+                self.reap()
+        finally:
+            self.shutdown()
@@ -1,7 +1,1583 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
+from django.core.files.base import ContentFile
+from django.conf import settings
+from django.urls import reverse
+from django.db import connection
+from django.db.models import ProtectedError, QuerySet
+
+from .classes.asynchttp import AsyncHTTPClient
+from .classes.exceptions import DownloadError, StitchingError
+from .classes.http import HTTPRequest, CachedResponse, TileFetcher, HTTPResponseError, backoff_delay, retry_delay
+from .classes.httpcache import HTTPCache, get_http_cache
+from .classes import httpcache
+from .classes.modules import DownloaderModule
+from .loader import Loader, LazyDownloader, ENTRY_POINT_GROUP
+from . import loader
+from .deduplication import normalize_url, conversion_fingerprint, create_conversion
+from .responses import parse_range
+from . import responses
+from .renditions import fit_size, get_rendition_cache
+from . import renditions
+from .classes.png import PNGWriter
+from .classes.projection import cubemap_projection, face_directions, ProjectionCache
+from .classes.stitching import BaseStitcher, BlenderStitcher, NumpyStitcher, PILStitcher
+from .classes.storage import PathFile, create_file, link_or_copy, local_path
+from .classes import storage
+from .models import File, Conversion, ConversionStatus, User
+from .models.content import checkpoint_key
+from .progress import ProgressReporter, get_progress_reporter, flush_progress
+from .processes import StitcherPool, run_command
+from .notify import SocketNotifier, get_notifier, notify_workers
+from .pagination import encode_cursor
+from .status import conversion_statuses, status_payload
+from .supervisor import Supervisor
+from . import notify, progress
+from .worker import Worker
+
+import PIL.Image
+import numpy
+
+import asyncio
+import hashlib
+import importlib.metadata
+import json
+import http.server
+import io
+import logging
+import tempfile
+import threading
+import math
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import time
+import uuid
+
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
 # TODO: Add some meaningful tests
 
 class Test(TestCase):
     def test(self):
-        self.assertEqual(1, 1)
\ No newline at end of file
+        self.assertEqual(1, 1)
+
+class DeduplicationTest(SimpleTestCase):
+    def test_equivalent_urls_share_fingerprint(self):
+        self.assertEqual(normalize_url("HTTPS://Tours.Example.com:443/tour?b=2&a=1&utm_source=x#pano"), "https://tours.example.com/tour?a=1&b=2#pano")
+        self.assertEqual(conversion_fingerprint("https://example.com/tour#scene=1"), conversion_fingerprint("https://EXAMPLE.com:443/tour#scene=1"))
+        self.assertNotEqual(conversion_fingerprint("https://example.com/tour#scene=1"), conversion_fingerprint("https://example.com/tour#scene=2"))
+        self.assertNotEqual(conversion_fingerprint("https://example.com/tour"), conversion_fingerprint("https://example.com/tour", "other.downloader"))
+
+    def test_only_relevant_properties_count(self):
+        with self.settings(PIX360_DEDUPLICATION_PROPERTIES=["resolution"]):
+            self.assertEqual(conversion_fingerprint("https://example.com/", properties={"resolution": 8192, "note": "a"}), conversion_fingerprint("https://example.com/", properties={"resolution": 8192}))
+            self.assertNotEqual(conversion_fingerprint("https://example.com/", properties={"resolution": 4096}), conversion_fingerprint("https://example.com/", properties={"resolution": 8192}))
+
+class MediaTestCase(TestCase):
+    """Test case storing uploaded files in a temporary MEDIA_ROOT
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        media = self.settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create(email="user@example.com")
+
+class DuplicateTest(MediaTestCase):
+    def test_duplicates_share_the_result_of_a_protected_original(self):
+        with self.settings(PIX360_DEDUPLICATION_WINDOW=3600):
+            original = create_conversion("https://example.com/tour#pano=1", "Tour", self.user)
+            original.status = ConversionStatus.DONE
+            original.save()
+            result = File.objects.create(conversion=original, file=ContentFile(b"result", name="result.png"), mime_type="image/png", is_result=True)
+
+            duplicate = create_conversion("https://EXAMPLE.com/tour#pano=1", "Tour", self.user)
+            other = create_conversion("https://example.com/tour#pano=2", "Tour", self.user)
+
+        self.assertEqual(duplicate.status, ConversionStatus.DONE)
+        self.assertEqual(duplicate.result, result)
+        self.assertIsNone(other.duplicate_of)
+
+        with self.assertRaises(ProtectedError):
+            original.delete()
+
+def direction_color(x, y, z):
+    norm = numpy.sqrt(x * x + y * y + z * z)
+    return numpy.stack([(x / norm + 1) * 127, (y / norm + 1) * 127, (z / norm + 1) * 127], -1)
+
+def synthetic_cubemap(dim):
+    coords = (numpy.arange(dim) + 0.5) / dim * 2 - 1
+    u, v = numpy.meshgrid(coords, coords)
+
+    return numpy.stack([direction_color(*face_directions(face, u, v)) for face in range(6)])
+
+def expected_equirectangular(width, height):
+    lon, lat = numpy.meshgrid(((numpy.arange(width) + 0.5) / width * 2 - 1) * math.pi, (0.5 - (numpy.arange(height) + 0.5) / height) * math.pi)
+    return direction_color(numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat), numpy.cos(lat) * numpy.cos(lon))
+
+class CubemapProjectionTest(SimpleTestCase):
+    def test_projection_matches_sphere(self):
+        dim = 64
+        width, height = dim * 4, dim * 2
+
+        face, rows, cols = cubemap_projection(dim, width, height)
+        output = synthetic_cubemap(dim)[face, rows, cols]
+
+        self.assertLess(numpy.abs(output - expected_equirectangular(width, height)).max(), 4)
+
+    def test_interpolation_is_seamless(self):
+        cube = synthetic_cubemap(16).astype(numpy.uint8)
+        expected = expected_equirectangular(256, 128)
+        cache = ProjectionCache()
+
+        errors = {
+            interpolation: numpy.abs(cache.get(16, 256, 128, interpolation=interpolation).gather(cube) - expected).max()
+            for interpolation in ("nearest", "bilinear", "bicubic")
+        }
+
+        self.assertLess(errors["bilinear"], errors["nearest"] / 2)
+        self.assertLess(errors["bicubic"], errors["nearest"] / 2)
+
+    def test_rotation_turns_view(self):
+        face, _, _ = cubemap_projection(16, 64, 32)
+        rotated, _, _ = cubemap_projection(16, 64, 32, (0, 180, 0))
+
+        self.assertEqual(face[16, 32], 2)
+        self.assertEqual(rotated[16, 32], 0)
+
+class ProjectionCacheTest(SimpleTestCase):
+    def test_maps_are_reused_and_persisted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ProjectionCache(directory=directory)
+            projection = cache.get(16, 64, 32)
+
+            self.assertIs(cache.get(16, 64, 32), projection)
+            self.assertIsInstance(projection.face, numpy.memmap)
+
+            reloaded = ProjectionCache(directory=directory).get(16, 64, 32)
+            numpy.testing.assert_array_equal(reloaded.cols, cubemap_projection(16, 64, 32)[2])
+
+    def test_persisted_maps_respect_disk_budget(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ProjectionCache(directory=directory)
+            first = cache.get(16, 64, 32)
+            size = first.nbytes
+
+            cache = ProjectionCache(directory=directory, max_disk_bytes=3 * size)
+            cache.get(16, 64, 32, (0, 90, 0))
+            os.utime(cache.path(first.key), (0, 0))
+            os.utime(cache.path(cache.key(16, 64, 32, (0, 90, 0))), (1, 1))
+
+            # Loading the first map again makes the second the least recently used
+            ProjectionCache(directory=directory).get(16, 64, 32)
+            third = cache.get(16, 64, 32, (0, 180, 0))
+            numpy.testing.assert_array_equal(third.face, cubemap_projection(16, 64, 32, (0, 180, 0))[0])
+
+            self.assertTrue(cache.path(first.key).is_dir())
+            self.assertFalse(cache.path(cache.key(16, 64, 32, (0, 90, 0))).exists())
+            self.assertTrue(cache.path(third.key).is_dir())
+
+    def test_persistence_failures_are_cache_misses(self):
+        with tempfile.NamedTemporaryFile() as file:
+            cache = ProjectionCache(directory=os.path.join(file.name, "projections"))
+
+            with self.assertLogs("pix360", "WARNING"):
+                projection = cache.get(16, 64, 32)
+
+            numpy.testing.assert_array_equal(projection.face, cubemap_projection(16, 64, 32)[0])
+            self.assertIs(cache.get(16, 64, 32), projection)
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(numpy, "save", side_effect=OSError("No space left on device")):
+            cache = ProjectionCache(directory=directory)
+
+            with self.assertLogs("pix360", "WARNING"):
+                projection = cache.get(16, 64, 32)
+
+            numpy.testing.assert_array_equal(projection.rows, cubemap_projection(16, 64, 32)[1])
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_lru_respects_byte_budget(self):
+        cache = ProjectionCache(max_bytes=1)
+        first = cache.get(16, 64, 32)
+        cache.get(16, 64, 32, (0, 90, 0))
+
+        self.assertEqual(len(cache.maps), 1)
+        self.assertIsNot(cache.get(16, 64, 32), first)
+
+class HTTPCacheTest(SimpleTestCase):
+    def test_responses_are_keyed_and_revalidated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = HTTPCache(directory)
+            cache.store("http://tiles/0.jpg", {"Accept": "image/jpeg"}, {"ETag": '"a"', "Cache-Control": "max-age=0"}, b"tile")
+
+            self.assertIsNone(cache.lookup("http://tiles/0.jpg"))
+            self.assertIsNone(cache.store("http://tiles/1.jpg", {}, {"Cache-Control": "no-store"}, b"tile"))
+
+            entry = HTTPCache(directory).lookup("http://tiles/0.jpg", {"accept": "image/jpeg"})
+            self.assertFalse(entry.fresh)
+            self.assertEqual(entry.validators(), {"If-None-Match": '"a"'})
+            self.assertEqual(entry.read(), b"tile")
+
+            entry = cache.refresh(entry, {"Cache-Control": "max-age=60"})
+            self.assertTrue(cache.lookup("http://tiles/0.jpg", {"Accept": "image/jpeg"}).fresh)
+
+    def test_least_recently_used_blobs_are_evicted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = HTTPCache(directory, max_size=8)
+            cache.store("http://tiles/0.jpg", {}, {"ETag": '"0"'}, b"0000")
+            cache.store("http://tiles/1.jpg", {}, {"ETag": '"1"'}, b"1111")
+            cache.store("http://tiles/copy.jpg", {}, {"ETag": '"1"'}, b"1111")
+            cache.lookup("http://tiles/0.jpg")
+            cache.store("http://tiles/2.jpg", {}, {"ETag": '"2"'}, b"2222")
+
+            self.assertIsNotNone(cache.lookup("http://tiles/0.jpg"))
+            self.assertIsNone(cache.lookup("http://tiles/1.jpg"))
+            self.assertIsNone(cache.lookup("http://tiles/copy.jpg"))
+            self.assertFalse(cache.blob_path(hashlib.sha256(b"1111").hexdigest()).exists())
+
+    def test_only_revalidatable_responses_get_a_default_ttl(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = HTTPCache(directory)
+
+            self.assertIsNone(cache.store("http://api/tour.json", {}, {"Content-Type": "application/json"}, b"{}"))
+            self.assertTrue(cache.store("http://tiles/0.jpg", {}, {"Last-Modified": "Sun, 18 Oct 2026 09:00:00 GMT"}, b"tile").fresh)
+            self.assertTrue(cache.store("http://api/tour.json", {}, {"Cache-Control": "max-age=60"}, b"{}").fresh)
+
+class CacheDirectoryTest(SimpleTestCase):
+    def setUp(self):
+        for module, name in ((httpcache, "_http_cache"), (renditions, "_rendition_cache")):
+            patch = mock.patch.object(module, name, None)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_caches_default_to_the_cache_of_the_user(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(os.environ, {"XDG_CACHE_HOME": directory}):
+            self.assertEqual(get_http_cache().directory, Path(directory) / "pix360" / "http")
+            self.assertEqual(get_rendition_cache().directory, Path(directory) / "pix360" / "renditions")
+            self.assertEqual(SocketNotifier().directory, Path(directory) / "pix360" / "workers")
+            self.assertEqual((Path(directory) / "pix360" / "http").stat().st_mode & 0o777, 0o700)
+
+    def test_unusable_directories_disable_the_cache(self):
+        with tempfile.NamedTemporaryFile() as file, self.settings(PIX360_HTTP_CACHE_DIR=os.path.join(file.name, "http"), PIX360_RENDITION_CACHE_DIR=os.path.join(file.name, "renditions")):
+            with self.assertLogs("pix360", "WARNING"):
+                self.assertIsNone(get_http_cache())
+                rendition_cache = get_rendition_cache()
+
+            self.addCleanup(shutil.rmtree, rendition_cache.directory)
+            self.assertTrue(rendition_cache.directory.is_dir())
+            self.assertIsNone(get_http_cache())
+
+            with TileFetcher() as fetcher:
+                self.assertIsNone(fetcher.cache)
+
+            self.assertIsNone(AsyncHTTPClient().cache)
+
+class HTTPRequestTest(SimpleTestCase):
+    def test_responses_are_streamed_unless_cached(self):
+        server = start_server(self, {"/tour.json": [(200, {"Cache-Control": "max-age=60"}, b"{}")]})
+
+        for _ in range(2):
+            with HTTPRequest(server.url + "/tour.json").open() as response:
+                self.assertNotIsInstance(response, CachedResponse)
+                self.assertEqual(response.read(), b"{}")
+
+        self.assertEqual(len(server.requests), 2)
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(PIX360_HTTP_CACHE_DIR=directory):
+            httpcache._http_cache = None
+            self.addCleanup(setattr, httpcache, "_http_cache", None)
+
+            for _ in range(2):
+                self.assertEqual(HTTPRequest(server.url + "/tour.json").open(cache=True).read(), b"{}")
+
+        self.assertEqual(len(server.requests), 3)
+
+class RangeTest(SimpleTestCase):
+    def test_byte_ranges(self):
+        self.assertEqual(parse_range("bytes=10-19", 100), (10, 19))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=50-500", 100), (50, 99))
+        self.assertEqual(parse_range("bytes=-5", 100), (95, 99))
+        self.assertIsNone(parse_range("bytes=0-1,5-6", 100))
+
+        with self.assertRaises(ValueError):
+            parse_range("bytes=100-", 100)
+
+class ServeFileTest(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.conversion = Conversion.objects.create(url="https://tours.example.com/", user=self.user, title="Tour", status=ConversionStatus.DONE)
+        self.content = bytes(range(100))
+        self.result = File.objects.create(conversion=self.conversion, file=ContentFile(self.content, name="result.png"), mime_type="image/png", is_result=True)
+        self.etag = f'"{self.result.id}"'
+
+        self.client.force_login(self.user)
+
+    def get(self, name="conversion_result", **headers):
+        return self.client.get(reverse(name, args=[self.conversion.id]), headers=headers)
+
+    def test_files_are_streamed_whole(self):
+        for name in ("conversion_result", "conversion_download"):
+            response = self.get(name)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), self.content)
+            self.assertEqual(response["Content-Length"], "100")
+            self.assertEqual(response["Accept-Ranges"], "bytes")
+            self.assertEqual(response["ETag"], self.etag)
+
+        self.assertIn("attachment", response["Content-Disposition"])
+
+    def test_ranges(self):
+        response = self.get(Range="bytes=10-19")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/100")
+        self.assertEqual(response["Content-Length"], "10")
+        self.assertEqual(b"".join(response.streaming_content), self.content[10:20])
+
+        response = self.get("conversion_download", Range="bytes=-5", If_Range=self.etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.content[95:])
+
+        response = self.get(Range="bytes=100-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */100")
+
+        response = self.get(Range="bytes=10-19", If_Range='"outdated"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+
+    def test_unchanged_files_are_not_sent(self):
+        response = self.get(If_None_Match=self.etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], self.etag)
+        self.assertEqual(response.content, b"")
+
+    def test_sending_is_offloaded(self):
+        with self.settings(PIX360_SENDFILE_HEADER="X-Sendfile"):
+            response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Sendfile"], str(local_path(self.result)))
+        self.assertEqual(response.content, b"")
+
+        with self.settings(PIX360_SENDFILE_HEADER="X-Accel-Redirect", PIX360_SENDFILE_PREFIX="/internal/media/"):
+            response = self.get("conversion_download")
+
+        self.assertEqual(response["X-Accel-Redirect"], "/internal/media/" + self.result.file.name)
+        self.assertEqual(response["ETag"], self.etag)
+        self.assertIn("attachment", response["Content-Disposition"])
+        self.assertEqual(response.content, b"")
+
+        with self.settings(PIX360_STORAGE_REDIRECT=True):
+            self.assertEqual(self.get().status_code, 200)
+
+            with mock.patch.object(responses, "local_path", return_value=None):
+                response = self.get()
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], self.result.file.url)
+
+    def test_conversions_without_result(self):
+        self.result.delete()
+
+        for name in ("conversion_result", "conversion_download"):
+            self.assertEqual(self.get(name).status_code, 404)
+
+class RenditionTest(SimpleTestCase):
+    def test_fit_size_keeps_aspect_ratio_and_never_upscales(self):
+        self.assertEqual(fit_size(4000, 2000, 500, 500), (500, 250))
+        self.assertEqual(fit_size(4000, 2000, 1000, 100), (200, 100))
+        self.assertEqual(fit_size(4000, 2000, 9000, 9000), (4000, 2000))
+
+class RenditionServingTest(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_directory = Path(directory.name)
+
+        patch = mock.patch.object(renditions, "_rendition_cache", None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.conversion = Conversion.objects.create(url="https://tours.example.com/", user=self.user, status=ConversionStatus.DONE)
+        path = Path(directory.name) / "result.png"
+        PIL.Image.fromarray(numpy.random.default_rng(0).integers(0, 256, (200, 400, 3), dtype=numpy.uint8)).save(path)
+        self.result = create_file(path, conversion=self.conversion, mime_type="image/png", is_result=True)
+
+        self.client.force_login(self.user)
+
+    def get_rendition(self, width, height):
+        with self.settings(PIX360_RENDITION_CACHE_DIR=str(self.cache_directory)):
+            response = self.client.get(reverse("conversion_download_resized", args=[self.conversion.id, width, height]))
+
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content)
+
+    def test_renditions_are_created_for_every_size(self):
+        limit = PIL.Image.MAX_IMAGE_PIXELS
+
+        with self.settings(PIX360_RENDITION_SIZES=[(100, 100), (200, 100), (800, 800)]):
+            created = renditions.create_renditions(self.result)
+
+        self.assertEqual([(file.width, file.height) for file in created], [(200, 100), (100, 50)])
+        self.assertEqual(PIL.Image.MAX_IMAGE_PIXELS, limit)
+
+        for file in created:
+            self.assertEqual(file.rendition_of, self.result)
+
+            with file.file.open("rb") as handle:
+                self.assertEqual(PIL.Image.open(handle).size, (file.width, file.height))
+
+    def test_decompression_bomb_limit_is_restored_after_errors(self):
+        limit = PIL.Image.MAX_IMAGE_PIXELS
+        file = File.objects.create(conversion=self.conversion, file=ContentFile(b"not an image", name="broken.png"))
+
+        with self.assertRaises(PIL.UnidentifiedImageError):
+            renditions.open_image(file)
+
+        self.assertEqual(PIL.Image.MAX_IMAGE_PIXELS, limit)
+
+    def test_stored_renditions_are_served_as_is(self):
+        with self.settings(PIX360_RENDITION_SIZES=[(200, 100)]):
+            rendition, = renditions.create_renditions(self.result)
+
+        with mock.patch.object(renditions, "open_image", side_effect=AssertionError("decoded")):
+            body = self.get_rendition(200, 100)
+
+        with rendition.file.open("rb") as handle:
+            self.assertEqual(body, handle.read())
+
+        self.assertEqual(list(self.cache_directory.iterdir()), [])
+
+    def test_other_sizes_are_cached_reused_and_evicted(self):
+        first = self.get_rendition(150, 150)
+        second = self.get_rendition(140, 140)
+
+        first_path = self.cache_directory / f"{self.result.id}-150x75.jpg"
+        second_path = self.cache_directory / f"{self.result.id}-140x70.jpg"
+        self.assertEqual(first_path.read_bytes(), first)
+        self.assertEqual(second_path.read_bytes(), second)
+        self.assertEqual(PIL.Image.open(io.BytesIO(first)).size, (150, 75))
+
+        # The first rendition is the least recently used until it is reused
+        os.utime(first_path, (0, 0))
+        os.utime(second_path, (1, 1))
+        limit = first_path.stat().st_size + second_path.stat().st_size
+        renditions._rendition_cache = None
+
+        with self.settings(PIX360_RENDITION_CACHE_SIZE=limit), mock.patch.object(renditions, "open_image", wraps=renditions.open_image) as decode:
+            self.assertEqual(self.get_rendition(150, 150), first)
+            decode.assert_not_called()
+
+            self.get_rendition(130, 130)
+            decode.assert_called_once()
+
+        self.assertTrue(first_path.exists())
+        self.assertFalse(second_path.exists())
+        self.assertTrue((self.cache_directory / f"{self.result.id}-130x65.jpg").exists())
+        self.assertLessEqual(sum(path.stat().st_size for path in self.cache_directory.iterdir()), limit)
+
+class PNGWriterTest(SimpleTestCase):
+    def test_streamed_png_roundtrips(self):
+        image = numpy.random.default_rng(0).integers(0, 256, (50, 40, 3), dtype=numpy.uint8)
+        output = io.BytesIO()
+
+        with PNGWriter(output, 40, 50, chunk_size=512, band=7) as writer:
+            writer.write(image[:20])
+            writer.write(image[20:])
+
+        output.seek(0)
+        numpy.testing.assert_array_equal(numpy.asarray(PIL.Image.open(output)), image)
+
+    def test_incomplete_image_is_rejected(self):
+        writer = PNGWriter(io.BytesIO(), 4, 4)
+        writer.write(numpy.zeros((2, 4, 3), dtype=numpy.uint8))
+
+        with self.assertRaises(ValueError):
+            writer.close()
+
+class LoaderTest(SimpleTestCase):
+    def test_urls_are_routed_by_index(self):
+        class Hosted(DownloaderModule):
+            identifier = "hosted"
+            hostnames = ["*.example.com"]
+
+        class Prefixed(DownloaderModule):
+            identifier = "prefixed"
+            url_prefixes = ["https://tours.example.org/view/"]
+
+        class Scanned(DownloaderModule):
+            identifier = "scanned"
+            tested = 0
+
+            @classmethod
+            def test_url(cls, url):
+                cls.tested += 1
+                return cls.CERTAINTY_POSSIBLE if "pano" in url else cls.CERTAINTY_UNSUPPORTED
+
+        class Broken(DownloaderModule):
+            identifier = "broken"
+
+        loader = Loader([Hosted, Prefixed, Scanned, Broken])
+
+        with self.assertLogs("pix360", "ERROR"):
+            self.assertEqual([type(d) for d, _ in loader.find_downloader("https://a.example.com/x")], [Hosted])
+            self.assertEqual([type(d) for d, _ in loader.find_downloader("https://TOURS.example.org/view/1?pano")], [Prefixed, Scanned])
+            self.assertEqual(loader.find_downloader("https://tours.example.org/edit/1"), [])
+
+        loader.find_downloader("https://tours.example.org/edit/1")
+        self.assertEqual(Scanned.tested, 3)
+
+        with self.assertLogs("pix360", "ERROR"):
+            loader.find_downloader("https://tours.example.org/edit/1#pano")
+
+        self.assertEqual(Scanned.tested, 4)
+        self.assertIsInstance(loader.resolve_downloader_identifier("prefixed"), Prefixed)
+
+class StitcherTest(MediaTestCase):
+    FACE_COLORS = {"back": (255, 0, 0), "right": (0, 255, 0), "front": (0, 0, 255), "left": (255, 255, 0), "up": (255, 0, 255), "down": (0, 255, 255)}
+
+    def setUp(self):
+        super().setUp()
+
+        self.conversion = Conversion.objects.create(url="https://tours.example.com/", user=self.user)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def create_image(self, name, image):
+        path = self.directory / name
+        image.save(path)
+        return create_file(path, conversion=self.conversion, mime_type="image/png")
+
+    def open_result(self, file):
+        with file.file.open("rb") as handle:
+            return numpy.asarray(PIL.Image.open(handle).convert("RGB"))
+
+    def create_cubemap(self):
+        return [self.create_image(f"{face}.png", PIL.Image.new("RGB", (16, 16), self.FACE_COLORS[face])) for face in BaseStitcher.CUBEMAP_ORDER]
+
+    def test_cubemap_faces_are_oriented_like_cube2sphere(self):
+        faces = self.create_cubemap()
+
+        with self.settings(PIX360_PROJECTION_CACHE_DIR=None), mock.patch("pix360core.classes.projection._projection_cache", None):
+            result = NumpyStitcher().cubemap_to_equirectangular(faces)
+            resized = NumpyStitcher().cubemap_to_equirectangular(faces, size=(96, 48))
+            rotated = NumpyStitcher().cubemap_to_equirectangular(faces, rotation=(0, 180, 0))
+
+        self.assertEqual(result.mime_type, "image/png")
+        self.assertEqual(result.conversion, self.conversion)
+
+        image = self.open_result(result)
+        self.assertEqual(image.shape, (32, 64, 3))
+
+        # The center looks at the front face, longitude increases to the right
+        positions = {"front": (16, 32), "right": (16, 48), "left": (16, 16), "back": (16, 1), "up": (1, 32), "down": (30, 32)}
+
+        for face, (row, col) in positions.items():
+            self.assertEqual(tuple(image[row, col]), self.FACE_COLORS[face], face)
+
+        self.assertEqual(tuple(image[16, 62]), self.FACE_COLORS["back"])
+
+        image = self.open_result(resized)
+        self.assertEqual(image.shape, (48, 96, 3))
+        self.assertEqual(tuple(image[24, 72]), self.FACE_COLORS["right"])
+
+        image = self.open_result(rotated)
+        self.assertEqual(tuple(image[16, 32]), self.FACE_COLORS["back"])
+        self.assertEqual(tuple(image[16, 1]), self.FACE_COLORS["front"])
+        self.assertEqual(tuple(image[1, 32]), self.FACE_COLORS["up"])
+
+    def test_tile_grids_are_stitched_in_order(self):
+        rng = numpy.random.default_rng(0)
+        tiles = [[rng.integers(0, 256, (6, 8, 3), dtype=numpy.uint8) for x in range(4)] for y in range(3)]
+        files = [[self.create_image(f"{y}-{x}.png", PIL.Image.fromarray(tile)) for x, tile in enumerate(line)] for y, line in enumerate(tiles)]
+
+        reference = PIL.Image.new("RGB", (32, 18))
+        for y, line in enumerate(tiles):
+            for x, tile in enumerate(line):
+                reference.paste(PIL.Image.fromarray(tile), (x * 8, y * 6))
+
+        result = PILStitcher().stitch(files)
+
+        self.assertEqual(result.mime_type, "image/png")
+        self.assertEqual(result.conversion, self.conversion)
+        numpy.testing.assert_array_equal(self.open_result(result), numpy.asarray(reference))
+
+    def test_tiles_must_have_the_same_dimensions(self):
+        tile = PIL.Image.new("RGB", (8, 6))
+        files = [[self.create_image(f"{y}-{x}.png", tile) for x in range(2)] for y in range(2)]
+        files[1][1] = self.create_image("narrow.png", PIL.Image.new("RGB", (7, 6)))
+        count = File.objects.count()
+
+        with self.assertRaisesMessage(ValueError, "All files must have the same dimensions!"):
+            PILStitcher().stitch(files)
+
+        with self.assertRaisesMessage(ValueError, "All lines must have the same length!"):
+            PILStitcher().stitch([files[0], files[1][:1]])
+
+        self.assertEqual(File.objects.count(), count)
+
+    def install_cube2sphere(self, script):
+        """Put a fake cube2sphere running a shell script first on the PATH
+        """
+        directory = self.directory / "bin"
+        directory.mkdir(exist_ok=True)
+
+        path = directory / "cube2sphere"
+        path.write_text(f"#!/bin/sh\n{script}\n")
+        path.chmod(0o755)
+
+        patch = mock.patch.dict(os.environ, {"PATH": f"{directory}:{os.environ['PATH']}"})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_cube2sphere_output_is_stored(self):
+        self.install_cube2sphere(f'echo "$@" > {self.directory / "arguments"}; cp front.png out0001.png')
+        result = BlenderStitcher().cubemap_to_equirectangular(self.create_cubemap(), rotation=(0, 90, 0), size=(96, 48))
+
+        self.assertEqual(tuple(self.open_result(result)[0, 0]), self.FACE_COLORS["front"])
+        self.assertEqual((self.directory / "arguments").read_text().split(), ["front.png", "back.png", "right.png", "left.png", "up.png", "down.png", "-R", "0", "90", "0", "-o", "out", "-f", "png", "-r", "96", "48"])
+
+    def test_cube2sphere_errors_are_reported(self):
+        self.install_cube2sphere('for line in 1 2 3 4 5 6 7; do echo "error $line" >&2; done; exit 3')
+
+        with self.assertLogs("pix360", "ERROR"), self.assertRaises(StitchingError) as context:
+            BlenderStitcher().cubemap_to_equirectangular(self.create_cubemap())
+
+        message = str(context.exception)
+        self.assertIn("exit code 3", message)
+        self.assertIn(str(self.conversion.id), message)
+        self.assertIn("error 3\nerror 4\nerror 5\nerror 6\nerror 7", message)
+        self.assertNotIn("error 2", message)
+
+    def test_hanging_cube2sphere_is_killed(self):
+        pid_path = self.directory / "pid"
+        self.install_cube2sphere(f"sleep 60 & echo $! > {pid_path}; wait")
+
+        start = time.monotonic()
+
+        with self.assertRaisesMessage(StitchingError, "timed out after 0.5 seconds"):
+            BlenderStitcher(timeout=0.5).cubemap_to_equirectangular(self.create_cubemap())
+
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertFalse(process_alive(wait_for_file(pid_path)))
+
+    def test_missing_cube2sphere(self):
+        with self.assertRaisesMessage(StitchingError, "Could not run cube2sphere"):
+            BlenderStitcher(cube2sphere_path=str(self.directory / "missing")).cubemap_to_equirectangular(self.create_cubemap())
+
+class DelayedStitcher(BaseStitcher):
+    """Stitcher returning the key of its first tile after a delay, so jobs finish out of order
+    """
+    DELAYS = {"slow": 1, "medium": 0.5}
+
+    def estimate_memory(self, files):
+        return 0
+
+    def stitch(self, files, progress=True):
+        key = files[0][0].key
+
+        if key == "broken":
+            raise StitchingError("Broken tile")
+
+        time.sleep(self.DELAYS.get(key, 0))
+        return key
+
+class MultistitchTest(SimpleTestCase):
+    @staticmethod
+    def tiles(*keys):
+        return [[[File(key=key)]] for key in keys]
+
+    def test_results_keep_input_order(self):
+        self.assertEqual(DelayedStitcher().multistitch(self.tiles("slow", "medium", "fast"), processes=3), ["slow", "medium", "fast"])
+
+    def test_errors_reach_the_caller(self):
+        with self.assertRaisesMessage(StitchingError, "Broken tile"):
+            DelayedStitcher().multistitch(self.tiles("medium", "broken"), processes=2)
+
+class QueuedHTTPHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the responses queued for each path, see start_server()
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers.items())))
+        responses = self.server.responses[self.path]
+        status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server(testcase, responses):
+    """Start a local HTTP server for a test
+
+    Args:
+        testcase (TestCase): The test, which stops the server when it ends
+        responses (dict): Lists of (status, headers, body) responses by path, the last one of each is repeated
+
+    Returns:
+        ThreadingHTTPServer: The server, recording its connections and requests
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), QueuedHTTPHandler)
+    server.daemon_threads = True
+    server.responses = responses
+    server.connections = 0
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    testcase.addCleanup(server.server_close)
+    testcase.addCleanup(server.shutdown)
+
+    return server
+
+class TileFetcherTest(SimpleTestCase):
+    def test_backoff_is_jittered_and_capped(self):
+        delays = [backoff_delay(attempt) for attempt in range(20) for _ in range(10)]
+
+        self.assertTrue(all(0 <= delay <= 30 for delay in delays))
+        self.assertTrue(all(backoff_delay(0) <= 0.5 for _ in range(100)))
+        self.assertEqual(len(set(delays)), len(delays))
+
+    def test_retry_after_is_capped(self):
+        self.assertEqual(retry_delay(0, 5), 5)
+
+        with self.settings(PIX360_HTTP_MAX_RETRY_AFTER=10):
+            self.assertEqual(retry_delay(0, 3600), 10)
+
+    def test_failed_requests_are_retried_on_kept_alive_connections(self):
+        server = start_server(self, {
+            "/0.jpg": [(503, {"Retry-After": "3600"}, b""), (200, {"Content-Type": "image/jpeg"}, b"tile0")],
+            "/1.jpg": [(200, {}, b"tile1")],
+            "/missing.jpg": [(404, {}, b"")],
+        })
+
+        with self.settings(PIX360_HTTP_MAX_RETRY_AFTER=0.1), TileFetcher(connections_per_host=1, cache=False) as fetcher, self.assertLogs("pix360", "WARNING"):
+            started = time.monotonic()
+            self.assertEqual(fetcher.fetch_all([server.url + "/0.jpg", server.url + "/1.jpg"]), [b"tile0", b"tile1"])
+            self.assertLess(time.monotonic() - started, 5)
+
+            with self.assertRaises(HTTPResponseError) as error:
+                fetcher.fetch(server.url + "/missing.jpg")
+
+        self.assertEqual(error.exception.status, 404)
+        self.assertEqual(len(server.requests), 4)
+        self.assertEqual(server.connections, 1)
+
+    def test_unsupported_urls_are_rejected(self):
+        with TileFetcher(cache=False) as fetcher, self.assertRaises(DownloadError):
+            fetcher.fetch("ftp://example.com/tile.jpg")
+
+# Raw responses of the server in AsyncHTTPClientTest, by path
+RAW_RESPONSES = {
+    "/chunked": b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n4;ext=1\r\ntile\r\n2\r\n-0\r\n0\r\nX-Trailer: 1\r\n\r\n",
+    "/redirect": b"HTTP/1.1 302 Found\r\nLocation: /length\r\nContent-Length: 0\r\n\r\n",
+    "/length": b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\ntile-1",
+    "/close": b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\ntile-2",
+}
+
+class AsyncHTTPClientTest(SimpleTestCase):
+    def fetch(self, paths, **kwargs):
+        """Fetch paths from a local asyncio server
+
+        Returns:
+            Tuple: Bodies or exception, number of connections and requests received by the server
+        """
+        connections, requests = [], []
+
+        async def handle(reader, writer):
+            connections.append(asyncio.current_task())
+
+            try:
+                while True:
+                    request = await reader.readuntil(b"\r\n\r\n")
+                    path = request.split(b" ")[1].decode()
+                    requests.append(request)
+                    writer.write(RAW_RESPONSES[path])
+                    await writer.drain()
+
+                    if path == "/close":
+                        break
+            except asyncio.IncompleteReadError:
+                pass
+            finally:
+                writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+            try:
+                async with AsyncHTTPClient(connections_per_host=1, retries=1, cache=False) as client:
+                    return await client.fetch_all([url + path for path in paths], **kwargs)
+            except DownloadError as e:
+                return e
+            finally:
+                # The client closed its connections, so the handlers see the end of their streams
+                await asyncio.wait_for(asyncio.gather(*connections), 5)
+                server.close()
+                await server.wait_closed()
+
+        return asyncio.run(run()), len(connections), len(requests)
+
+    def test_responses_are_decoded_on_kept_alive_connections(self):
+        self.assertEqual(self.fetch(["/chunked", "/redirect", "/close", "/length"]), ([b"tile-0", b"tile-1", b"tile-2", b"tile-1"], 2, 5))
+
+    def test_header_injection_is_rejected(self):
+        error, _, requests = self.fetch(["/length"], headers={"X-Tile": "1\r\nX-Injected: 1"})
+
+        self.assertIsInstance(error, DownloadError)
+        self.assertEqual(requests, 0)
+
+class FakeDownloader(DownloaderModule):
+    """Downloader producing a small text file for every conversion
+    """
+    identifier = "fake"
+    hostnames = ["tours.example.com"]
+
+    def process_conversion(self, conversion):
+        return File.objects.create(conversion=conversion, file=ContentFile(b"result", name="result.txt"), mime_type="text/plain")
+
+class HookDownloader(FakeDownloader):
+    """FakeDownloader calling a function with every conversion before producing its result
+    """
+    identifier = "hook"
+    hook = None
+
+    def process_conversion(self, conversion):
+        type(self).hook(conversion)
+        return super().process_conversion(conversion)
+
+class PipelineDownloader(FakeDownloader):
+    """FakeDownloader split into a download and a stitch stage
+    """
+    identifier = "pipeline"
+
+    def download_conversion(self, conversion):
+        return {"downloaded": str(conversion.id)}
+
+    def stitch_conversion(self, conversion, data):
+        return File.objects.create(conversion=conversion, file=ContentFile(data["downloaded"].encode(), name="result.txt"), mime_type="text/plain")
+
+class WorkerTestCase(MediaTestCase):
+    """Test case running workers in the test process, with FakeDownloader installed
+    """
+    def setUp(self):
+        super().setUp()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        sockets = self.settings(PIX360_WORKER_SOCKET_DIR=directory.name)
+        sockets.enable()
+        self.addCleanup(sockets.disable)
+
+        notify._notifiers.clear()
+        self.addCleanup(notify._notifiers.clear)
+
+        # Workers configure the logger when they are created
+        logger = logging.getLogger("pix360")
+        self.addCleanup(setattr, logger, "handlers", list(logger.handlers))
+        self.addCleanup(logger.setLevel, logger.level)
+
+    def queue(self, count=1, **kwargs):
+        return [Conversion.objects.create(url="https://tours.example.com/tour", user=self.user, **kwargs) for _ in range(count)]
+
+    def create_worker(self, downloader=FakeDownloader, identity=None, **kwargs):
+        worker = Worker(**kwargs)
+        worker.loader = Loader([downloader])
+
+        # Set by run() otherwise
+        worker.identity = identity
+        worker.notifier = get_notifier()
+        return worker
+
+    def hook(self, function):
+        HookDownloader.hook = function
+        self.addCleanup(setattr, HookDownloader, "hook", None)
+
+    def run_worker(self, worker):
+        handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+
+        try:
+            worker.run()
+        finally:
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+
+        return worker
+
+class ExitingProcess(multiprocessing.Process):
+    """Stand-in for a worker process, exiting with the given code as soon as it starts
+    """
+    def __init__(self, exitcode):
+        super().__init__(daemon=True)
+        self.code = exitcode
+
+    def run(self):
+        os._exit(self.code)
+
+class ScriptedSupervisor(Supervisor):
+    """Supervisor starting ExitingProcess workers with the given exit codes, then stopping
+    """
+    def __init__(self, exitcodes, **kwargs):
+        super().__init__(**kwargs)
+        self.exitcodes = list(exitcodes)
+        self.created = []
+
+    def create_worker(self):
+        if not self.exitcodes:
+            self.stop()
+
+        worker = ExitingProcess(self.exitcodes.pop(0) if self.exitcodes else 0)
+        self.created.append(worker)
+        return worker
+
+class SupervisorTest(WorkerTestCase):
+    def test_exited_workers_are_replaced(self):
+        supervisor = ScriptedSupervisor([0, 0, 3, 0], concurrency=2)
+        handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+
+        try:
+            with self.assertLogs("pix360", "INFO") as logs:
+                supervisor.run()
+        finally:
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+
+        self.assertEqual([worker.exitcode for worker in supervisor.created[:4]], [0, 0, 3, 0])
+        self.assertEqual(len(supervisor.created), 5)
+        self.assertEqual(supervisor.workers, [])
+        self.assertTrue(any("died with exit code 3" in line for line in logs.output))
+
+    def test_workers_are_spawned_and_stopped(self):
+        supervisor = Supervisor(shutdown_timeout=30)
+
+        with self.assertLogs("pix360", "INFO"):
+            worker = supervisor.spawn()
+            self.assertIsInstance(worker, Worker)
+
+            # Bound once the worker handles SIGTERM, see Worker.run()
+            path = Path(settings.PIX360_WORKER_SOCKET_DIR) / f"{worker.pid}.sock"
+            deadline = time.monotonic() + 30
+            while not path.exists() and worker.is_alive() and time.monotonic() < deadline:
+                time.sleep(0.05)
+
+            self.assertTrue(path.exists())
+            supervisor.shutdown()
+
+        self.assertEqual(worker.exitcode, 0)
+        self.assertFalse(path.exists())
+        self.assertEqual(supervisor.workers, [])
+
+    def test_crashes_delay_restarts(self):
+        supervisor = ScriptedSupervisor([])
+        supervisor.workers = [ExitingProcess(1)]
+        supervisor.workers[0].start()
+        supervisor.workers[0].join()
+
+        start = time.monotonic()
+
+        with self.assertLogs("pix360", "ERROR"):
+            supervisor.reap()
+
+        self.assertEqual(supervisor.failures, 1)
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+        self.assertEqual(supervisor.workers, [])
+
+    def test_workers_exit_after_max_jobs(self):
+        self.queue(3)
+
+        with self.assertLogs("pix360", "INFO") as logs:
+            worker = self.run_worker(self.create_worker(max_jobs=2))
+
+        self.assertEqual(Conversion.objects.filter(status=ConversionStatus.DONE).count(), 2)
+        self.assertEqual(Conversion.objects.filter(status=ConversionStatus.PENDING, worker=None).count(), 1)
+        self.assertEqual(Conversion.objects.filter(worker=worker.identity).count(), 0)
+        self.assertTrue(any("loading 1 downloaders took" in line for line in logs.output))
+        self.assertIn("Worker exiting after 2 conversions", logs.output[-1])
+
+class NotifierTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        sockets = self.settings(PIX360_WORKER_SOCKET_DIR=self.directory)
+        sockets.enable()
+        self.addCleanup(sockets.disable)
+
+        notify._notifiers.clear()
+        self.addCleanup(notify._notifiers.clear)
+
+    def listen(self):
+        listener = SocketNotifier(self.directory)
+        listener.fileno()
+        self.addCleanup(listener.close)
+        return listener
+
+    def test_socket_notifications_round_trip(self):
+        listener = self.listen()
+
+        self.assertFalse(listener.wait(0))
+
+        SocketNotifier(self.directory).notify()
+        SocketNotifier(self.directory).notify()
+        self.assertTrue(listener.wait(1))
+
+        # Both notifications are consumed at once
+        self.assertFalse(listener.wait(0))
+
+        listener.interrupt()
+        self.assertTrue(listener.wait(1))
+        self.assertFalse(listener.wait(0))
+
+    def test_stale_sockets_are_removed(self):
+        listener = self.listen()
+        path = listener.path
+        listener.close()
+
+        # A socket file left behind by a worker that was killed
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(str(path))
+        stale.close()
+
+        SocketNotifier(self.directory).notify()
+        self.assertFalse(path.exists())
+
+    def test_workers_are_notified_on_commit(self):
+        notifier = get_notifier()
+        self.assertIsInstance(notifier, SocketNotifier)
+        self.assertIs(get_notifier(), notifier)
+        self.assertEqual(str(notifier.directory), self.directory)
+
+        listener = self.listen()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_workers()
+            self.assertFalse(listener.wait(0))
+
+        self.assertTrue(listener.wait(1))
+
+class ClaimTest(WorkerTestCase):
+    def test_claims_do_not_overlap(self):
+        queued = self.queue(3)
+        first = self.create_worker(identity="first")
+        second = self.create_worker(identity="second")
+
+        with mock.patch.object(QuerySet, "select_for_update", autospec=True, side_effect=QuerySet.select_for_update) as select_for_update:
+            claimed = first.claim(2) + second.claim(2)
+
+        self.assertEqual(select_for_update.call_args.kwargs, {"skip_locked": connection.features.has_select_for_update_skip_locked})
+        self.assertCountEqual([conversion.id for conversion in claimed], [conversion.id for conversion in queued])
+        self.assertEqual(second.claim(1), [])
+        self.assertEqual(Conversion.objects.filter(worker="first").count(), 2)
+
+    def test_prefetched_conversions_stay_queued_until_started(self):
+        self.queue(2)
+        worker = self.create_worker(identity="worker")
+        started, prefetched = worker.claim(2)
+
+        self.assertTrue(worker.start_conversion(started))
+        self.assertEqual(started.status, ConversionStatus.PROCESSING)
+
+        statuses = {conversion.id: status_payload(conversion)["status"] for conversion in conversion_statuses(self.user)}
+        self.assertEqual(statuses, {started.id: "processing", prefetched.id: "queued"})
+
+        # Reclaimed by the heartbeat of another worker meanwhile
+        Conversion.objects.filter(id=prefetched.id).update(worker="other")
+        self.assertFalse(worker.start_conversion(prefetched))
+
+    def test_prefetched_conversions_are_released_on_exit(self):
+        self.queue(3)
+        worker = self.create_worker(HookDownloader)
+        self.hook(lambda conversion: worker.stop())
+
+        worker.prefetch = 3
+
+        with self.assertLogs("pix360", "INFO"):
+            self.run_worker(worker)
+
+        self.assertEqual(Conversion.objects.filter(status=ConversionStatus.DONE).count(), 1)
+        self.assertEqual(list(Conversion.objects.filter(status=ConversionStatus.PENDING).values_list("worker", "lease_expires", "attempts")), [(None, None, 0)] * 2)
+
+class SchedulingTest(WorkerTestCase):
+    def claim_order(self, worker, count):
+        return [worker.claim(1)[0] for _ in range(count)]
+
+    def test_priority_then_age(self):
+        old, new, urgent = self.queue(3)
+        Conversion.objects.filter(id=urgent.id).update(priority=10)
+        Conversion.objects.filter(id=old.id).update(created=new.created - timedelta(hours=1))
+
+        worker = self.create_worker(identity="worker")
+        self.assertEqual([conversion.id for conversion in self.claim_order(worker, 3)], [urgent.id, old.id, new.id])
+
+    def test_users_with_fewer_active_conversions_come_first(self):
+        other = User.objects.create(email="other@example.com")
+        self.queue(1, status=ConversionStatus.PROCESSING)
+        busy = self.queue(2)
+        idle = Conversion.objects.create(url="https://tours.example.com/tour", user=other)
+
+        worker = self.create_worker(identity="worker")
+        self.assertEqual([conversion.id for conversion in self.claim_order(worker, 2)], [idle.id, busy[0].id])
+
+    def test_size_classes_are_routed(self):
+        small, large = self.queue(1, size_class="small") + self.queue(1, size_class="large")
+        unclassified, = self.queue()
+
+        worker = self.create_worker(identity="large", size_classes=["large"])
+        self.assertCountEqual([conversion.id for conversion in worker.claim(3)], [large.id, unclassified.id])
+        self.assertEqual(Conversion.objects.get(id=small.id).worker, None)
+
+class PipelineTest(WorkerTestCase):
+    def test_conversions_are_handed_off_between_stages(self):
+        conversion, = self.queue()
+
+        with self.assertLogs("pix360", "INFO"):
+            self.run_worker(self.create_worker(PipelineDownloader, max_jobs=1, stage="download"))
+
+        conversion.refresh_from_db()
+        self.assertEqual(conversion.status, ConversionStatus.DOWNLOADED)
+        self.assertEqual(conversion.stage_data, {"downloaded": str(conversion.id)})
+        self.assertIsNone(conversion.worker)
+        self.assertIsNone(conversion.lease_expires)
+
+        with self.assertLogs("pix360", "INFO"):
+            self.run_worker(self.create_worker(PipelineDownloader, max_jobs=1, stage="stitch"))
+
+        conversion.refresh_from_db()
+        self.assertEqual(conversion.status, ConversionStatus.DONE)
+        self.assertIsNone(conversion.stage_data)
+        self.assertEqual(conversion.result.file.read(), str(conversion.id).encode())
+
+    def test_download_stage_waits_for_the_stitch_queue(self):
+        self.queue(2, status=ConversionStatus.DOWNLOADED)
+        pending, = self.queue()
+
+        with self.settings(PIX360_PIPELINE_QUEUE_SIZE=2):
+            worker = self.create_worker(PipelineDownloader, identity="downloader", stage="download")
+
+        self.assertEqual(worker.sources(), [])
+        self.assertEqual(worker.claim(), [])
+
+        worker.queue_size = 3
+        self.assertEqual([conversion.id for conversion in worker.claim()], [pending.id])
+
+class LeaseTest(WorkerTestCase):
+    def test_leases_are_renewed_until_the_last_conversion_is_finished(self):
+        self.queue()
+        worker = self.create_worker(HookDownloader)
+        worker.heartbeat_interval = 0.01
+        renewed = threading.Event()
+        worker.renew_leases = renewed.set
+
+        def stop_and_wait(conversion):
+            worker.stop()
+            renewed.clear()
+            self.assertTrue(renewed.wait(5))
+
+        self.hook(stop_and_wait)
+
+        with self.assertLogs("pix360", "INFO"):
+            self.run_worker(worker)
+
+        self.assertEqual(Conversion.objects.get().status, ConversionStatus.DONE)
+
+    def test_reclaimed_conversions_are_not_overwritten(self):
+        conversion, = self.queue()
+        worker = self.create_worker(HookDownloader, max_jobs=1)
+        self.hook(lambda conversion: Conversion.objects.filter(id=conversion.id).update(status=ConversionStatus.PROCESSING, worker="other"))
+
+        with self.assertLogs("pix360", "INFO") as logs:
+            self.run_worker(worker)
+
+        conversion.refresh_from_db()
+        self.assertEqual((conversion.status, conversion.worker), (ConversionStatus.PROCESSING, "other"))
+        self.assertFalse(File.objects.filter(conversion=conversion, is_result=True).exists())
+        self.assertTrue(any("Lost the lease" in line for line in logs.output))
+
+class CheckpointTest(MediaTestCase):
+    def checkpoint(self, conversion, key, content=b"tile"):
+        file = File.objects.create(conversion=conversion, file=ContentFile(content, name="tile.jpg"))
+        return conversion.add_checkpoint(file, File.STAGE_DOWNLOADED, key)
+
+    def test_checkpoints_are_replaced(self):
+        conversion = Conversion.objects.create(url="https://example.com/tour", user=self.user)
+        first = self.checkpoint(conversion, "key")
+        second = self.checkpoint(conversion, "key")
+
+        self.assertEqual(conversion.get_checkpoint(File.STAGE_DOWNLOADED, "key"), second)
+        self.assertEqual(conversion.get_checkpoints(File.STAGE_DOWNLOADED), {"key": second})
+        first.refresh_from_db()
+        self.assertIsNone(first.stage)
+
+    def test_checkpoints_are_only_adopted_when_no_worker_uses_them(self):
+        failed = Conversion.objects.create(url="https://example.com/tour", user=self.user, status=ConversionStatus.FAILED)
+        leased = Conversion.objects.create(url="https://example.com/tour", user=self.user, status=ConversionStatus.PROCESSING, worker="worker")
+        self.checkpoint(failed, "failed")
+        self.checkpoint(leased, "leased")
+        File.objects.create(conversion=failed, file=ContentFile(b"result", name="result.png"), is_result=True, stage=File.STAGE_STITCHED, key="result")
+
+        retry = Conversion.objects.create(url="https://example.com/tour", user=self.user)
+        self.assertEqual(retry.adopt_checkpoints(failed), 1)
+        self.assertEqual(retry.adopt_checkpoints(leased), 0)
+        self.assertEqual(list(retry.get_checkpoints(File.STAGE_DOWNLOADED)), ["failed"])
+
+    def test_retries_resume_from_the_failed_attempt(self):
+        failed = Conversion.objects.create(url="https://example.com/tour", user=self.user, status=ConversionStatus.FAILED)
+        checkpoint = self.checkpoint(failed, "key")
+        self.client.force_login(self.user)
+
+        with self.captureOnCommitCallbacks():
+            response = self.client.get(reverse("conversion_retry", args=[failed.id]))
+
+        retry = Conversion.objects.get(id=response.json()["id"])
+        self.assertEqual(retry.get_checkpoints(File.STAGE_DOWNLOADED), {"key": checkpoint})
+
+    def test_downloads_resume_from_checkpoints(self):
+        server = start_server(self, {"/0.jpg": [(200, {}, b"tile0")], "/1.jpg": [(200, {"Content-Type": "image/jpeg"}, b"tile1")]})
+        urls = [server.url + "/0.jpg", server.url + "/1.jpg"]
+        conversion = Conversion.objects.create(url="https://example.com/tour", user=self.user)
+        downloaded = self.checkpoint(conversion, checkpoint_key(urls[0]), b"tile0")
+
+        with TileFetcher(cache=False) as fetcher:
+            (first, second), = fetcher.fetch_grid_files([urls], conversion)
+
+        self.assertEqual(first, downloaded)
+        self.assertEqual((second.file.read(), second.mime_type), (b"tile1", "image/jpeg"))
+        self.assertEqual([path for path, _ in server.requests], ["/1.jpg"])
+        self.assertEqual(set(conversion.get_checkpoints(File.STAGE_DOWNLOADED)), {checkpoint_key(url) for url in urls})
+
+def start_background_command(path):
+    """Stitching job starting a command that leaves a process behind, writing its PID to a file
+    """
+    return run_command(["sh", "-c", f"sleep 60 & echo $! > {path}; wait"])
+
+def count_progress_reporters(conversion_id=None):
+    """Stitching job returning the number of progress reporters in its process, after creating one for a conversion
+    """
+    if conversion_id:
+        get_progress_reporter(conversion_id)
+    return len(progress._reporters)
+
+def exit_process():
+    """Stitching job killing its process
+    """
+    os._exit(1)
+
+def process_alive(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] not in ("Z", "X")
+    except FileNotFoundError:
+        return False
+
+def wait_for_file(path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not os.path.getsize(path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    with open(path) as f:
+        return int(f.read())
+
+class StitcherPoolTest(SimpleTestCase):
+    def setUp(self):
+        self.pool = StitcherPool(processes=1, timeout=5, max_jobs=10)
+        self.addCleanup(self.pool.shutdown)
+
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.unlink, self.path)
+
+    def test_timed_out_jobs_are_killed_with_their_commands(self):
+        worker = self.pool.submit(os.getpid).result()
+
+        with self.assertLogs("pix360", "ERROR"), self.assertRaises(StitchingError):
+            self.pool.submit(start_background_command, self.path).result()
+
+        self.assertFalse(process_alive(wait_for_file(self.path)))
+        self.assertFalse(process_alive(worker))
+        self.assertNotEqual(self.pool.submit(os.getpid).result(), worker)
+
+    def test_progress_reporters_are_discarded_after_each_job(self):
+        self.assertEqual(self.pool.submit(count_progress_reporters, uuid.uuid4()).result(), 1)
+        self.assertEqual(self.pool.submit(count_progress_reporters).result(), 0)
+
+    def test_dead_processes_fail_their_job_and_are_replaced(self):
+        worker = self.pool.submit(os.getpid).result()
+
+        with self.assertRaises(StitchingError):
+            self.pool.submit(exit_process).result()
+
+        self.assertNotEqual(self.pool.submit(os.getpid).result(), worker)
+
+    def test_commands_are_killed_with_their_group_on_timeout(self):
+        with self.assertRaises(subprocess.TimeoutExpired):
+            run_command(["sh", "-c", f"sleep 60 & echo $! > {self.path}; wait"], timeout=1)
+
+        self.assertFalse(process_alive(wait_for_file(self.path)))
+
+class StorageTest(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Next to MEDIA_ROOT, so files can be moved and hardlinked
+        directory = tempfile.TemporaryDirectory(dir=os.path.dirname(File._meta.get_field("file").storage.location))
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+        self.conversion = Conversion.objects.create(url="https://example.com/tour", user=self.user)
+
+    def test_files_are_moved_into_storage(self):
+        path = self.directory / "tile.jpg"
+        path.write_bytes(b"tile")
+        inode = path.stat().st_ino
+
+        file = create_file(path, conversion=self.conversion, mime_type="image/jpeg")
+
+        self.assertFalse(path.exists())
+        self.assertEqual(local_path(file).stat().st_ino, inode)
+        self.assertEqual(file.file.name, f"content/{self.conversion.id}/{file.id}/tile.jpg")
+        self.assertEqual(file.file.read(), b"tile")
+
+    def test_path_files_are_named_after_their_path(self):
+        path = self.directory / "tile.jpg"
+        path.write_bytes(b"tile")
+
+        with PathFile(path) as default, PathFile(path, "other.jpg") as named:
+            self.assertEqual((default.name, named.name), ("tile.jpg", "other.jpg"))
+            self.assertEqual(default.temporary_file_path(), str(path))
+
+    def test_files_are_linked_where_possible(self):
+        file = File.objects.create(conversion=self.conversion, file=ContentFile(b"tile", name="tile.jpg"))
+
+        link_or_copy(file, self.directory / "hardlink.jpg")
+        self.assertEqual((self.directory / "hardlink.jpg").stat().st_ino, local_path(file).stat().st_ino)
+
+        with mock.patch("os.link", side_effect=OSError("Invalid cross-device link")):
+            link_or_copy(file, self.directory / "symlink.jpg")
+
+        self.assertEqual((self.directory / "symlink.jpg").resolve(), local_path(file).resolve())
+
+        with mock.patch.object(storage, "local_path", return_value=None):
+            link_or_copy(file, self.directory / "copy.jpg")
+
+        self.assertFalse((self.directory / "copy.jpg").is_symlink())
+        self.assertEqual((self.directory / "copy.jpg").read_bytes(), b"tile")
+        self.assertNotEqual((self.directory / "copy.jpg").stat().st_ino, local_path(file).stat().st_ino)
+
+class ConversionListTest(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_conversions_are_paged_newest_first(self):
+        conversions = [Conversion.objects.create(url="https://example.com/tour", user=self.user) for _ in range(3)]
+        Conversion.objects.create(url="https://example.com/tour", user=User.objects.create(email="other@example.com"))
+
+        first = self.client.get(reverse("conversion_list"), {"limit": 2}).json()
+        second = self.client.get(reverse("conversion_list"), {"limit": 2, "cursor": first["next"]}).json()
+
+        self.assertEqual([conversion["id"] for conversion in first["conversions"] + second["conversions"]], [str(conversion.id) for conversion in reversed(conversions)])
+        self.assertIsNone(second["next"])
+
+    def test_invalid_cursors_are_rejected(self):
+        conversion = Conversion.objects.create(url="https://example.com/tour", user=self.user)
+        conversion.pk = "not-a-uuid"
+
+        for cursor in (encode_cursor(conversion), "not-a-cursor"):
+            response = self.client.get(reverse("conversion_list"), {"cursor": cursor})
+            self.assertEqual(response.status_code, 400)
+
+class StatusTest(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def conversion(self, **kwargs):
+        return Conversion.objects.create(url="https://example.com/tour", user=self.user, **kwargs)
+
+    def test_results_are_annotated_in_a_single_query(self):
+        original = self.conversion(status=ConversionStatus.DONE)
+        File.objects.create(conversion=original, file=ContentFile(b"result", name="result.png"), mime_type="image/png", is_result=True)
+        duplicate = self.conversion(status=ConversionStatus.DONE, duplicate_of=original)
+        deleted = self.conversion(status=ConversionStatus.DONE)
+        progressing = self.conversion(status=ConversionStatus.DOWNLOADING, progress={"phase": "download", "done": 1, "total": 2})
+
+        with self.assertNumQueries(1):
+            payloads = {conversion.id: status_payload(conversion) for conversion in conversion_statuses(self.user)}
+
+        self.assertEqual(payloads[original.id]["result"], payloads[duplicate.id]["result"])
+        self.assertTrue(payloads[duplicate.id]["result"].endswith("/result.png"))
+        self.assertEqual(payloads[duplicate.id]["content_type"], "image/png")
+        self.assertEqual(payloads[deleted.id]["status"], "failed")
+        self.assertEqual(payloads[progressing.id]["progress"], {"phase": "download", "done": 1, "total": 2})
+
+    def test_batches_only_include_own_conversions(self):
+        own = self.conversion(status=ConversionStatus.DISMISSED)
+        other = Conversion.objects.create(url="https://example.com/tour", user=User.objects.create(email="other@example.com"))
+        ids = [str(own.id), str(other.id), str(uuid.uuid4())]
+
+        for response in (self.client.get(reverse("conversion_status_batch"), {"id": ids}), self.client.post(reverse("conversion_status_batch"), {"id": ids})):
+            self.assertEqual([(conversion["id"], conversion["status"]) for conversion in response.json()["conversions"]], [(str(own.id), "dismissed")])
+
+        self.assertEqual(self.client.get(reverse("conversion_status_batch"), {"id": "invalid"}).status_code, 400)
+
+        with self.settings(PIX360_STATUS_BATCH_SIZE=2):
+            self.assertEqual(self.client.get(reverse("conversion_status_batch"), {"id": ids}).status_code, 400)
+
+    def test_events_are_opt_in(self):
+        self.assertEqual(self.client.get(reverse("conversion_events")).status_code, 404)
+        self.assertIn(b"var statusEvents = false;", self.client.get(reverse("converter")).content)
+
+        with self.settings(PIX360_STATUS_BATCH_SIZE=50):
+            self.assertIn(b"var statusBatchSize = 50;", self.client.get(reverse("converter")).content)
+
+        conversion = self.conversion()
+
+        with self.settings(PIX360_STATUS_EVENTS=True, PIX360_EVENTS_TIMEOUT=0.01, PIX360_EVENTS_POLL_INTERVAL=0.01):
+            self.assertIn(b"var statusEvents = true;", self.client.get(reverse("converter")).content)
+
+            response = self.client.get(reverse("conversion_events"), {"since": (conversion.updated - timedelta(minutes=1)).isoformat()})
+            events = b"".join(response.streaming_content).decode()
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertIn(f"id: {conversion.updated.isoformat()}\nevent: status\n", events)
+        self.assertIn('"status": "queued"', events)
+
+class ProgressTest(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversion = Conversion.objects.create(url="https://example.com/tour", user=self.user, status=ConversionStatus.DOWNLOADING)
+
+    def progress(self):
+        return Conversion.objects.get(id=self.conversion.id).progress
+
+    def test_reports_are_coalesced(self):
+        reporter = ProgressReporter(self.conversion.id, interval=60)
+
+        reporter.report("download", 1, 10)
+        self.assertEqual(self.progress(), {"phase": "download", "done": 1, "total": 10})
+
+        with self.assertNumQueries(0):
+            reporter.report("download", 2, 10)
+
+        reporter.flush()
+        self.assertEqual(self.progress(), {"phase": "download", "done": 2, "total": 10})
+
+        with self.assertNumQueries(0):
+            reporter.flush()
+
+        reporter.report("download", 5, 10)
+        reporter.report("download", 10, 10)
+        self.assertEqual(self.progress(), {"phase": "download", "done": 10, "total": 10})
+
+        reporter.report("stitch", 0, 4)
+        self.assertEqual(self.progress(), {"phase": "stitch", "done": 0, "total": 4})
+
+    def test_finished_conversions_are_not_touched(self):
+        reporter = ProgressReporter(self.conversion.id, interval=60)
+        Conversion.objects.filter(id=self.conversion.id).update(status=ConversionStatus.DONE, progress=None)
+
+        reporter.report("download", 1, 10)
+        self.assertIsNone(self.progress())
+
+    def test_pending_reports_are_flushed(self):
+        get_progress_reporter(self.conversion).report("download", 1, 10)
+        get_progress_reporter(self.conversion.id).report("download", 2, 10)
+        self.addCleanup(progress._reporters.clear)
+
+        flush_progress()
+
+        self.assertEqual(self.progress(), {"phase": "download", "done": 2, "total": 10})
+        self.assertEqual(progress._reporters, {})
+
+class PluginManifestTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "plugins.json")
+
+        manifest = self.settings(PIX360_PLUGIN_MANIFEST=self.path)
+        manifest.enable()
+        self.addCleanup(manifest.disable)
+
+        registry = mock.patch.object(loader, "_registry", None)
+        registry.start()
+        self.addCleanup(registry.stop)
+
+        entry_points = mock.patch.object(loader, "downloader_entry_points", return_value=[
+            importlib.metadata.EntryPoint(name="fake", value=f"{__name__}:FakeDownloader", group=ENTRY_POINT_GROUP),
+        ])
+        entry_points.start()
+        self.addCleanup(entry_points.stop)
+
+    def load(self):
+        loader._registry = None
+        return Loader.load_downloaders()
+
+    def test_downloaders_are_only_imported_when_used(self):
+        downloader, = self.load()
+        self.assertIs(downloader.downloader, FakeDownloader)
+
+        downloader, = self.load()
+        self.assertIsInstance(downloader, LazyDownloader)
+        self.assertIsNone(downloader.downloader)
+        self.assertEqual((downloader.identifier, downloader.hostnames), ("fake", ["tours.example.com"]))
+
+        index = Loader([downloader])
+        self.assertEqual(index.candidates("https://tours.example.com/tour"), [downloader])
+        self.assertIsNone(downloader.downloader)
+
+        self.assertIsInstance(index.resolve_downloader_identifier("fake"), FakeDownloader)
+        self.assertIs(downloader.downloader, FakeDownloader)
+
+    def test_manifests_only_describe_installed_downloaders(self):
+        self.load()
+
+        with open(self.path) as f:
+            manifest = json.load(f)
+
+        manifest["downloaders"].append({"entry_point": "os:system", "identifier": "planted", "hostnames": ["tours.example.com"]})
+
+        with open(self.path, "w") as f:
+            json.dump(manifest, f)
+
+        self.assertEqual([downloader.identifier for downloader in self.load()], ["fake"])
+
+        with open(self.path) as f:
+            self.assertEqual([downloader["entry_point"] for downloader in json.load(f)["downloaders"]], [f"{__name__}:FakeDownloader"])
+
+    def test_manifests_default_to_the_cache_of_the_user(self):
+        with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "/home/user/.cache"}):
+            self.assertEqual(loader.manifest_path(), "/home/user/.cache/pix360/plugins.json")
+
+        with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "", "HOME": "/home/user"}):
+            self.assertEqual(loader.manifest_path(), "/home/user/.cache/pix360/plugins.json")
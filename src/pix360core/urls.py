@@ -1,11 +1,13 @@
 from django.urls import path
 
-from .views import ConverterView, StartConversionView, ConversionStatusView, ConversionLogView, ConversionListView, ConversionDeleteView, ConversionResultView, ConversionRetryView, ConversionDownloadView
+from .views import ConverterView, StartConversionView, ConversionStatusView, ConversionStatusBatchView, ConversionEventsView, ConversionLogView, ConversionListView, ConversionDeleteView, ConversionResultView, ConversionRetryView, ConversionDownloadView
 
 urlpatterns = [
     path('', ConverterView.as_view(), name='converter'),
     path('start', StartConversionView.as_view(), name='conversion_start'),
+    path('status', ConversionStatusBatchView.as_view(), name='conversion_status_batch'),
     path('status/<uuid:id>', ConversionStatusView.as_view(), name='conversion_status'),
+    path('events', ConversionEventsView.as_view(), name='conversion_events'),
     path('log/<uuid:id>', ConversionLogView.as_view(), name='conversion_log'),
     path('list', ConversionListView.as_view(), name='conversion_list'),
     path('delete/<uuid:id>', ConversionDeleteView.as_view(), name='conversion_delete'),
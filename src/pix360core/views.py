@@ -1,12 +1,20 @@
 from django.views.generic import View, TemplateView
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from pix360core.models import Conversion, ConversionStatus
+from pix360core.models import Conversion, ConversionStatus, File
+from pix360core.deduplication import create_conversion
+from pix360core.notify import notify_workers
+from pix360core.responses import serve_file, serve_rendition
+from pix360core.pagination import paginate
+from pix360core.status import conversion_statuses, status_payload, status_events
 
-import PIL.Image
+import uuid
 
 
 class ConverterView(LoginRequiredMixin, TemplateView):
@@ -14,6 +22,14 @@ class ConverterView(LoginRequiredMixin, TemplateView):
     """
     template_name = 'pix360core/converter.html'
 
+    def get_context_data(self, **kwargs):
+        """Tell the frontend whether to use the status events, see ConversionEventsView, and how many statuses to request at once
+        """
+        context = super().get_context_data(**kwargs)
+        context['status_events'] = getattr(settings, 'PIX360_STATUS_EVENTS', False)
+        context['status_batch_size'] = getattr(settings, 'PIX360_STATUS_BATCH_SIZE', 500)
+        return context
+
 @method_decorator(csrf_exempt, name='dispatch')
 class StartConversionView(LoginRequiredMixin, View):
     """View for starting a conversion
@@ -28,7 +44,34 @@ class StartConversionView(LoginRequiredMixin, View):
                 'error': 'No URL provided'
             }, status=400)
         
-        conversion = Conversion.objects.create(url=url, title=title, user=request.user)
+        options = {}
+
+        size_class = request.POST.get('size_class')
+        if size_class:
+            if size_class not in getattr(settings, 'PIX360_SIZE_CLASSES', []):
+                return JsonResponse({
+                    'error': 'Invalid size class'
+                }, status=400)
+            options['size_class'] = size_class
+
+        priority = request.POST.get('priority')
+        if priority:
+            if not request.user.is_staff:
+                return JsonResponse({
+                    'error': 'Only staff can set the priority'
+                }, status=403)
+            try:
+                options['priority'] = int(priority)
+            except ValueError:
+                return JsonResponse({
+                    'error': 'Invalid priority'
+                }, status=400)
+
+        conversion = create_conversion(url, title, request.user, **options)
+
+        if conversion.status == ConversionStatus.PENDING:
+            notify_workers()
+
         return JsonResponse({
             'id': conversion.id
         })
@@ -39,28 +82,82 @@ class ConversionStatusView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         """Handle the GET request
         """
-        conversion = Conversion.objects.filter(id=kwargs['id']).first()
-        if not conversion or not (conversion.user == request.user):
+        conversion = conversion_statuses(request.user, [kwargs['id']]).first()
+        if not conversion:
             return JsonResponse({
                 'error': 'Conversion not found'
             }, status=404)
-        
-        response = {}
-
-        if conversion.status == ConversionStatus.DONE:
-            response['status'] = "completed"
-            response['result'] = conversion.result.file.url
-            response['content_type'] = conversion.result.mime_type
-        elif conversion.status == ConversionStatus.FAILED:
-            response['status'] = "failed"
-        elif conversion.status == ConversionStatus.DOWNLOADING:
-            response['status'] = "downloading"
-        elif conversion.status == ConversionStatus.STITCHING:
-            response['status'] = "stitching"
+
+        return JsonResponse(status_payload(conversion))
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ConversionStatusBatchView(LoginRequiredMixin, View):
+    """View for getting the statuses of many conversions at once
+    """
+    def get(self, request, *args, **kwargs):
+        """Handle the GET request
+        """
+        return self.statuses(request, request.GET.getlist('id'))
+
+    def post(self, request, *args, **kwargs):
+        """Handle the POST request, for lists of IDs too long for a URL
+        """
+        return self.statuses(request, request.POST.getlist('id'))
+
+    def statuses(self, request, ids):
+        """Build the response for a list of conversion IDs
+
+        Conversions that do not exist or belong to another user are left out.
+        """
+        if len(ids) > getattr(settings, 'PIX360_STATUS_BATCH_SIZE', 500):
+            return JsonResponse({
+                'error': 'Too many conversions'
+            }, status=400)
+
+        try:
+            ids = [uuid.UUID(pk) for pk in ids]
+        except ValueError:
+            return JsonResponse({
+                'error': 'Invalid conversion ID'
+            }, status=400)
+
+        return JsonResponse({
+            'conversions': [status_payload(conversion) for conversion in conversion_statuses(request.user, ids)],
+            'time': timezone.now(),
+        })
+
+class ConversionEventsView(LoginRequiredMixin, View):
+    """View streaming the status changes of the user's conversions as Server-Sent Events
+
+    Every open stream holds a web worker, so the events are only enabled by
+    the PIX360_STATUS_EVENTS setting, for deployments running an
+    asynchronous server or enough threads. Otherwise, the frontend polls
+    ConversionStatusBatchView.
+    """
+    def get(self, request, *args, **kwargs):
+        """Handle the GET request
+        """
+        if not getattr(settings, 'PIX360_STATUS_EVENTS', False):
+            return JsonResponse({
+                'error': 'Status events are disabled'
+            }, status=404)
+
+        since = request.headers.get('Last-Event-ID') or request.GET.get('since')
+
+        if since:
+            since = parse_datetime(since)
+            if since is None:
+                return JsonResponse({
+                    'error': 'Invalid time'
+                }, status=400)
         else:
-            response['status'] = "processing"
+            since = timezone.now()
 
-        return JsonResponse(response)
+        response = StreamingHttpResponse(status_events(request.user, since), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Keep nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 class ConversionLogView(LoginRequiredMixin, View):
     """View for getting the log of a conversion
@@ -90,15 +187,14 @@ class ConversionResultView(LoginRequiredMixin, View):
                 'error': 'Conversion not found'
             }, status=404)
         
-        file = conversion.result
-        if not file:
+        try:
+            file = conversion.result
+        except File.DoesNotExist:
             return JsonResponse({
                 'error': 'Conversion not done'
             }, status=404)
 
-        content = file.file.read()
-
-        return HttpResponse(content, content_type=file.mime_type)
+        return serve_file(request, file)
 
 class ConversionListView(LoginRequiredMixin, View):
     """View for getting the list of conversions
@@ -106,14 +202,37 @@ class ConversionListView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         """Handle the GET request
         """
-        conversions = Conversion.objects.filter(user=request.user)
+        conversions = Conversion.objects.filter(user=request.user).only('id', 'url', 'title', 'status', 'created', 'updated')
+
+        statuses = request.GET.getlist('status')
+        if statuses:
+            try:
+                conversions = conversions.filter(status__in=[int(status) for status in statuses])
+            except ValueError:
+                return JsonResponse({
+                    'error': 'Invalid status'
+                }, status=400)
+
+        page_size = getattr(settings, 'PIX360_LIST_PAGE_SIZE', 100)
+
+        try:
+            limit = min(max(int(request.GET.get('limit', page_size)), 1), page_size)
+            conversions, cursor = paginate(conversions, request.GET.get('cursor'), limit)
+        except ValueError:
+            return JsonResponse({
+                'error': 'Invalid cursor or limit'
+            }, status=400)
+
         return JsonResponse({
             'conversions': [{
                 'id': conversion.id,
                 'url': conversion.url,
                 'title': conversion.title,
                 'status': conversion.status,
-            } for conversion in conversions]
+                'created': conversion.created,
+                'updated': conversion.updated,
+            } for conversion in conversions],
+            'next': cursor,
         })
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -146,7 +265,13 @@ class ConversionRetryView(LoginRequiredMixin, View):
                 'error': 'Conversion not found'
             }, status=404)
         
-        new_conversion = Conversion.objects.create(url=conversion.url, title=conversion.title, user=request.user)
+        # Never reuse the result that is being retried
+        new_conversion = create_conversion(conversion.url, conversion.title, request.user, exclude=[conversion.id, conversion.duplicate_of_id], priority=conversion.priority, size_class=conversion.size_class)
+
+        if new_conversion.status == ConversionStatus.PENDING:
+            # Resume from the intermediate files of the failed attempt, unless a worker is still using them
+            new_conversion.adopt_checkpoints(conversion)
+            notify_workers()
 
         return JsonResponse({
             'id': new_conversion.id
@@ -164,24 +289,19 @@ class ConversionDownloadView(LoginRequiredMixin, View):
                 'error': 'Conversion not found'
             }, status=404)
         
-        file = conversion.result
-        if not file:
+        try:
+            file = conversion.result
+        except File.DoesNotExist:
             return JsonResponse({
                 'error': 'Conversion not done'
             }, status=404)
 
         if "width" in kwargs:
-            width = int(kwargs['width'])
-            height = int(kwargs['height'])
-            PIL.Image.MAX_IMAGE_PIXELS = None
-            image = PIL.Image.open(file.file)
-            image.thumbnail((width, height))
-            image = image.convert('RGB')
-            response = HttpResponse(content_type="image/jpeg")
-            image.save(response, "JPEG")
-            return response
-
-        content = file.file.read()
-        response = HttpResponse(content, content_type=file.mime_type)
-        response['Content-Disposition'] = f'attachment; filename="{conversion.get_result_filename()}"'
-        return response
+            if not kwargs['width'] or not kwargs['height']:
+                return JsonResponse({
+                    'error': 'Invalid size'
+                }, status=400)
+
+            return serve_rendition(request, file, kwargs['width'], kwargs['height'])
+
+        return serve_file(request, file, filename=conversion.get_result_filename(), as_attachment=True)
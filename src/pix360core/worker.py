@@ -1,45 +1,144 @@
 from .loader import Loader
 from .models import Conversion, File, ConversionStatus
-from .classes import ConversionError
+from .classes import ConversionError, DownloaderModule
+from .notify import get_notifier
+from .processes import get_stitcher_pool
+from .renditions import create_renditions
+from .progress import discard_progress
 
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, connections, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
+from typing import List, Optional
+from datetime import timedelta
+
+import collections
 import multiprocessing
 import logging
+import os
+import signal
+import socket
+import threading
 import time
 import traceback
 
+# Statuses of conversions that are currently being worked on
+ACTIVE_STATUSES = (ConversionStatus.PROCESSING, ConversionStatus.DOWNLOADING, ConversionStatus.STITCHING, ConversionStatus.DOWNLOADED)
+
+# Statuses of conversions that are held by a worker under a lease
+LEASED_STATUSES = (ConversionStatus.PROCESSING, ConversionStatus.DOWNLOADING, ConversionStatus.STITCHING)
+
+# Stages a worker can run: the download stage, the stitch stage, or both
+STAGE_ALL = "all"
+STAGE_DOWNLOAD = "download"
+STAGE_STITCH = "stitch"
+STAGES = (STAGE_ALL, STAGE_DOWNLOAD, STAGE_STITCH)
+
+# Status a conversion is claimed from, and the status it has once the worker starts it
+CLAIMS = {
+    ConversionStatus.PENDING: ConversionStatus.PROCESSING,
+    ConversionStatus.DOWNLOADED: ConversionStatus.STITCHING,
+}
+
+def reap_expired_leases(max_attempts: Optional[int] = None) -> int:
+    """Return conversions whose worker stopped renewing its lease to the queue
+
+    Conversions that were claimed max_attempts times already are marked as
+    failed instead, so a conversion that keeps crashing its workers does not
+    take them all down. Conversions that were downloaded already are
+    returned to the stitch queue.
+
+    Args:
+        max_attempts (Optional[int], optional): Maximum number of claims per conversion. Defaults to the PIX360_MAX_ATTEMPTS setting, or 3.
+
+    Returns:
+        int: Number of conversions reclaimed
+    """
+    max_attempts = max_attempts or getattr(settings, "PIX360_MAX_ATTEMPTS", 3)
+    expired = Conversion.objects.filter(status__in=LEASED_STATUSES, lease_expires__lt=timezone.now())
+    released = {"lease_expires": None, "worker": None, "progress": None, "updated": timezone.now()}
+
+    # Each update only matches rows still in a leased status, so concurrent reapers do not conflict
+    reclaimed = expired.filter(attempts__gte=max_attempts).update(status=ConversionStatus.FAILED, log=f"Worker stopped responding, giving up after {max_attempts} attempts", **released)
+    reclaimed += expired.filter(status=ConversionStatus.STITCHING).update(status=ConversionStatus.DOWNLOADED, **released)
+    reclaimed += expired.update(status=ConversionStatus.PENDING, **released)
+
+    # Prefetched by a worker that never started them, see Worker.claim()
+    reclaimed += Conversion.objects.filter(status__in=CLAIMS, worker__isnull=False, lease_expires__lt=timezone.now()).update(
+        worker=None,
+        lease_expires=None,
+        attempts=F("attempts") - 1,
+    )
+
+    return reclaimed
+
 class Worker(multiprocessing.Process):
-    def __init__(self):
+    def __init__(self, max_jobs: Optional[int] = None, size_classes: Optional[List[str]] = None, stage: str = STAGE_ALL):
+        """Initialize the Worker
+
+        Downloaders implementing download_conversion() and stitch_conversion()
+        can have their conversions processed by two pools of workers: one for
+        the I/O bound download stage and one for the CPU bound stitch stage.
+        Downloaded conversions are handed off through the DOWNLOADED status,
+        and download workers stop taking new conversions while
+        PIX360_PIPELINE_QUEUE_SIZE conversions are waiting to be stitched.
+        Conversions of other downloaders are processed by download workers
+        as a whole.
+
+        Args:
+            max_jobs (Optional[int], optional): Number of conversions after which the worker exits, so it can be replaced by a fresh process. Defaults to None, meaning no limit.
+            size_classes (Optional[List[str]], optional): Only process conversions of these size classes, and those without a size class. Defaults to None, meaning all conversions.
+            stage (str, optional): Stage to process, see STAGES. Defaults to STAGE_ALL.
+
+        Raises:
+            ValueError: If the stage is invalid
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Invalid stage: {stage}")
+
         super().__init__()
-        self.loader = Loader()
+        self.loader = None
         self.logger = logging.getLogger("pix360")
+        self.max_jobs = max_jobs
+        self.size_classes = size_classes
+        self.stage = stage
+        self.queue_size = getattr(settings, "PIX360_PIPELINE_QUEUE_SIZE", 8)
+        self.lease_duration = getattr(settings, "PIX360_LEASE_DURATION", 300)
+        self.heartbeat_interval = getattr(settings, "PIX360_HEARTBEAT_INTERVAL", 30)
+        self.leases = {}
+        self.leases_lock = threading.Lock()
+        self.identity = None
+        self.stop_event = multiprocessing.Event()
+        self.heartbeat_stop = None
+        self.poll_interval = getattr(settings, "PIX360_WORKER_POLL_INTERVAL", 30)
+        self.prefetch = getattr(settings, "PIX360_WORKER_PREFETCH", 1)
+        self.notifier = None
 
-        handler = logging.StreamHandler()
-        handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-        self.logger.addHandler(handler)
+        if not self.logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+            self.logger.addHandler(handler)
 
         if settings.DEBUG:
             self.logger.setLevel(logging.DEBUG)
         else:
             self.logger.setLevel(logging.INFO)
 
-    def process_conversion(self, conversion: Conversion) -> File:
-        """Process a conversion
+    def get_downloader(self, conversion: Conversion) -> DownloaderModule:
+        """Get the downloader for a conversion, finding the best one if none is set yet
 
         Args:
-            conversion (Conversion): Conversion to process
+            conversion (Conversion): Conversion to get the downloader for
 
         Returns:
-            File: Result of the conversion
+            DownloaderModule: The downloader
 
         Raises:
-            ConversionError: If the conversion is invalid
-            DownloadError: If the download fails
-            StitchingError: If the stitching fails
+            ConversionError: If no suitable downloader is installed
         """
-        
         if conversion.downloader:
             downloader = self.loader.resolve_downloader_identifier(conversion.downloader)
             if not downloader:
@@ -50,49 +149,381 @@ class Worker(multiprocessing.Process):
                 downloaders.sort(key=lambda x: x[1], reverse=True)
                 downloader = downloaders[0][0]
                 conversion.downloader = downloader.identifier
-                conversion.save()
+                conversion.save(update_fields=["downloader", "updated"])
             else:
                 raise ConversionError("No downloader found")
+
+        return downloader
+
+    def set_status(self, conversion: Conversion, status: int):
+        """Update the status of a conversion
+
+        Args:
+            conversion (Conversion): Conversion to update
+            status (int): New status, see ConversionStatus
+        """
+        conversion.status = status
+        conversion.save(update_fields=["status", "updated"])
+
+    def finish(self, conversion: Conversion, **fields) -> bool:
+        """Write the outcome of a conversion and give up its lease, if this worker still holds it
+
+        A conversion whose lease expired may have been reclaimed and
+        processed by another worker meanwhile, whose outcome must not be
+        overwritten.
+
+        Args:
+            conversion (Conversion): Conversion to update
+            **fields: Fields to update, like the status
+
+        Returns:
+            bool: Whether the outcome was written
+        """
+        fields.update(worker=None, lease_expires=None, progress=None, updated=timezone.now())
+        finished = Conversion.objects.filter(id=conversion.id, worker=self.identity).update(**fields)
+
+        if not finished:
+            self.logger.warning(f"Lost the lease on conversion {conversion.id}, discarding its outcome")
+            return False
+
+        for name, value in fields.items():
+            setattr(conversion, name, value)
+
+        return True
+
+    def process_conversion(self, conversion: Conversion) -> Optional[File]:
+        """Process a conversion, or the stage of it this worker is responsible for
+
+        Args:
+            conversion (Conversion): Conversion to process
+
+        Returns:
+            Optional[File]: Result of the conversion, or None if it was handed off to the stitch stage
+
+        Raises:
+            ConversionError: If the conversion is invalid
+            DownloadError: If the download fails
+            StitchingError: If the stitching fails
+        """
         
-        result = downloader.process_conversion(conversion)
+        downloader = self.get_downloader(conversion)
+
+        if conversion.status == ConversionStatus.STITCHING:
+            # Claimed from the hand-off queue, downloaded by another worker
+            result = downloader.stitch_conversion(conversion, conversion.stage_data)
+        elif downloader.supports_pipeline:
+            self.set_status(conversion, ConversionStatus.DOWNLOADING)
+            data = downloader.download_conversion(conversion)
+
+            if self.stage == STAGE_DOWNLOAD:
+                if self.finish(conversion, status=ConversionStatus.DOWNLOADED, stage_data=data):
+                    self.notifier.notify()
+                return None
+
+            self.set_status(conversion, ConversionStatus.STITCHING)
+            result = downloader.stitch_conversion(conversion, data)
+        else:
+            result = downloader.process_conversion(conversion)
+
         result.conversion = conversion
         result.is_result = True
         result.save()
 
+        if result.mime_type.startswith("image/"):
+            try:
+                create_renditions(result)
+            except Exception as e:
+                # Previews are made on demand if they are missing
+                self.logger.warning(f"Could not create renditions for conversion {conversion.id}: {e}")
+
         return result
 
+    def sources(self) -> List[int]:
+        """Get the statuses this worker currently claims conversions from
+
+        Returns:
+            List[int]: Statuses to claim from, in order of preference
+        """
+        sources = []
+
+        if self.stage in (STAGE_ALL, STAGE_STITCH):
+            sources.append(ConversionStatus.DOWNLOADED)
+
+        if self.stage == STAGE_ALL:
+            sources.append(ConversionStatus.PENDING)
+        elif self.stage == STAGE_DOWNLOAD:
+            # Back pressure: wait for the stitch workers to catch up
+            if Conversion.objects.filter(status=ConversionStatus.DOWNLOADED).count() < self.queue_size:
+                sources.append(ConversionStatus.PENDING)
+            else:
+                self.logger.debug("Stitch queue is full")
+
+        return sources
+
+    def claim(self, count: int = 1) -> List[Conversion]:
+        """Claim the next conversions for this worker
+
+        Conversions with a higher priority come first. Among those, users
+        with fewer conversions in progress are preferred, so a user queueing
+        many conversions cannot starve the others. Remaining ties are broken
+        by age. Downloaded conversions are claimed before pending ones.
+
+        Rows locked by other workers are skipped where the database supports
+        it, so concurrent workers do not wait for each other.
+
+        Claimed conversions are leased to this worker for
+        PIX360_LEASE_DURATION seconds, and the lease is renewed by a heartbeat
+        until they are finished, see heartbeat(). They keep the status they
+        were claimed from until the worker starts them, see start_conversion(), so
+        prefetched conversions are still reported as queued.
+
+        Args:
+            count (int, optional): Maximum number of conversions to claim. Defaults to 1.
+
+        Returns:
+            List[Conversion]: The claimed conversions
+        """
+        skip_locked = connection.features.has_select_for_update_skip_locked
+
+        active = (
+            Conversion.objects.filter(user=OuterRef("user"), status__in=ACTIVE_STATUSES)
+            .order_by()
+            .values("user")
+            .annotate(count=Count("id"))
+            .values("count")
+        )
+
+        conversions = []
+
+        for source in self.sources():
+            if len(conversions) >= count:
+                break
+
+            queued = Conversion.objects.filter(status=source, worker__isnull=True)
+
+            if self.size_classes:
+                # Conversions without a size class would be left behind if no worker took them
+                queued = queued.filter(Q(size_class__in=self.size_classes) | Q(size_class__isnull=True))
+
+            now = timezone.now()
+            expires = now + timedelta(seconds=self.lease_duration)
+
+            with transaction.atomic():
+                claimed = list(
+                    queued.select_for_update(skip_locked=skip_locked)
+                    .annotate(user_active=Coalesce(Subquery(active), 0))
+                    .order_by("-priority", "user_active", "created")[:count - len(conversions)]
+                )
+
+                if claimed:
+                    Conversion.objects.filter(id__in=[conversion.id for conversion in claimed]).update(
+                        worker=self.identity,
+                        lease_expires=expires,
+                        attempts=F("attempts") + 1,
+                    )
+
+            for conversion in claimed:
+                conversion.worker = self.identity
+                conversion.lease_expires = expires
+                conversion.attempts += 1
+
+            conversions.extend(claimed)
+
+        with self.leases_lock:
+            self.leases.update((conversion.id, conversion) for conversion in conversions)
+
+        return conversions
+
+    def start_conversion(self, conversion: Conversion) -> bool:
+        """Mark a claimed conversion as being processed by this worker
+
+        Args:
+            conversion (Conversion): Conversion from claim()
+
+        Returns:
+            bool: Whether the conversion was started, which fails if the lease on it was lost
+        """
+        now = timezone.now()
+        status = CLAIMS[conversion.status]
+
+        if not Conversion.objects.filter(id=conversion.id, status=conversion.status, worker=self.identity).update(status=status, updated=now):
+            return False
+
+        conversion.status = status
+        conversion.updated = now
+        return True
+
+    def release(self, conversions: List[Conversion]):
+        """Return claimed conversions that were not started to the queue
+
+        Args:
+            conversions (List[Conversion]): The conversions to release
+        """
+        Conversion.objects.filter(id__in=[conversion.id for conversion in conversions], status__in=CLAIMS, worker=self.identity).update(
+            worker=None,
+            lease_expires=None,
+            attempts=F("attempts") - 1,
+        )
+
+        self.end_leases(conversions)
+
+        if conversions:
+            self.notifier.notify()
+
+    def end_leases(self, conversions: List[Conversion]):
+        """Stop renewing the leases of conversions
+
+        Args:
+            conversions (List[Conversion]): Conversions no longer processed by this worker
+        """
+        with self.leases_lock:
+            for conversion in conversions:
+                self.leases.pop(conversion.id, None)
+
+    def renew_leases(self):
+        """Renew the leases of the claimed conversions and reclaim expired ones
+        """
+        with self.leases_lock:
+            leases = list(self.leases.values())
+
+        if leases:
+            expires = timezone.now() + timedelta(seconds=self.lease_duration)
+            renewed = Conversion.objects.filter(id__in=[conversion.id for conversion in leases], worker=self.identity).update(lease_expires=expires)
+
+            # Keep the objects in sync, so saving them does not revert the lease
+            for conversion in leases:
+                conversion.lease_expires = expires
+
+            if renewed < len(leases):
+                self.logger.warning(f"Lost the lease on {len(leases) - renewed} conversions")
+
+        reclaimed = reap_expired_leases()
+
+        if reclaimed:
+            self.logger.warning(f"Reclaimed {reclaimed} conversions from unresponsive workers")
+            self.notifier.notify()
+
+    def heartbeat(self):
+        """Call renew_leases() every PIX360_HEARTBEAT_INTERVAL seconds, until the main loop has finished
+
+        This runs in a separate thread, so leases are kept alive while a long
+        conversion blocks the main thread, including the last one after the
+        worker was asked to stop.
+        """
+        while not self.heartbeat_stop.wait(self.heartbeat_interval):
+            try:
+                self.renew_leases()
+            except Exception as e:
+                self.logger.error(f"Heartbeat error: {e}")
+
+        connections.close_all()
+
+    def stop(self, *args):
+        """Ask the worker to exit once the conversion in progress is finished
+
+        Can be used as a signal handler.
+        """
+        self.stop_event.set()
+
+        if self.notifier:
+            self.notifier.interrupt()
+
     def run(self):
         """Run the worker
+
+        The worker exits after SIGTERM or SIGINT, or after max_jobs
+        conversions, but never in the middle of a conversion. While the
+        queue is empty, it sleeps until notified of a new conversion, or
+        for at most PIX360_WORKER_POLL_INTERVAL seconds. Up to
+        PIX360_WORKER_PREFETCH conversions are claimed at once, and those not
+        started yet are returned to the queue on exit. The time the worker
+        took to start, including loading the downloaders, is logged.
         """
-        while True:
+        started = time.monotonic()
+
+        # Loaded here rather than in __init__(), which runs in the supervisor
+        if self.loader is None:
+            self.loader = Loader()
+
+        loader_time = time.monotonic() - started
+
+        self.notifier = get_notifier()
+        self.identity = f"{socket.gethostname()}:{os.getpid()}"
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        try:
+            # Start listening before the first check of the queue, so no notification is missed
+            self.notifier.fileno()
+        except Exception as e:
+            self.logger.warning(f"Notifications unavailable, polling every {self.poll_interval} seconds: {e}")
+
+        self.heartbeat_stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, name="pix360-heartbeat", daemon=True)
+        heartbeat.start()
+
+        self.logger.info(f"Worker {self.identity} ready after {time.monotonic() - started:.3f} seconds, loading {len(self.loader.downloaders)} downloaders took {loader_time:.3f} seconds")
+
+        jobs = 0
+        claimed = collections.deque()
+
+        while not self.stop_event.is_set() and (self.max_jobs is None or jobs < self.max_jobs):
             try:
-                with transaction.atomic():
-                    conversion = Conversion.objects.select_for_update().filter(status=ConversionStatus.PENDING).first()
-                
-                    if conversion:
-                        conversion.status = ConversionStatus.PROCESSING
-                        conversion.save()
+                if not claimed:
+                    count = self.prefetch if self.max_jobs is None else min(self.prefetch, self.max_jobs - jobs)
+                    claimed.extend(self.claim(count))
 
-                    else:
-                        self.logger.debug("No conversion to process")
-                        time.sleep(1)
-                        continue
+                if not claimed:
+                    self.logger.debug("No conversion to process")
+                    self.notifier.wait(self.poll_interval)
+                    continue
+
+                conversion = claimed.popleft()
+
+                if not self.start_conversion(conversion):
+                    self.logger.warning(f"Lost the lease on conversion {conversion.id} before starting it")
+                    self.end_leases([conversion])
+                    continue
 
                 self.logger.info(f"Processing conversion {conversion.id}")
+                jobs += 1
+                handed_off = conversion.status == ConversionStatus.STITCHING
             
                 try:
                     result = self.process_conversion(conversion)
-                    result.is_result = True
-                    result.save()
-                    conversion.status = ConversionStatus.DONE
-                    conversion.save()
-                    self.logger.info(f"Conversion {conversion.id} done")
+
+                    if not result:
+                        self.logger.info(f"Conversion {conversion.id} downloaded")
+                    elif self.finish(conversion, status=ConversionStatus.DONE, stage_data=None):
+                        self.logger.info(f"Conversion {conversion.id} done")
+                    else:
+                        # The worker that reclaimed the conversion provides the result
+                        result.is_result = False
+                        result.save(update_fields=["is_result"])
                 except Exception as e:
-                    conversion.status = ConversionStatus.FAILED
-                    conversion.log = traceback.format_exc()
-                    conversion.save()
+                    self.finish(conversion, status=ConversionStatus.FAILED, log=traceback.format_exc())
                     self.logger.error(f"Conversion {conversion.id} failed: {e}")
                     self.logger.debug(traceback.format_exc())
 
+                discard_progress(conversion)
+                self.end_leases([conversion])
+
+                if handed_off:
+                    # Download workers may be waiting for room in the stitch queue
+                    self.notifier.notify()
+
             except Exception as e:
-                self.logger.error(f"Worker error: {e}")
\ No newline at end of file
+                self.logger.error(f"Worker error: {e}")
+
+        try:
+            self.release(list(claimed))
+        except Exception as e:
+            self.logger.error(f"Could not release prefetched conversions: {e}")
+
+        self.heartbeat_stop.set()
+        heartbeat.join()
+
+        self.notifier.close()
+        get_stitcher_pool().shutdown()
+        self.logger.info(f"Worker exiting after {jobs} conversions")